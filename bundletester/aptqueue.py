@@ -0,0 +1,120 @@
+"""Serialize the apt work of concurrent bundletester processes.
+
+Each process queues a request (sources and packages) in a shared
+directory and then waits for the queue's lock. Whoever gets the lock runs
+all queued requests as one transaction, so the processes waiting behind
+it usually find their request already done. If that transaction fails it
+retries with only its own request, and marks the others failed so each
+process retries its own, rather than the merged transaction again.
+"""
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+
+from bundletester import utils
+
+log = logging.getLogger('aptqueue')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _merge(lists):
+    merged = []
+    for items in lists:
+        merged.extend(i for i in items if i not in merged)
+    return merged
+
+
+def _mark(request, suffix):
+    """Replace the queued request file with a marker for its process."""
+    os.rename(request['path'], request['path'][:-len('.request')] + suffix)
+
+
+class AptQueue(object):
+    """A queue of apt requests in path, shared by every bundletester
+    process using the same cache directory."""
+    def __init__(self, path=None):
+        self.path = path or utils.cache_dir('apt')
+
+    def _requests(self):
+        """Return the queued requests, dropping those of dead processes.
+        """
+        requests = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.request'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                with open(path) as fp:
+                    request = json.load(fp)
+            except (IOError, ValueError):
+                continue
+            if not _alive(request['pid']):
+                log.debug('Dropping request of dead process %s',
+                          request['pid'])
+                os.remove(path)
+                continue
+            request['path'] = path
+            requests.append(request)
+        return requests
+
+    def run(self, sources, packages, execute):
+        """Have execute(sources, packages) run for these sources and
+        packages, merged with those of the other queued requests, unless
+        another process already did.
+
+        Returns the seconds spent waiting for the queue.
+        """
+        name = '%s-%s' % (os.getpid(), uuid.uuid4().hex)
+        path = os.path.join(self.path, name + '.request')
+        done = os.path.join(self.path, name + '.done')
+        failed = os.path.join(self.path, name + '.failed')
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'pid': os.getpid(), 'sources': sources,
+                       'packages': packages}, fp)
+        os.rename(tmp, path)
+
+        start = time.time()
+        try:
+            with open(os.path.join(self.path, 'lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                waited = time.time() - start
+                log.info('Waited %.1fs for the apt queue', waited)
+                if os.path.exists(done):
+                    log.debug('Request already run by another process')
+                    return waited
+                if os.path.exists(failed):
+                    log.info('Merged apt request failed, running our own')
+                    execute(sources, packages)
+                    return waited
+                requests = self._requests()
+                try:
+                    execute(_merge(r['sources'] for r in requests),
+                            _merge(r['packages'] for r in requests))
+                except Exception:
+                    others = [r for r in requests if r['path'] != path]
+                    if not others:
+                        raise
+                    log.warning('Merged apt request failed, running our own')
+                    for request in others:
+                        _mark(request, '.failed')
+                    execute(sources, packages)
+                    return waited
+                for request in requests:
+                    _mark(request, '.done')
+                return waited
+        finally:
+            for leftover in (path, done, failed):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
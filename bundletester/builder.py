@@ -2,25 +2,55 @@ import os
 import logging
 import subprocess
 import sys
+import threading
 import time
 import errno
+import fcntl
+import glob
+import random
+import re
 
 import websocket
 from deployer.env.go import GoEnvironment
 
+from bundletester import aptqueue, probe, process, utils, venvcache
+from bundletester.utils import OutputCapture
+
+# Output of apt-get and dpkg when another process holds the dpkg lock
+APT_LOCK_ERROR = re.compile(
+    r'Could not get lock|Unable to lock|Unable to acquire the dpkg')
+
+
+class DeploymentError(RuntimeError):
+    """The deployment failed to settle."""
+
 
 class Builder(object):
     """Build out the system-level environment needed to run tests"""
-    APT_NO_LOCK = 100  # The return code for "couldn't acquire lock" in APT
-    APT_NO_LOCK_RETRY_DELAY = 10
+    # Seconds between status checks while waiting for a deployment
+    DEPLOYMENT_POLL = 5
+    # Consecutive polls the model must stay idle for, so units idle for a
+    # moment between hooks don't end the wait
+    DEPLOYMENT_SETTLE = 3
+    # Bounds of the delay between retries while the dpkg lock is held
+    APT_LOCK_RETRY_MIN = 5
+    APT_LOCK_RETRY_MAX = 60
+    # Bounds of the status polling interval when the model can't be watched
+    REMOVAL_POLL_MIN = 0.5
+    REMOVAL_POLL_MAX = 8
 
-    def __init__(self, config, options):
+    def __init__(self, config, options, environment=None):
         self.config = config
         self.options = options
         self.environment = None
         self.env_name = None
+        # Model state right after the last full reset, and after the
+        # deployment that partial resets return to.
+        self._reset_state = None
+        self._baseline = None
+        self._venv_cache = None
         if options:
-            self.env_name = options.environment
+            self.env_name = environment or options.environment
             if self.env_name:
                 self.environment = GoEnvironment(self.env_name)
 
@@ -64,22 +94,22 @@ class Builder(object):
             return result
 
         logging.debug("deploy %s", ' '.join(cmd))
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
+        log_dir = getattr(self.options, 'log_dir', None)
+        output = OutputCapture(
+            os.path.join(log_dir, '000-deploy.log') if log_dir else None)
+        try:
+            p = process.run(cmd, output)
+        finally:
+            output.close()
 
-        # Print all output as it comes in to debug
-        output = []
-        lines = iter(p.stdout.readline, "")
-        for line in lines:
-            output.append(line)
-            logging.debug(str(line.rstrip()))
-
-        p.communicate()
-        return {
+        result = {
             'returncode': p.returncode,
-            'output': ''.join(output),
+            'output': output.getvalue(),
             'executable': cmd
         }
+        if output.path:
+            result['output_file'] = output.path
+        return result
 
     def destroy(self):
         if self.options.no_destroy:
@@ -95,10 +125,107 @@ class Builder(object):
             # at least for now.
             self.reset()
 
-    def reset(self):
+    @property
+    def _applications_key(self):
+        if self.options.juju_major_version == 1:
+            return 'services'
+        return 'applications'
+
+    def model_state(self):
+        """Return a comparable snapshot of the applications in the model:
+        their charm, units, relations and config.
+        """
+        status = self.environment.status()
+        state = {}
+        for name, app in (status.get(self._applications_key) or {}).items():
+            state[name] = {
+                'charm': app.get('charm'),
+                'units': sorted((app.get('units') or {}).keys()),
+                'relations': app.get('relations') or {},
+                'config': self.environment.get_config(name),
+            }
+        return state
+
+    def wait_for_deployment(self, timeout):
+        """Wait for every unit to be idle with an active workload.
+
+        The model has to be idle for DEPLOYMENT_SETTLE polls in a row.
+        Returns the seconds after which each application became ready.
+        Raises DeploymentError as soon as a unit is in error, when units
+        are still blocked once the whole model stays idle, or once timeout
+        seconds have passed.
+        """
+        start = time.time()
+        ready = {}
+        # The applications pending at the last idle poll, and how many
+        # idle polls in a row saw them
+        idle, quiet = None, 0
+        while True:
+            status = self.environment.status()
+            pending = []
+            blocked = []
+            settled = True
+            applications = status.get(self._applications_key) or {}
+            for name, app in sorted(applications.items()):
+                state = _application_state(app, blocked)
+                if state == 'ready':
+                    if name not in ready:
+                        ready[name] = round(time.time() - start, 1)
+                        logging.debug('%s ready after %ss', name, ready[name])
+                else:
+                    # It may have been ready and gone back to work
+                    ready.pop(name, None)
+                    pending.append(name)
+                    settled = settled and state == 'blocked'
+            if settled:
+                quiet = quiet + 1 if pending == idle else 1
+                idle = pending
+            else:
+                idle, quiet = None, 0
+            if quiet >= self.DEPLOYMENT_SETTLE:
+                if not pending:
+                    return ready
+                # Units are often blocked until their relations are
+                # joined, it's only final once nothing else is going on.
+                raise DeploymentError(
+                    'Units blocked: %s' % '; '.join(blocked))
+            if time.time() - start > timeout:
+                raise DeploymentError(
+                    'Timeout exceeded. Applications not ready after %s '
+                    'seconds: %s%s' % (
+                        timeout, ', '.join(pending),
+                        ' (blocked: %s)' % '; '.join(blocked)
+                        if blocked else ''))
+            logging.debug('Waiting for applications: %s', pending)
+            time.sleep(self.DEPLOYMENT_POLL)
+
+    def mark_baseline(self):
+        """Record the current model as the state partial resets return to.
+        """
+        if self.options.dryrun or not self.environment:
+            return
+        self._baseline = self.model_state()
+
+    def reset(self, partial=False):
+        """Reset the model, unless it is unchanged since the last reset.
+
+        With partial, if the applications present at the baseline are
+        unchanged only the applications added since are removed.
+        """
         if self.options.dryrun:
             return
         if self.environment:
+            state = self.model_state()
+            if state == self._reset_state:
+                logging.debug('Model unchanged since last reset, skipping')
+                return
+            if partial and self._baseline is not None:
+                if state == self._baseline:
+                    logging.debug('Model unchanged since baseline, skipping')
+                    return
+                if self._remove_added(state):
+                    return
+
             start, timeout = time.time(), self.config.reset_timeout
             while True:
                 try:
@@ -132,57 +259,171 @@ class Builder(object):
                     time.sleep(1)
                     logging.debug('Retrying environment reset...')
 
-            # wait for all applications to be removed
-            logging.debug("Waiting for applications to be removed...")
-            start, timeout = time.time(), self.config.reset_timeout
-            while True:
-                status = self.environment.status()
-                if self.options.juju_major_version == 1:
-                    key = 'services'
-                else:
-                    key = 'applications'
-                if not status.get(key):
-                    break
-                if (time.time() - start) > timeout:
-                    raise RuntimeError(
-                        'Timeout exceeded. Failed to destroy all applications '
-                        ' in %s seconds.' % timeout)
+            self._wait_for_removal()
+            self._reset_state = self.model_state()
+
+    def _remove_added(self, state):
+        """Destroy the applications added since the baseline.
+
+        Returns False, without changing anything, if the baseline
+        applications were modified so a full reset is needed instead.
+        """
+        for name, app in self._baseline.items():
+            if state.get(name) != app:
+                logging.debug('Application %s changed since baseline', name)
+                return False
+        added = sorted(set(state) - set(self._baseline))
+        logging.debug('Removing applications added since baseline: %s',
+                      added)
+        client = self.environment.client
+        destroy = getattr(client, 'destroy_application', None) or \
+            client.destroy_service
+        for name in added:
+            destroy(name)
+        self._wait_for_removal(added)
+        return True
+
+    def _wait_for_removal(self, names=None):
+        """Wait for the named applications, or all of them, to be removed.
+
+        Follows the model's all-watcher deltas when possible, so there is
+        no polling delay, and otherwise polls the status with a growing
+        interval.
+        """
+        logging.debug("Waiting for applications to be removed...")
+        deadline = time.time() + self.config.reset_timeout
+        if not self._watch_removal(names, deadline):
+            self._poll_removal(names, deadline)
+
+    def _removal_timeout(self):
+        raise RuntimeError(
+            'Timeout exceeded. Failed to destroy all applications '
+            ' in %s seconds.' % self.config.reset_timeout)
+
+    def _watch_removal(self, names, deadline):
+        """Watch the model until the applications are removed. Returns
+        False if the model couldn't be watched to the end.
+        """
+        get_watch = getattr(self.environment.client, 'get_watch', None)
+        if get_watch is None:
+            return False
+        try:
+            watch = get_watch()
+        except Exception as e:
+            logging.debug('Unable to watch the model: %s', e)
+            return False
+        # The first delta of an empty model never comes, so don't wait
+        # for it if there is nothing left to remove.
+        if not self._remaining(names):
+            _close_watch(watch)
+            return True
+        # The watch blocks until the model changes, so close its
+        # connection when the time is up.
+        timer = threading.Timer(
+            max(deadline - time.time(), 0), _abort_watch, [watch])
+        timer.daemon = True
+        timer.start()
+        remaining = set()
+        try:
+            for deltas in watch:
+                _track_applications(remaining, deltas, names)
+                if not remaining:
+                    return True
                 logging.debug(
-                    " Remaining applications: %s", status.get(key).keys())
-                time.sleep(4)
+                    " Remaining applications: %s", sorted(remaining))
+        except Exception as e:
+            if time.time() >= deadline:
+                if not self._remaining(names):
+                    return True
+                self._removal_timeout()
+            logging.debug('Lost the model watch: %s', e)
+        finally:
+            timer.cancel()
+            _close_watch(watch)
+        return False
+
+    def _remaining(self, names):
+        """Return the set of the named applications, or all of them,
+        still in the model's status."""
+        status = self.environment.status()
+        remaining = set(status.get(self._applications_key) or {})
+        if names is not None:
+            remaining.intersection_update(names)
+        return remaining
+
+    def _poll_removal(self, names, deadline):
+        delay = self.REMOVAL_POLL_MIN
+        while True:
+            remaining = self._remaining(names)
+            if not remaining:
+                break
+            if time.time() > deadline:
+                self._removal_timeout()
+            logging.debug(
+                " Remaining applications: %s", sorted(remaining))
+            time.sleep(delay)
+            delay = min(delay * 2, self.REMOVAL_POLL_MAX)
 
     def build_virtualenv(self, path):
         subprocess.check_call(
             ['virtualenv', '-p', self.config.virtualenv_python, path],
             stdout=open('/dev/null', 'w'))
 
-    def _run_apt_command(self, cmd, retries=3):
+    def virtualenv(self, path):
+        """Return the path of a virtualenv with the python packages of the
+        tests installed.
+
+        The virtualenv is taken from the cache, or built there, unless
+        caching is disabled, in which case it is built at path.
         """
-        Run an APT command, retrying if failed.
+        def build(path):
+            self.build_virtualenv(path)
+            self.install_python_packages(os.path.join(path, 'bin', 'pip'))
+
+        if getattr(self.options, 'no_cache', False):
+            build(path)
+            return path
+        if not self._venv_cache:
+            self._venv_cache = venvcache.VenvCache(
+                max_size=getattr(self.options, 'venv_cache_size', None) or
+                venvcache.DEFAULT_SIZE)
+        python = (probe.which(self.config.virtualenv_python) or
+                  self.config.virtualenv_python)
+        key = venvcache.venv_key(
+            python, self._requirements(), self.config.python_packages)
+        return self._venv_cache.get(key, build)
+
+    def _run_apt_command(self, cmd, retries=5):
+        """
+        Run an APT command, retrying with a jittered backoff while the
+        dpkg lock is held by another process.
 
         :param: cmd: str: The apt command to run.
-        :param: fatal: bool: Whether the command's output should be checked and
-            retried.
+        :param: retries: int: How many times to retry on lock errors.
         """
         env = os.environ.copy()
 
         if 'DEBIAN_FRONTEND' not in env:
             env['DEBIAN_FRONTEND'] = 'noninteractive'
 
-        result = None
-        retry_count = 0
-        while result is None or result == self.APT_NO_LOCK:
-            try:
-                result = subprocess.check_call(cmd, env=env)
-            except subprocess.CalledProcessError as e:
-                retry_count = retry_count + 1
-                if retry_count > retries:
-                    raise
-                result = e.returncode
-                logging.info(
-                    "Couldn't acquire DPKG lock. Will retry in {} seconds."
-                    "".format(self.APT_NO_LOCK_RETRY_DELAY))
-                time.sleep(self.APT_NO_LOCK_RETRY_DELAY)
+        for attempt in range(retries + 1):
+            proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+            for line in output.splitlines():
+                logging.debug(line)
+            if proc.returncode == 0:
+                return
+            if attempt == retries or not APT_LOCK_ERROR.search(output):
+                raise subprocess.CalledProcessError(
+                    proc.returncode, cmd, output)
+            delay = min(self.APT_LOCK_RETRY_MIN * 2 ** attempt,
+                        self.APT_LOCK_RETRY_MAX)
+            delay *= random.uniform(0.5, 1.5)
+            logging.info(
+                "Couldn't acquire DPKG lock. Will retry in {:.0f} seconds."
+                "".format(delay))
+            time.sleep(delay)
 
     def add_source(self, source):
         logging.debug('Adding source: %s', source)
@@ -198,23 +439,221 @@ class Builder(object):
         logging.debug('Running `sudo apt-get update -qq`')
         self._run_apt_command(['sudo', 'apt-get', 'update', '-qq'])
 
-    def install_packages(self):
-        if self.config.packages:
+    def install_packages(self, python=True):
+        self.install_system_packages([self.config])
+        if python:
+            self.install_python_packages()
+
+    def install_system_packages(self, configs):
+        """Add the apt sources and install the packages of all configs,
+        with at most one update and one install.
+
+        Sources already configured and packages already installed are
+        skipped.
+        """
+        sources, packages = [], []
+        needs_pip = False
+        for config in configs:
+            sources.extend(s for s in config.sources if s not in sources)
+            packages.extend(p for p in config.packages if p not in packages)
+            needs_pip = needs_pip or bool(config.python_packages)
+        if packages and needs_pip and not probe.which('pip'):
+            packages.append('python-pip')
+
+        configured = configured_sources() if sources else set()
+        added = [s for s in sources if not source_configured(s, configured)]
+        missing = missing_packages(packages)
+        if not (added or missing):
+            logging.debug('Apt sources and packages already present')
+            return
+        # Shared with other bundletester processes on this host
+        aptqueue.AptQueue().run(
+            added, missing, self._apt_transaction)
+
+    def _apt_transaction(self, sources, packages):
+        for source in sources:
+            self.add_source(source)
+        if sources:
+            self.apt_update()
+        if packages:
             cmd = ['sudo', 'apt-get', 'install', '-qq', '-y']
-            cmd.extend(set(self.config.packages))
-            if (self.config.python_packages and
-                    subprocess.call(['which', 'pip']) != 0):
-                cmd.extend('python-pip')
+            cmd.extend(packages)
             self._run_apt_command(cmd)
 
-        if self.config.python_packages or self.config.requirements:
+    def _requirements(self):
+        """Return the paths of the existing requirement files."""
+        paths = [os.path.join(self.options.testdir, requirement)
+                 for requirement in self.config.requirements]
+        return [path for path in paths if os.path.exists(path)]
+
+    def install_python_packages(self, pip=None):
+        """Install the python packages and requirements with pip, or the
+        pip executable given.
+
+        In wheelhouse mode packages are installed from the wheels in the
+        cache, and only missing wheels are fetched and built.
+        """
+        if not (self.config.python_packages or self.config.requirements):
+            return
+        if pip:
+            cmd = [pip]
+        else:
             cmd = ['sudo'] if not self.config.virtualenv else []
-            cmd.extend(['pip', 'install', '-U'])
-            for requirement in self.config.requirements:
-                requirement_path = os.path.join(
-                    self.options.testdir, requirement)
-                if os.path.exists(requirement_path):
-                    cmd.extend(['--requirement', requirement_path])
-            if self.config.python_packages:
-                cmd.extend(set(self.config.python_packages))
-            subprocess.check_call(cmd)
+            cmd.append('pip')
+        args = []
+        for requirement_path in self._requirements():
+            args.extend(['--requirement', requirement_path])
+        if self.config.python_packages:
+            args.extend(set(self.config.python_packages))
+        if not getattr(self.options, 'wheelhouse', False):
+            subprocess.check_call(cmd + ['install', '-U'] + args)
+            return
+
+        wheelhouse = utils.cache_dir('wheelhouse')
+        links = ['--find-links', wheelhouse]
+        for path in getattr(self.options, 'find_links', None) or []:
+            links.extend(['--find-links', path])
+        offline = cmd + ['install', '-U', '--no-index'] + links + args
+        if subprocess.call(offline) == 0:
+            return
+        logging.info('Building missing wheels into %s', wheelhouse)
+        # Building wheels needs no privileges
+        with open(os.path.join(wheelhouse, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            subprocess.check_call(
+                [pip or 'pip', 'wheel', '--wheel-dir', wheelhouse] +
+                links + args)
+        subprocess.check_call(offline)
+
+
+def _status_value(status, *keys):
+    """Return the state and message of a unit status entry, in either
+    the API or the CLI format."""
+    for key in keys:
+        value = status.get(key)
+        if isinstance(value, dict):
+            return (value.get('current') or value.get('status'),
+                    value.get('message') or value.get('info') or '')
+    return None, ''
+
+
+def _units(app):
+    """Yield the name and status of the units of app, subordinates
+    included."""
+    for name, unit in (app.get('units') or {}).items():
+        yield name, unit
+        for sub in (unit.get('subordinates') or {}).items():
+            yield sub
+
+
+def _application_state(app, blocked):
+    """Return 'ready' if every unit of app is idle with an active (or
+    unset) workload, 'blocked' if the others are idle with a blocked
+    workload, and 'busy' otherwise. Blocked units are added to blocked.
+    Raises DeploymentError on units in error."""
+    state = 'ready'
+    for name, unit in _units(app):
+        workload, message = _status_value(unit, 'workload-status')
+        agent, agent_message = _status_value(
+            unit, 'juju-status', 'agent-status')
+        if workload == 'error' or agent == 'error':
+            raise DeploymentError('%s is in error: %s' % (
+                name, message or agent_message))
+        if agent != 'idle':
+            state = 'busy'
+        elif workload == 'blocked':
+            blocked.append('%s: %s' % (name, message))
+            if state == 'ready':
+                state = 'blocked'
+        elif workload not in ('active', 'unknown', None):
+            state = 'busy'
+    return state
+
+
+def configured_sources(paths=None):
+    """Return the normalized lines of the apt sources lists."""
+    if paths is None:
+        paths = ['/etc/apt/sources.list'] + sorted(
+            glob.glob('/etc/apt/sources.list.d/*.list'))
+    lines = set()
+    for path in paths:
+        try:
+            with open(path) as fp:
+                for line in fp:
+                    line = line.split('#', 1)[0].strip()
+                    if line:
+                        lines.add(' '.join(line.split()))
+        except IOError:
+            continue
+    return lines
+
+
+def source_configured(source, configured):
+    """Return whether an apt-add-repository source is among the
+    configured source lines."""
+    if source.startswith('ppa:'):
+        ppa = source[len('ppa:'):]
+        if '/' not in ppa:
+            ppa += '/ppa'
+        return any('.launchpad' in line and '/%s/' % ppa in line + '/'
+                   for line in configured)
+    return ' '.join(source.split()) in configured
+
+
+def missing_packages(packages):
+    """Return the packages which dpkg doesn't know as installed.
+
+    Packages pinned to a version are always returned.
+    """
+    names = [p for p in packages if '=' not in p]
+    if not names:
+        return list(packages)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            # Exits non-zero when some package is unknown, still listing
+            # the others
+            proc = subprocess.Popen(
+                ['dpkg-query', '-W', '-f', '${Package} ${Status}\n'] +
+                names, stdout=subprocess.PIPE, stderr=devnull)
+            output = proc.communicate()[0]
+    except OSError:
+        return list(packages)
+    installed = set()
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split()
+        if fields[-3:] == ['install', 'ok', 'installed']:
+            installed.add(fields[0])
+    return [p for p in packages
+            if '=' in p or p.split(':', 1)[0] not in installed]
+
+
+def _track_applications(applications, deltas, names=None):
+    """Update the set of application names from all-watcher deltas,
+    ignoring those not in names.
+    """
+    for entity_type, change, data in deltas:
+        # Services in Juju 1, applications since
+        if entity_type not in ('service', 'application'):
+            continue
+        name = data.get('Name') or data.get('name')
+        if names is not None and name not in names:
+            continue
+        if change == 'remove':
+            applications.discard(name)
+        else:
+            applications.add(name)
+
+
+def _close_watch(watch):
+    try:
+        watch.stop()
+    except Exception:
+        pass
+
+
+def _abort_watch(watch):
+    """Close the connection of a watch blocked in another thread."""
+    try:
+        watch.conn.close()
+    except Exception:
+        pass
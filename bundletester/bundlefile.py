@@ -0,0 +1,170 @@
+"""Tell bundle files from other yaml files without loading them.
+
+Only the top-level keys of a file, and the keys of the mappings right
+below them, are streamed from the yaml parser (libyaml's when available);
+no values are constructed and the parse stops as soon as the shape of the
+file is known. Shapes are remembered per file until it changes, so the
+bundle file found by discovery isn't classified again by
+utils.fetch_deployment.
+"""
+import os
+import threading
+
+import yaml
+from deployer.config import ConfigStack
+
+from bundletester import yamlfiles
+
+# The option keys of a charm's config.yaml, which isn't a bundle
+CHARM_OPTION = ['default', 'description', 'type']
+
+_lock = threading.Lock()
+_shapes = {}
+
+
+class _Undecided(Exception):
+    """The file uses aliases or merge keys where the shape is decided."""
+
+
+def classify(data):
+    """Return 4 or 3 if loaded yaml data is a bundle of that version,
+    else None."""
+    if not isinstance(data, dict):
+        return None
+    services = data.get('services')
+    if isinstance(services, dict) and 'services' not in services:
+        return 4
+    for possible in data.values():
+        if isinstance(possible, dict) and \
+                isinstance(possible.get('services'), dict):
+            if sorted(possible['services']) != CHARM_OPTION:
+                return 3
+    return None
+
+
+def _skip(events, event):
+    """Consume the rest of the node started by event."""
+    depth = 0
+    while True:
+        if isinstance(event, (yaml.MappingStartEvent,
+                              yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent,
+                                yaml.SequenceEndEvent)):
+            depth -= 1
+        if depth <= 0:
+            return
+        event = next(events)
+
+
+def _items(events):
+    """Yield the key and the first event of the value of each item of the
+    mapping being parsed. The caller consumes the rest of the value."""
+    while True:
+        event = next(events)
+        if isinstance(event, yaml.MappingEndEvent):
+            return
+        key = None
+        if isinstance(event, yaml.ScalarEvent):
+            key = event.value
+        else:
+            _skip(events, event)
+        if key == '<<':
+            raise _Undecided()
+        yield key, next(events)
+
+
+def _mapping_keys(events, event):
+    """Return the keys of the mapping started by event, or None if the
+    node isn't a mapping."""
+    if isinstance(event, yaml.AliasEvent):
+        raise _Undecided()
+    if not isinstance(event, yaml.MappingStartEvent):
+        _skip(events, event)
+        return None
+    keys = set()
+    for key, value in _items(events):
+        keys.add(key)
+        _skip(events, value)
+    return keys
+
+
+def sniff(stream):
+    """Return 4 or 3 if the yaml stream is a bundle of that version, else
+    None, parsing as little of it as possible."""
+    events = yaml.parse(stream, Loader=yamlfiles.Loader)
+    try:
+        for event in events:
+            if isinstance(event, (yaml.StreamStartEvent,
+                                  yaml.DocumentStartEvent)):
+                continue
+            if isinstance(event, yaml.AliasEvent):
+                raise _Undecided()
+            if not isinstance(event, yaml.MappingStartEvent):
+                return None
+            break
+        else:
+            return None
+        shape = None
+        for key, value in _items(events):
+            if shape and key != 'services':
+                # Only top-level services can still make it a v4 bundle
+                _skip(events, value)
+                continue
+            if isinstance(value, yaml.AliasEvent):
+                raise _Undecided()
+            if not isinstance(value, yaml.MappingStartEvent):
+                _skip(events, value)
+                continue
+            keys = set()
+            for inner, inner_value in _items(events):
+                keys.add(inner)
+                if inner == 'services' and not shape:
+                    inner_keys = _mapping_keys(events, inner_value)
+                    if inner_keys is not None and \
+                            sorted(inner_keys) != CHARM_OPTION:
+                        shape = 3
+                else:
+                    _skip(events, inner_value)
+            if key == 'services' and 'services' not in keys:
+                return 4
+        return shape
+    finally:
+        events.close()
+
+
+def shape(path):
+    """Return 4 or 3 if the file at path is a bundle of that version, else
+    None."""
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_mtime, st.st_size)
+    with _lock:
+        if key in _shapes:
+            return _shapes[key]
+    with open(path) as fp:
+        try:
+            found = sniff(fp)
+        except _Undecided:
+            found = classify(yamlfiles.load(path))
+    with _lock:
+        _shapes[key] = found
+    return found
+
+
+def is_bundle(path):
+    return shape(path) is not None
+
+
+class BundleStack(ConfigStack):
+    """A deployer ConfigStack which loads local files with the fastest
+    loader, reusing their known shape."""
+
+    def _yaml_load(self, config_file):
+        if config_file not in self.yaml and os.path.isfile(config_file):
+            # Deployer modifies what it loads
+            data = yamlfiles.thaw(yamlfiles.load(config_file))
+            if shape(config_file) == 4:
+                self.version = 4
+                data = {config_file: data}
+            self.yaml[config_file] = data
+        return super(BundleStack, self)._yaml_load(config_file)
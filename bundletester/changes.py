@@ -0,0 +1,78 @@
+"""Only test the charms of a bundle which changed since an earlier run.
+
+Each charm is fingerprinted by the content of its fetched tree. A run
+records the fingerprints of the charms whose tests all passed, in its JSON
+report and in the history. A later run given that report, or a reference
+to the recorded run, skips the charm suites whose fingerprint is the same.
+"""
+import hashlib
+import json
+import logging
+import os
+import stat
+
+log = logging.getLogger('changes')
+
+# Directories which don't affect what a charm does
+IGNORED = set(['.git', '.bzr', '.hg', '.tox', '.venv', '__pycache__'])
+# Refers to the last recorded run, rather than a bundle revision
+LAST = 'last'
+
+
+def fingerprint(directory):
+    """Return a digest of the names, modes and content of the files in
+    directory."""
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d not in IGNORED)
+        for name in sorted(files):
+            if name.endswith('.pyc'):
+                continue
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, directory)
+            st = os.lstat(path)
+            digest.update('{}\0{}\0'.format(
+                rel, st.st_mode & (stat.S_IFMT(st.st_mode) | 0o111)))
+            if stat.S_ISLNK(st.st_mode):
+                digest.update(os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as fp:
+                    for chunk in iter(lambda: fp.read(1 << 16), b''):
+                        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_baseline(value, history=None):
+    """Return the charm fingerprints of the run value refers to: the path
+    of its JSON report, or LAST or the revision of the bundle it tested,
+    looked up in the history."""
+    if os.path.isfile(value):
+        with open(value) as fp:
+            charms = json.load(fp).get('charms')
+        if charms is None:
+            log.warning('%s has no charm fingerprints, testing every charm',
+                        value)
+        return charms or {}
+    if history is None:
+        log.warning('No history to find run %s in, testing every charm',
+                    value)
+        return {}
+    charms = history.charm_fingerprints(None if value == LAST else value)
+    if not charms:
+        log.warning('No recorded run for %s, testing every charm', value)
+    return charms
+
+
+def passed(suite, plan):
+    """Return the fingerprints of the charms of suite which were unchanged,
+    or whose tests all ran and passed."""
+    sizes = dict((s.name, plan.count(s)) for s in plan.suites[1:])
+    clean = {}
+    for name, digest in suite.charm_fingerprints.items():
+        if name not in suite.unchanged:
+            results = plan.results(name)
+            if sum(results.values()) != sizes.get(name, 0) or \
+                    any(code != 0 for code in results):
+                continue
+        clean[name] = digest
+    return clean
@@ -1,4 +1,4 @@
-import yaml
+from bundletester import yamlfiles
 
 
 class Parser(dict):
@@ -9,12 +9,17 @@ class Parser(dict):
             'bootstrap': True,
             'reset': True,
             'reset_timeout': 60 * 3,
+            'parallel': False,
+            'timeout': None,
+            'idle_timeout': None,
             'bundle': None,
             'bundle_deploy': True,
             'deployment_timeout': None,
+            'deployment_wait': 'native',
             'virtualenv': False,
             'virtualenv_python': 'python',
             'tests': "*",
+            'pinned': [],
             'excludes': [],
             'sources': [],
             'packages': [],
@@ -34,7 +39,7 @@ class Parser(dict):
             self.merge(kwargs)
 
         if path:
-            data = yaml.safe_load(open(path, 'r').read())
+            data = yamlfiles.thaw(yamlfiles.load(path))
             self.merge(data)
 
             # Replace the default makefile targets
@@ -58,4 +63,11 @@ class Parser(dict):
 
     def merge(self, other):
         for k, v in other.items():
+            if type(v) is list and k not in self:
+                # Copy, so extending our lists leaves other's alone
+                v = list(v)
             self[k] = v
+
+
+# What a config without parent starts from
+DEFAULTS = yamlfiles.freeze(Parser())
@@ -0,0 +1,146 @@
+"""Cache of the tests found in each suite, across runs.
+
+A suite's own tests (not those of its nested charm suites) are stored
+under a fingerprint of everything their discovery depends on: the names
+and modes of the files in its tests directory, the contents of its yaml
+files and Makefile, the bundle file, the parent config and the options
+which affect discovery. A change to any of them only invalidates the
+suites it belongs to.
+"""
+import hashlib
+import json
+import logging
+import os
+import stat
+
+from bundletester import makefile, spec, utils
+
+log = logging.getLogger('discovery')
+
+# Stored suites kept, least recently used are removed beyond that
+MAX_ENTRIES = 1000
+# Stands for the suite directory in stored paths, which changes per run
+DIRECTORY = '{directory}'
+OPTIONS = ['tests', 'test_pattern', 'skip_implicit', 'exclude',
+           'juju_major_version', 'no_matrix', 'environment', 'deployment']
+
+
+def _hash_file(digest, path):
+    with open(path, 'rb') as fp:
+        digest.update(hashlib.sha1(fp.read()).hexdigest().encode('ascii'))
+
+
+def fingerprint(suite):
+    """Return the fingerprint of the inputs of the discovery of suite's
+    own tests."""
+    digest = hashlib.sha1()
+
+    def add(*values):
+        digest.update(json.dumps(values, sort_keys=True,
+                                 default=str).encode('utf-8'))
+        digest.update(b'\0')
+
+    add(type(suite.model).__name__, suite.name, os.environ.get('PATH'))
+    add(*[getattr(suite.options, name, None) for name in OPTIONS])
+    # The bundle path changes with every run, its content is added below
+    add(dict((k, v) for k, v in (suite._parent_config or {}).items()
+             if k != 'bundle'))
+    for name, path in (('tests_yaml', getattr(suite.options, 'tests_yaml',
+                                              None)),
+                       ('bundle', suite.config.bundle),
+                       ('makefile', makefile.find_makefile(suite.directory))):
+        exists = bool(path) and os.path.isfile(path)
+        add(name, path and os.path.basename(path), exists)
+        if exists:
+            _hash_file(digest, path)
+    if suite.testdir and os.path.isdir(suite.testdir):
+        for name in sorted(os.listdir(suite.testdir)):
+            path = os.path.join(suite.testdir, name)
+            try:
+                mode = os.stat(path).st_mode
+            except OSError:
+                continue
+            add(name, stat.S_IFMT(mode), mode & 0o555)
+            if name.endswith('.yaml') and stat.S_ISREG(mode):
+                _hash_file(digest, path)
+    return digest.hexdigest()
+
+
+def _tokenize(value, directory):
+    if isinstance(value, list):
+        return [_tokenize(v, directory) for v in value]
+    if isinstance(value, basestring) and directory and \
+            value.startswith(directory):
+        return DIRECTORY + value[len(directory):]
+    return value
+
+
+def _expand(value, directory):
+    if isinstance(value, list):
+        return [_expand(v, directory) for v in value]
+    if isinstance(value, basestring) and value.startswith(DIRECTORY):
+        return directory + value[len(DIRECTORY):]
+    return value
+
+
+class DiscoveryCache(object):
+    def __init__(self, path=None):
+        self.path = path or utils.cache_dir('discovery')
+
+    def _entry(self, suite):
+        return os.path.join(self.path, fingerprint(suite) + '.json')
+
+    def restore(self, suite):
+        """Append the stored tests of suite to it. Returns False if none
+        are stored."""
+        entry = self._entry(suite)
+        try:
+            with open(entry) as fp:
+                specs = json.load(fp)
+        except (IOError, ValueError):
+            return False
+        restored = []
+        for data in specs:
+            record = spec.SpecRecord(None, None, suite=suite,
+                                     parent=suite.config)
+            for k, v in data.items():
+                # Stored values are resolved, so replace rather than add
+                record[k] = _expand(v, suite.directory)
+            if not os.path.exists(record.executable[0]):
+                log.debug('%s is gone, rediscovering %s',
+                          record.executable[0], suite.name)
+                return False
+            restored.append(record)
+        suite.extend(restored)
+        os.utime(entry, None)
+        log.debug('Restored %s tests of %s', len(restored), suite.name)
+        return True
+
+    def store(self, suite):
+        """Store the tests (but not the nested suites) of suite.
+
+        Only what differs from the suite config is stored for each test.
+        """
+        specs = []
+        for element in suite:
+            if not isinstance(element, spec.Suite):
+                specs.append(dict(
+                    (k, _tokenize(v, suite.directory))
+                    for k, v in element.items()
+                    if k != 'suite' and suite.config.get(k) != v))
+        entry = self._entry(suite)
+        tmp = '%s.%s' % (entry, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump(specs, fp, separators=(',', ':'), default=str)
+        os.rename(tmp, entry)
+        self.prune()
+
+    def prune(self):
+        entries = [os.path.join(self.path, name)
+                   for name in os.listdir(self.path)
+                   if name.endswith('.json')]
+        if len(entries) <= MAX_ENTRIES:
+            return
+        entries.sort(key=lambda path: os.stat(path).st_mtime)
+        for path in entries[:len(entries) - MAX_ENTRIES]:
+            os.remove(path)
@@ -8,7 +8,8 @@ import sys
 import tempfile
 
 import requests
-import yaml
+
+from bundletester import yamlfiles
 
 log = logging.getLogger(__name__)
 
@@ -42,7 +43,7 @@ def rename(dir_):
     metadata = os.path.join(dir_, "metadata.yaml")
     if not os.path.exists(metadata):
         return dir_
-    metadata = yaml.safe_load(open(metadata))
+    metadata = yamlfiles.load(metadata)
     name = metadata.get("name")
     if not name:
         return dir_
@@ -0,0 +1,113 @@
+"""Persistent record of how long each test took in past runs, and of the
+charms they tested."""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from bundletester import utils
+
+log = logging.getLogger('history')
+
+# Runs of a test averaged to estimate its duration, older ones are pruned
+RECENT_RUNS = 5
+# Seconds after which records are pruned, for tests and bundles not run
+# since
+MAX_AGE = 90 * 24 * 3600
+
+
+class History(object):
+    """Durations of the setup, test and teardown phases of tests, stored in
+    an SQLite database and keyed by test id (see spec.test_id).
+
+    Test ids are only unique within a bundle or charm, so records are kept
+    apart by scope, which identifies what is being tested.
+    """
+    def __init__(self, path=None, scope=''):
+        self.path = path or os.path.join(utils.cache_dir(), 'history.db')
+        self.scope = scope
+        # Parallel tests record from several threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            # Unscoped tables of earlier versions
+            self._db.execute('DROP TABLE IF EXISTS durations')
+            self._db.execute('DROP TABLE IF EXISTS charms')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS test_durations ('
+                'scope TEXT, test TEXT, setup REAL, main REAL, '
+                'teardown REAL, recorded REAL)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS test_durations_test '
+                'ON test_durations (scope, test, recorded)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS charm_fingerprints ('
+                'scope TEXT, revision TEXT, charm TEXT, fingerprint TEXT, '
+                'recorded REAL)')
+            self._prune()
+
+    def _prune(self):
+        expired = time.time() - MAX_AGE
+        for table in ('test_durations', 'charm_fingerprints'):
+            self._db.execute(
+                'DELETE FROM {} WHERE recorded < ?'.format(table),
+                (expired,))
+
+    def record(self, test, setup=0, main=0, teardown=0):
+        log.debug('Recording durations of %s: %s, %s, %s',
+                  test, setup, main, teardown)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO test_durations VALUES (?, ?, ?, ?, ?, ?)',
+                (self.scope, test, setup or 0, main or 0, teardown or 0,
+                 time.time()))
+            # Only the recent runs are averaged
+            self._db.execute(
+                'DELETE FROM test_durations WHERE scope = ? AND test = ? '
+                'AND rowid NOT IN (SELECT rowid FROM test_durations '
+                'WHERE scope = ? AND test = ? '
+                'ORDER BY recorded DESC, rowid DESC LIMIT ?)',
+                (self.scope, test, self.scope, test, RECENT_RUNS))
+
+    def durations(self):
+        """Return the mean total duration of the recent runs of each test.
+        """
+        with self._lock:
+            return dict(self._db.execute(
+                'SELECT test, AVG(setup + main + teardown) '
+                'FROM test_durations WHERE scope = ? GROUP BY test',
+                (self.scope,)).fetchall())
+
+    def record_charms(self, revision, fingerprints):
+        """Record the fingerprints of the charms (see changes) which
+        passed a run of revision of the bundle."""
+        recorded = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT INTO charm_fingerprints VALUES (?, ?, ?, ?, ?)',
+                [(self.scope, revision, charm, digest, recorded)
+                 for charm, digest in sorted(fingerprints.items())])
+
+    def charm_fingerprints(self, revision=None):
+        """Return the charm fingerprints recorded by the last run, or by
+        the last run of revision of the bundle."""
+        with self._lock:
+            if revision is None:
+                row = self._db.execute(
+                    'SELECT MAX(recorded) FROM charm_fingerprints '
+                    'WHERE scope = ?', (self.scope,)).fetchone()
+            else:
+                row = self._db.execute(
+                    'SELECT MAX(recorded) FROM charm_fingerprints '
+                    'WHERE scope = ? AND revision = ?',
+                    (self.scope, revision)).fetchone()
+            if not row or row[0] is None:
+                return {}
+            return dict(self._db.execute(
+                'SELECT charm, fingerprint FROM charm_fingerprints '
+                'WHERE scope = ? AND recorded = ?',
+                (self.scope, row[0])).fetchall())
+
+    def close(self):
+        self._db.close()
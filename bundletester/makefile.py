@@ -0,0 +1,121 @@
+"""Find the targets of Makefiles without running their recipes.
+
+Plain Makefiles are parsed directly. Those with include directives or
+computed target names are read from the database of `make -pRrq`, which
+runs nothing but the parse. Either way, each Makefile is only indexed
+once per process until it changes.
+"""
+import logging
+import os
+import re
+import subprocess
+import threading
+
+log = logging.getLogger('makefile')
+
+# The names GNU make looks for, in order
+NAMES = ['GNUmakefile', 'makefile', 'Makefile']
+
+# "targets: prerequisites" or "targets:: ...", but not "VAR := value"
+RULE = re.compile(r'^(?P<targets>[^\t#=:][^#=:]*?)\s*::?(?!=)')
+INCLUDE = re.compile(r'^\s*-?s?include\s', re.M)
+DEFINE = re.compile(r'^\s*define\s')
+ENDEF = re.compile(r'^\s*endef\b')
+
+_lock = threading.Lock()
+_index = {}
+
+
+def find_makefile(directory):
+    for name in NAMES:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _lines(text):
+    """Yield the logical lines of a Makefile, continuations joined."""
+    pending = ''
+    for line in text.splitlines():
+        if line.endswith('\\'):
+            pending += line[:-1] + ' '
+            continue
+        yield pending + line
+        pending = ''
+    if pending:
+        yield pending
+
+
+def parse(text):
+    """Return the targets of the rules in Makefile text, and whether some
+    of them are computed (contain variable references)."""
+    targets, computed = set(), False
+    in_define = False
+    for line in _lines(text):
+        if in_define:
+            in_define = not ENDEF.match(line)
+            continue
+        if DEFINE.match(line):
+            in_define = True
+            continue
+        match = RULE.match(line)
+        if not match:
+            continue
+        for target in match.group('targets').split():
+            if '$' in target:
+                computed = True
+            elif not target.startswith('.') and '%' not in target:
+                targets.add(target)
+    return targets, computed
+
+
+def parse_database(output):
+    """Return the targets in the output of `make -pRrq`."""
+    targets = set()
+    not_target = False
+    for line in output.splitlines():
+        if line.startswith('# Not a target'):
+            not_target = True
+            continue
+        match = RULE.match(line)
+        if match and not line.startswith('#'):
+            if not not_target:
+                targets.update(
+                    t for t in match.group('targets').split()
+                    if not t.startswith('.') and '%' not in t)
+        not_target = False
+    return targets
+
+
+def _database(directory):
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(['make', '-pRrq'], cwd=directory,
+                                stdout=subprocess.PIPE, stderr=devnull)
+        output = proc.communicate()[0]
+    return parse_database(output.decode('utf-8', 'replace'))
+
+
+def targets(directory):
+    """Return the set of targets of the Makefile in directory."""
+    path = find_makefile(directory)
+    if not path:
+        return frozenset()
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_mtime, st.st_size)
+    with _lock:
+        if key in _index:
+            return _index[key]
+    with open(path) as fp:
+        text = fp.read()
+    found, computed = parse(text)
+    if computed or INCLUDE.search(text):
+        log.debug('Reading the make database of %s', directory)
+        try:
+            found = _database(directory)
+        except OSError as e:
+            log.debug('Unable to run make: %s', e)
+    found = frozenset(found)
+    with _lock:
+        _index[key] = found
+    return found
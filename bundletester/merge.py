@@ -0,0 +1,24 @@
+import argparse
+import json
+import sys
+
+from bundletester import shard
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merge the JSON reports of a sharded bundletester run.')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    parser.add_argument('reports', nargs='+', type=argparse.FileType('r'))
+    options = parser.parse_args()
+
+    report = shard.merge([json.load(fp) for fp in options.reports])
+    json.dump(report, options.output, indent=2)
+    options.output.write('\n')
+    failed = [t for t in report['tests'] if t.get('returncode') != 0]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
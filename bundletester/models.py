@@ -1,9 +1,12 @@
 import atexit
+import logging
 import os
 import shutil
 import tempfile
 
-from bundletester import utils
+from bundletester import staging, utils
+
+log = logging.getLogger('models')
 
 
 def is_int(s):
@@ -20,11 +23,12 @@ class FSEntity(dict):
 
 class Charm(FSEntity):
     @classmethod
-    def from_deployer_charm(cls, dcharm):
-        """Copy charm source from the deployer cache to a new temp location
+    def from_deployer_charm(cls, dcharm, staging_mode='auto'):
+        """Stage charm source from the deployer cache at a new temp location
         so we can change the charm dir name to match the charm name
         (some tests rely on these matching).
 
+        See bundletester.staging for the staging modes.
         """
         tmp_dir = tempfile.mkdtemp()
         charm_name = dcharm.name.split('/')[-1]
@@ -35,13 +39,17 @@ class Charm(FSEntity):
             charm_name = '-'.join(name_parts[:-1])
 
         charm_dir = os.path.join(tmp_dir, charm_name)
-        shutil.copytree(dcharm.path, charm_dir, symlinks=True)
+        stats = staging.stage(dcharm.path, charm_dir, staging_mode)
         atexit.register(shutil.rmtree, tmp_dir, ignore_errors=True)
+        log.info('Staged %s (%s, %.1f MiB, %.1f MiB written) in %.2fs',
+                 dcharm.name, stats['mode'], stats['size'] / 1048576.0,
+                 stats['written'] / 1048576.0, stats['seconds'])
 
         c = cls()
         c['name'] = dcharm.name
         c['directory'] = charm_dir
         c['testdir'] = utils.find_testdir(charm_dir)
+        c['staging'] = stats
 
         return c
 
@@ -0,0 +1,116 @@
+"""Cached answers about the tools bundletester runs.
+
+Executable lookups are remembered for the life of the process. The output
+of probe commands, like `juju version`, is also kept in the cache
+directory, keyed by the path of the binary and stamped with its mtime and
+size, so later runs don't spawn them again until the tool is upgraded.
+Snaps are all links to the snap binary, so they are stamped with their
+installed revision instead, and the output of other binaries that link to
+a differently named wrapper is not kept.
+"""
+import errno
+import json
+import logging
+import os
+import subprocess
+import threading
+from distutils.spawn import find_executable
+
+from bundletester import utils
+
+log = logging.getLogger('probe')
+
+# Where snaps are installed, as /snap/<name>/current -> revision
+SNAP_DIR = '/snap'
+
+_lock = threading.Lock()
+_which = {}
+_outputs = {}
+
+
+def which(name):
+    """Return the path of executable name on the PATH, or None."""
+    key = (name, os.environ.get('PATH'))
+    with _lock:
+        if key not in _which:
+            _which[key] = find_executable(name)
+        return _which[key]
+
+
+def _cache_path():
+    return os.path.join(utils.cache_dir(), 'probes.json')
+
+
+def _load():
+    try:
+        with open(_cache_path()) as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save(cache):
+    path = _cache_path()
+    tmp = '%s.%s' % (path, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump(cache, fp, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def _stamp(binary):
+    """Return what changes when the tool at binary is upgraded, or None
+    if that can't be told."""
+    real = os.path.realpath(binary)
+    name = os.path.basename(binary)
+    if os.path.basename(real) != name:
+        # A multiplexing wrapper, like snap, runs the tool it's called as
+        revision = os.path.join(SNAP_DIR, name, 'current')
+        if os.path.basename(real) == 'snap' and os.path.exists(revision):
+            return ['snap', os.path.realpath(revision)]
+        return None
+    st = os.stat(real)
+    return [st.st_mtime, st.st_size]
+
+
+def check_output(cmd):
+    """Return the output of cmd like subprocess.check_output, from the
+    cache when the binary hasn't changed since it last ran.
+
+    Only use for commands whose output depends on nothing but the binary.
+    """
+    binary = which(cmd[0])
+    if not binary:
+        raise OSError(errno.ENOENT, 'No such file or directory: %s' % cmd[0])
+    name = ' '.join([binary] + list(cmd[1:]))
+    stamp = _stamp(binary)
+    with _lock:
+        if name in _outputs:
+            return _outputs[name]
+        cache = _load() if stamp is not None else {}
+        entry = cache.get(name)
+        if entry and entry['stamp'] == stamp:
+            log.debug('Cached output of %s', name)
+            output = entry['output']
+        else:
+            output = subprocess.check_output([binary] + list(cmd[1:]))
+            if isinstance(output, bytes):
+                output = output.decode('utf-8', 'replace')
+            if stamp is not None:
+                cache[name] = {'stamp': stamp, 'output': output}
+                try:
+                    _save(cache)
+                except (IOError, OSError) as e:
+                    log.debug('Unable to save probe cache: %s', e)
+        _outputs[name] = output
+        return output
+
+
+def juju_version():
+    return check_output(['juju', 'version']).strip()
+
+
+def reset():
+    """Forget what this process has probed."""
+    with _lock:
+        _which.clear()
+        _outputs.clear()
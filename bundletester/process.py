@@ -0,0 +1,246 @@
+"""Run child processes, multiplexing their output on one select loop."""
+import errno
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+import time
+
+log = logging.getLogger('process')
+
+# Exit status recorded for a process killed by a timeout, as timeout(1) does
+TIMEOUT = 124
+# Seconds a timed out process group gets to exit before SIGKILL
+KILL_GRACE = 5
+# How often a process in its grace period is checked for exit
+GRACE_POLL = 0.1
+CHUNK_SIZE = 64 * 1024
+
+
+class Process(object):
+    """A child process run in its own process group.
+
+    Output (stdout and stderr) is written to ``output``, any object with a
+    ``write`` method, as it arrives. If the process runs longer than
+    ``timeout`` seconds, or is silent for ``idle_timeout`` seconds, its
+    whole process group is terminated and ``returncode`` is TIMEOUT. The
+    limits still apply once the process has closed its output.
+    """
+    def __init__(self, cmd, output, cwd=None, env=None, timeout=None,
+                 idle_timeout=None):
+        self.cmd = cmd
+        self.output = output
+        self.cwd = cwd
+        self.env = env
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.popen = None
+        self.exceeded = None
+        self.returncode = None
+        # Set once the output is closed, the process may still be running
+        self.eof = False
+        self.started = self.last_output = None
+        self._partial = ''
+        self._kill_at = None
+
+    def start(self):
+        self.popen = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=self.cwd,
+            env=self.env,
+            # Own process group, so the whole tree can be killed
+            preexec_fn=os.setpgrp,
+        )
+        self.started = self.last_output = time.time()
+        return self
+
+    @property
+    def pid(self):
+        return self.popen.pid
+
+    def fileno(self):
+        return self.popen.stdout.fileno()
+
+    def kill(self, sig=signal.SIGTERM):
+        """Signal the process group."""
+        log.debug('Sending signal %s to process group %s', sig, self.pid)
+        try:
+            os.killpg(self.pid, sig)
+        except OSError:
+            # Already gone
+            pass
+
+    def deadline(self):
+        """Return the time at which the limits next need checking."""
+        if self._kill_at:
+            return min(self._kill_at, time.time() + GRACE_POLL)
+        deadlines = []
+        if self.eof:
+            # Nothing to select on, check for its exit
+            deadlines.append(time.time() + GRACE_POLL)
+        if self.timeout:
+            deadlines.append(self.started + self.timeout)
+        if self.idle_timeout:
+            deadlines.append(self.last_output + self.idle_timeout)
+        return min(deadlines) if deadlines else None
+
+    def check(self, now):
+        """Enforce the limits. Returns True once the process should be
+        reaped."""
+        if self.eof and self.popen.poll() is not None:
+            return True
+        if self._kill_at:
+            return now >= self._kill_at or self.popen.poll() is not None
+        if self.timeout and now - self.started >= self.timeout:
+            self._expire('timeout of %ss exceeded' % self.timeout, now)
+        elif (self.idle_timeout and
+                now - self.last_output >= self.idle_timeout):
+            self._expire('no output for %ss' % self.idle_timeout, now)
+        return False
+
+    def _expire(self, reason, now):
+        log.error('Killing %s: %s', self.cmd, reason)
+        self.exceeded = reason
+        self.output.write('\nbundletester: %s\n' % reason)
+        self.kill()
+        self._kill_at = now + KILL_GRACE
+
+    def read(self):
+        """Read a chunk of output. Returns False at end of output."""
+        chunk = os.read(self.fileno(), CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.last_output = time.time()
+        self.output.write(chunk)
+        # Print all output as it comes in to debug
+        lines = (self._partial + chunk).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            log.debug(line.rstrip())
+        return True
+
+    def finish(self):
+        """Reap the process."""
+        if self._partial:
+            log.debug(self._partial.rstrip())
+            self._partial = ''
+        self.popen.stdout.close()
+        if self.exceeded:
+            # Also takes out anything left behind in the group
+            self.kill(signal.SIGKILL)
+        self.popen.wait()
+        self.returncode = TIMEOUT if self.exceeded else self.popen.returncode
+        log.debug("Exit Code: %s" % self.returncode)
+
+
+class Engine(object):
+    """Multiplex the output of any number of processes on a single select
+    loop.
+
+    Iterating an engine yields each process as it completes, until none
+    are left running. Processes may be started while iterating.
+
+    Threads sharing an engine each start their process and wait() for it:
+    one of them drives the loop for every running process at a time, and
+    hands it over to another waiting thread when its own process is done.
+    """
+    def __init__(self):
+        self.running = []
+        self._cond = threading.Condition()
+        self._driving = False
+        # Written to when a process starts, to wake up the select loop
+        self._wakeup = os.pipe()
+
+    def __del__(self):
+        for fd in getattr(self, '_wakeup', ()):
+            os.close(fd)
+
+    def start(self, process):
+        process.start()
+        with self._cond:
+            self.running.append(process)
+        os.write(self._wakeup[1], b'x')
+        return process
+
+    def __iter__(self):
+        try:
+            while self.running:
+                for process in self._poll():
+                    yield process
+        finally:
+            # Abandoned early, don't leave anything behind
+            for process in self.running:
+                process.kill(signal.SIGKILL)
+                process.finish()
+            self.running = []
+
+    def wait(self, process):
+        """Wait for a started process to complete, driving the loop while
+        no other thread does."""
+        with self._cond:
+            while process in self.running and self._driving:
+                # Time out so KeyboardInterrupt still gets through
+                self._cond.wait(1)
+            if process not in self.running:
+                return process
+            self._driving = True
+        try:
+            while process in self.running:
+                self._poll()
+        except BaseException:
+            # Interrupted, don't leave our process behind
+            process.kill(signal.SIGKILL)
+            with self._cond:
+                if process in self.running:
+                    self.running.remove(process)
+                    process.finish()
+            raise
+        finally:
+            with self._cond:
+                self._driving = False
+                self._cond.notify_all()
+        return process
+
+    def _poll(self):
+        with self._cond:
+            running = list(self.running)
+        deadlines = [d for d in (p.deadline() for p in running) if d]
+        wait = max(min(deadlines) - time.time(), 0) if deadlines else None
+        try:
+            ready, _, _ = select.select(
+                [p for p in running if not p.eof] + [self._wakeup[0]],
+                [], [], wait)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if self._wakeup[0] in ready:
+            ready.remove(self._wakeup[0])
+            os.read(self._wakeup[0], CHUNK_SIZE)
+        for process in ready:
+            process.read()
+        now = time.time()
+        # Closing its output doesn't end a process, it is reaped once it
+        # exits or is killed by a limit
+        done = [p for p in running if p.check(now)]
+        for process in done:
+            process.finish()
+        with self._cond:
+            for process in done:
+                self.running.remove(process)
+            self._cond.notify_all()
+        return done
+
+
+def run(cmd, output, **kwargs):
+    """Run cmd to completion and return its Process."""
+    engine = Engine()
+    process = engine.start(Process(cmd, output, **kwargs))
+    for _ in engine:
+        pass
+    return process
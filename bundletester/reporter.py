@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 import sys
 import re
 from collections import defaultdict
@@ -8,6 +9,9 @@ from xml.etree.ElementTree import Element, SubElement, tostring
 
 from blessings import Terminal
 
+from bundletester.process import TIMEOUT
+from bundletester.testplan import TestPlan
+
 log = logging.getLogger('reporter')
 
 
@@ -20,6 +24,29 @@ def constants(value):
     return repeat(value).next
 
 
+def full_output(msg):
+    """Return the complete output of msg.
+
+    The runner only keeps the tail of long output in memory, the rest is
+    read back from the log file it was streamed to.
+    """
+    path = msg.get('output_file')
+    if path and os.path.exists(path):
+        with open(path) as fp:
+            return fp.read()
+    return msg.get('output', '')
+
+
+class _FullOutputs(list):
+    """Messages which load their full output only as they are iterated,
+    so a report never holds the output of every test at once."""
+    def __iter__(self):
+        for msg in list.__iter__(self):
+            if msg.get('output_file'):
+                msg = dict(msg, output=full_output(msg))
+            yield msg
+
+
 class Reporter(object):
     status_flags = defaultdict(constants("FAIL"), {
         0: 'PASS',
@@ -32,26 +59,29 @@ class Reporter(object):
         self.messages = []
         self.term = Terminal()
         self.suite = None
+        self.plan = TestPlan(None)
 
-    def set_suite(self, suite):
+    def set_suite(self, suite, plan=None):
         self.suite = suite
+        self.plan = plan or TestPlan(suite)
+
+    def status(self, msg):
+        """Return the status flag of a result. Only tests killed by a
+        timeout are TIMEOUT, whatever their exit code."""
+        if msg.get('timeout'):
+            return 'TIMEOUT'
+        return self.status_flags[msg['returncode']]
 
     def emit(self, msg):
         """Emit a single record to output fp"""
         self.messages.append(_O(msg))
+        self.plan.add_result(msg)
 
     def header(self):
         pass
 
     def _calculate(self):
-        total_seconds = 0
-        by_code = {}
-        for m in self.messages:
-            total_seconds += m.get('duration', 0)
-            ec = m['returncode']
-            ec_ct = by_code.get(ec,  0)
-            by_code[ec] = ec_ct + 1
-        return total_seconds, by_code
+        return self.plan.seconds, self.plan.results()
 
     def write(self, s, *args, **kwargs):
         kwargs['t'] = self.term
@@ -63,7 +93,7 @@ class Reporter(object):
                 if m['returncode'] == 0:
                     continue
                 self.fp.write('-' * 78 + '\n')
-                status = self.status_flags[m['returncode']]
+                status = self.status(m)
                 self.write('{t.bold}{t.red}{}: ', status)
                 if m.get('suite'):
                     self.write('{m.suite}{t.normal}::', m=m)
@@ -79,14 +109,20 @@ class Reporter(object):
             self.write('\n')
         self.report_errors(by_code)
 
+        timeouts = self.plan.timeouts
         for ec, ct in by_code.items():
-            status = self.status_flags[ec]
-            self.write("{t.bold}{}{t.normal}: {t.cyan}{}{t.normal} ",
-                       status, ct)
+            if ec == TIMEOUT and timeouts:
+                self.write("{t.bold}TIMEOUT{t.normal}: {t.cyan}{}{t.normal} ",
+                           timeouts)
+                ct -= timeouts
+            if ct:
+                status = self.status_flags[ec]
+                self.write("{t.bold}{}{t.normal}: {t.cyan}{}{t.normal} ",
+                           status, ct)
         ct = len(self.messages)
         if self.suite:
-            ct = len(self.suite)
-            skipped = len(self.suite) - len(self.messages)
+            ct = len(self.plan)
+            skipped = ct - len(self.messages)
             if skipped != 0:
                 self.write('SKIP:{t.cyan}{}{t.normal} ', skipped)
 
@@ -112,7 +148,7 @@ class DotReporter(Reporter):
         ec = msg.get('returncode', 0)
         if self.options and self.options.verbose:
             self.write("{m.test:<40} ", m=msg)
-        self.write(self.responses[ec])
+        self.write('T' if msg.get('timeout') else self.responses[ec])
         if self.options and self.options.verbose:
             self.write('\n')
         self.fp.flush()
@@ -145,7 +181,7 @@ class SpecReporter(Reporter):
         color = "green" if message.returncode == 0 else "red"
         fmt = "{:<%s} {t.%s}{}{t.normal}\n" % (width, color)
         cmd = message.test
-        self.write(fmt, cmd, self.status_flags[message.returncode])
+        self.write(fmt, cmd, self.status(message))
 
     def write(self, message, *args, **kwargs):
         if self.level:
@@ -161,12 +197,22 @@ class JSONReporter(Reporter):
     def summary(self):
         opts = self.options
         d = {
-            'tests': self.messages,
+            'tests': _FullOutputs(self.messages),
             'revision': str(opts.fetcher.get_revision(opts.testdir)).strip(),
             'testdir': opts.testdir,
         }
         if opts.bundle:
             d['bundle'] = self.suite.model['bundle']
+        if getattr(opts, 'deployment_ready', None):
+            d['deployment'] = {'ready': opts.deployment_ready}
+        if getattr(opts, 'charms', None) is not None:
+            d['charms'] = opts.charms
+        if getattr(opts, 'shard', None):
+            d['shard'] = {
+                'index': opts.shard[0],
+                'count': opts.shard[1],
+                'plan': opts.shard_plan,
+            }
 
         json.dump(d, self.fp, indent=2)
         self.write('\n')
@@ -192,17 +238,22 @@ class XMLReporter(Reporter):
                 {"name": msg.test, "classname": msg.suite, "time": "{}".format(
                     msg.get('duration', 0))})
             if msg.returncode != 0:
-                errorelement = SubElement(
-                    testcase,
-                    'error',
-                    {"message": self.get_error(msg)})
-                errorelement.text = msg.output
+                output = full_output(msg)
+                attrs = {"message": self.get_error(msg, output)}
+                if msg.get('timeout'):
+                    attrs['type'] = self.status(msg)
+                errorelement = SubElement(testcase, 'error', attrs)
+                errorelement.text = output
 
         self.fp.write(tostring(top, encoding="utf-8"))
         self.fp.flush()
 
-    def get_error(self, msg):
-        m = re.search('ERROR[A-Za-z\t .]+', msg.output)
+    def get_error(self, msg, output=None):
+        if msg.get('timeout'):
+            return "Timeout in {} phase".format(msg.timeout)
+        if output is None:
+            output = msg.output
+        m = re.search('ERROR[A-Za-z\t .]+', output)
         if m:
             found = m.group(0)
             return found
@@ -1,74 +1,103 @@
 import datetime
+import itertools
 import logging
 import os
+import Queue
+import re
 import subprocess
+import threading
 import traceback
 
 from bundletester import builder
-from bundletester.spec import Suite
+from bundletester.process import Engine, Process
+from bundletester.spec import spec_id
+from bundletester.testplan import TestPlan, relative_to
+from bundletester.utils import OutputCapture, juju_model_var
 
 log = logging.getLogger('runner')
 
 
-def relative_to(filenames, basefile):
-    """Normalize files relative to basefile turning partial names into files in
-    the same dir as basefile
-    """
-    results = []
-    if isinstance(basefile, list):
-        basefile = basefile[0]
-    if basefile is None:
-        return results
-    dirname = os.path.dirname(basefile)
-    for f in filenames:
-        if isinstance(f, list):
-            f = f[0]
-        path = os.path.abspath(os.path.join(dirname, f))
-        if os.path.exists(path):
-            results.append(path)
-    return results
-
-
 class DeployError(Exception):
     pass
 
 
 class Runner(object):
-    def __init__(self, suite, options=None):
+    def __init__(self, suite, options=None, environment=None, plan=None):
         self.suite = suite
+        self._plan = plan
         self._builder = None
         self.options = options
+        # Model to run against, when not the one given by options
+        self.environment = environment
+        # Set when other runners share this process, so the cwd is left
+        # alone.
+        self._threaded = False
+        self._procs = set()
+        self._procs_lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._log_seq = itertools.count(1)
+        # One select loop for every test process this runner starts
+        self._engine = Engine()
+
+    @property
+    def plan(self):
+        if not self._plan:
+            self._plan = TestPlan(self.suite)
+        return self._plan
 
     @property
     def builder(self):
         if not self._builder:
-            self._builder = builder.Builder(self.suite.config, self.options)
+            self._builder = builder.Builder(
+                self.suite.config, self.options, self.environment)
         return self._builder
 
-    def _run(self, executable, cwd):
+    def _log_path(self, name):
+        """Return a new log file path for name in the log directory, or
+        None if output is not being logged to files."""
+        log_dir = getattr(self.options, 'log_dir', None)
+        if not log_dir or not name:
+            return None
+        name = re.sub(r'[^\w.-]+', '_', name)
+        return os.path.join(
+            log_dir, '{:03d}-{}.log'.format(next(self._log_seq), name))
+
+    def _run(self, executable, cwd, timeout=None, idle_timeout=None,
+             name=None, cancellable=True):
+        """Run executable and return (exit code, output, log file, timed
+        out).
+
+        If name is given and a log directory is configured, the complete
+        output is streamed to a log file and only its tail is returned as
+        output. Otherwise the log file is None. Unless cancellable, the
+        process is left to finish by cancel().
+        """
         log.debug("call %s (cwd: %s)" % (executable, cwd))
         if self.options.dryrun:
-            return 0, ""
-
-        p = subprocess.Popen(
-            executable,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            cwd=cwd,
-            env=dict(os.environ, PYTHONIOENCODING='utf8'),
-        )
-
-        # Print all output as it comes in to debug
-        output = []
-        lines = iter(p.stdout.readline, "")
-        for line in lines:
-            output.append(line)
-            log.debug(str(line.rstrip()))
-
-        p.communicate()
-        retcode = p.returncode
-        log.debug("Exit Code: %s" % retcode)
-        return retcode, ''.join(output)
+            return 0, "", None, False
+
+        env = dict(os.environ, PYTHONIOENCODING='utf8')
+        if self.environment:
+            env[juju_model_var(self.options.juju_major_version)] = \
+                self.environment
+        output = OutputCapture(self._log_path(name))
+        process = Process(executable, output, cwd=cwd, env=env,
+                          timeout=timeout, idle_timeout=idle_timeout)
+        try:
+            self._engine.start(process)
+            if cancellable:
+                with self._procs_lock:
+                    self._procs.add(process)
+                if self._cancelled.is_set():
+                    # cancel() may have run before process was registered
+                    process.kill()
+            self._engine.wait(process)
+        finally:
+            output.close()
+            with self._procs_lock:
+                self._procs.discard(process)
+        return (process.returncode, output.getvalue(), output.path,
+                bool(process.exceeded))
 
     def run(self, spec, phase=None):
         """Run a phase of spec.
@@ -80,48 +109,88 @@ class Runner(object):
             'returncode': 0
         }
 
+        planned = self.plan.get(spec)
         if phase == "setup":
-            candidates = relative_to(spec.setup, spec.suite.testdir)
+            candidates = planned.setup if planned else \
+                relative_to(spec.setup, spec.suite.testdir)
         elif phase == "teardown":
-            candidates = relative_to(reversed(spec.teardown),
-                                     spec.suite.testdir)
+            candidates = planned.teardown if planned else \
+                relative_to(reversed(spec.teardown), spec.suite.testdir)
         else:
             candidates = [spec.executable]
 
         if not candidates:
             return result
+        timeout, idle_timeout = self._timeouts(spec)
         start = datetime.datetime.utcnow()
+        suite = spec.get('suite')
+        name = '{}-{}'.format(spec.name, phase or 'test')
+        if suite and suite.name:
+            name = '{}-{}'.format(suite.name, name)
         for candidate in candidates:
-            ec, output = self._run(candidate, spec.dirname)
+            # Teardown still cleans up after a cancelled test
+            ec, output, output_file, timed_out = self._run(
+                candidate, spec.dirname, timeout, idle_timeout, name,
+                cancellable=phase != 'teardown')
             result['returncode'] = ec
             result['output'] = output
+            if output_file:
+                result['output_file'] = output_file
             result['executable'] = spec.executable
+            if timed_out:
+                result['timeout'] = phase or 'test'
             if ec != 0:
                 if isinstance(candidate, list):
                     candidate = " ".join(candidate)
                 result['exit'] = candidate
                 break
 
-        if not phase:
-            end = datetime.datetime.utcnow()
-            duration = end - start
-            result['duration'] = duration.total_seconds()
-            if result['duration'] < 0.1:
-                result['duration'] = 0.0
+        end = datetime.datetime.utcnow()
+        duration = (end - start).total_seconds()
+        if duration < 0.1:
+            duration = 0.0
+        if phase:
+            result['%s_duration' % phase] = duration
+        else:
+            result['duration'] = duration
         return result
 
     def build(self):
         # if we are already in a venv we will assume we
         # can use that
-        if self.suite.config.virtualenv and not os.environ.get("VIRTUAL_ENV"):
-            vpath = os.path.join(self.options.testdir, '.venv')
-            log.debug('Creating virtualenv at %s', vpath)
-            self.builder.build_virtualenv(vpath)
+        venv = (self.suite.config.virtualenv and
+                not os.environ.get("VIRTUAL_ENV"))
+        # System packages for the charm suites too, in one transaction
+        self.builder.install_system_packages(
+            [suite.config for suite in self.suite.walk()])
+        if venv:
+            # The python packages are installed as the virtualenv is built
+            vpath = self.builder.virtualenv(
+                os.path.join(self.options.testdir, '.venv'))
+            log.debug('Using virtualenv at %s', vpath)
             apath = os.path.join(vpath, 'bin/activate_this.py')
             execfile(apath, dict(__file__=apath))
+        else:
+            self.builder.install_python_packages()
 
-        self.builder.add_sources(self.suite.config.sources)
-        self.builder.install_packages()
+    def cancel(self):
+        """Terminate every test process currently in flight, except
+        teardowns."""
+        self._cancelled.set()
+        with self._procs_lock:
+            procs = list(self._procs)
+        for process in procs:
+            process.kill()
+
+    def _timeouts(self, spec):
+        """Return the (timeout, idle_timeout) limits for spec.
+
+        Values from the test's control file or tests.yaml take precedence
+        over the command line ones.
+        """
+        return (spec.timeout or getattr(self.options, 'timeout', None),
+                spec.idle_timeout or
+                getattr(self.options, 'idle_timeout', None))
 
     def _handle_result(self, result):
         stop = False
@@ -130,9 +199,33 @@ class Runner(object):
             stop = True
         return result, stop
 
-    @staticmethod
-    def wait_for_deployment(wait_cmd):
-        if wait_cmd:
+    def wait_for_deployment(self, wait_cmd):
+        """Wait for the deployment to settle, in process or with wait_cmd
+        (juju-wait) depending on the deployment_wait setting."""
+        mode = self.suite.config.deployment_wait
+        if not mode:
+            return
+        if (mode == 'native' and wait_cmd and self.builder.environment and
+                not self.options.dryrun):
+            log.info('Waiting for deployment to complete.')
+            try:
+                ready = self.builder.wait_for_deployment(
+                    self.suite.deployment_timeout())
+            except builder.DeploymentError as e:
+                exc = DeployError()
+                exc.result = {
+                    'test': 'deployment-wait',
+                    'suite': 'bundletester',
+                    'exit': 'deployment-wait',
+                    'returncode': 1,
+                    'output': str(e),
+                }
+                raise exc
+            log.info('Waiting completed, applications ready after: %s',
+                     ', '.join('{} {}s'.format(name, secs)
+                               for name, secs in sorted(ready.items())))
+            self.options.deployment_ready = ready
+        elif wait_cmd:
             log.info('Waiting for deployment to complete.')
             status = subprocess.check_output(wait_cmd)
             log.info('Waiting completed: {}'.format(status))
@@ -146,22 +239,26 @@ class Runner(object):
             try:
                 self._deploy(deploy_cmd)
                 self.wait_for_deployment(wait_cmd)
+                self.builder.mark_baseline()
             except DeployError as e:
                 yield e.result
                 raise StopIteration
 
-        for element in self.suite:
-            if isinstance(element, Suite):
-                for result in self._run_suite(element):
-                    result, stop = self._handle_result(result)
-                    yield result
-                    if stop:
-                        raise StopIteration
-            else:
-                result, stop = self._handle_result(self._run_test(element))
+        environments = getattr(self.options, 'environments', None) or []
+        if getattr(self.suite, 'pending', None):
+            results = self._run_streamed(self.suite)
+        elif len(environments) > 1:
+            results = self._run_pooled(self.suite, environments)
+        else:
+            results = self._run_suite(self.suite)
+        try:
+            for result in results:
+                result, stop = self._handle_result(result)
                 yield result
                 if stop:
                     raise StopIteration
+        finally:
+            results.close()
 
         if bootstrapped:
             self.builder.destroy()
@@ -177,11 +274,228 @@ class Runner(object):
             exc.result.update(deployed)
             raise exc
 
+    def _parallel_group(self, element):
+        """Return the parallel group of element, or None if it must run
+        on its own.
+
+        Specs which reset the model always run alone so they act as
+        barriers between groups of concurrent tests.
+        """
+        jobs = getattr(self.options, 'jobs', None) or 1
+        if jobs <= 1:
+            return None
+        if element.reset or not element.parallel:
+            return None
+        return element.parallel
+
+    def _batches(self, specs):
+        """Group consecutive specs of the same suite which share a
+        parallel group."""
+        batch, group = [], None
+        for spec in specs:
+            key = self._parallel_group(spec)
+            if batch and (key is None or key != group or
+                          spec.get('suite') is not batch[0].get('suite')):
+                yield batch
+                batch = []
+            batch.append(spec)
+            group = key
+        if batch:
+            yield batch
+
     def _run_suite(self, suite):
-        for spec in suite:
-            yield self._run_test(spec)
+        return self._run_specs(self.plan.specs(suite))
+
+    def _run_specs(self, specs):
+        for batch in self._batches(specs):
+            if len(batch) > 1:
+                results = self._run_parallel(batch)
+            else:
+                results = [self._run_test(batch[0],
+                                          chdir=not self._threaded)]
+            for result in results:
+                yield result
+
+    def _run_streamed(self, suite):
+        """Run the nested suites of suite as discovery yields them, then
+        the rest of suite.
 
-    def _run_test(self, spec):
+        Each nested suite joins the suite tree and the plan as it arrives,
+        after those already run, and the system packages it needs are
+        installed before it runs. Discovery is stopped if the run ends
+        early. It resolves paths against the cwd, so the cwd is left alone
+        until it is done.
+        """
+        pending, suite.pending = suite.pending, None
+        streamed = 0
+        threaded, self._threaded = self._threaded, True
+        try:
+            for charm_suite, error in pending:
+                if error:
+                    yield {
+                        'test': 'discovery',
+                        'suite': 'bundletester',
+                        'exit': 'discovery',
+                        'returncode': 1,
+                        'output': error,
+                    }
+                    continue
+                if not len(charm_suite):
+                    continue
+                suite.insert(streamed, charm_suite)
+                streamed += 1
+                self.plan.refresh()
+                self.builder.install_system_packages(
+                    [s.config for s in charm_suite.walk()])
+                for result in self._run_suite(charm_suite):
+                    yield result
+        finally:
+            close = getattr(pending, 'close', None)
+            if close:
+                close()
+            self._threaded = threaded
+        for result in self._run_specs(self.plan.own_specs(suite)):
+            yield result
+
+    def _run_pooled(self, suite, environments):
+        """Run the nested suites of suite concurrently, one per model.
+
+        The first model, which any bundle was deployed to, runs the rest of
+        suite before taking nested suites too. Every other model gets its
+        own Runner and Builder. Results are yielded in suite order.
+        """
+        suites = self.plan.children(suite)
+        rest = self.plan.own_specs(suite)
+        # One stream of results per nested suite, then one for the rest
+        streams = [Queue.Queue() for _ in range(len(suites) + 1)]
+        pending = Queue.Queue()
+        for i, s in enumerate(suites):
+            pending.put((i, s))
+        stop = threading.Event()
+        runners = [self] + [Runner(self.suite, self.options, environment=e,
+                                   plan=self.plan)
+                            for e in environments[1:]]
+        for runner in runners:
+            runner._threaded = True
+
+        def drain(runner, specs, stream):
+            try:
+                for result in runner._run_specs(specs):
+                    stream.put(result)
+                    if stop.is_set():
+                        break
+            except (Exception, SystemExit) as e:
+                log.exception(e)
+                stream.put({
+                    'test': 'bundletester',
+                    'suite': runner.builder.env_name,
+                    'returncode': 1,
+                    'exit': 'bundletester',
+                    'output': traceback.format_exc(),
+                })
+            finally:
+                stream.put(None)
+
+        def worker(runner):
+            if runner is self:
+                drain(runner, rest, streams[-1])
+            else:
+                try:
+                    runner.builder.bootstrap()
+                except (Exception, SystemExit) as e:
+                    log.error('Not using model %s: %s',
+                              runner.environment, e)
+                    return
+            while not stop.is_set():
+                try:
+                    i, s = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                log.debug('Running suite %s on model %s', s.name,
+                          runner.builder.env_name)
+                drain(runner, self.plan.specs(s), streams[i])
+
+        workers = []
+        for runner in runners:
+            w = threading.Thread(target=worker, args=(runner,))
+            w.daemon = True
+            w.start()
+            workers.append(w)
+
+        completed = False
+        try:
+            for stream in streams:
+                while True:
+                    try:
+                        # Time out so KeyboardInterrupt still gets through
+                        result = stream.get(timeout=1)
+                    except Queue.Empty:
+                        continue
+                    if result is None:
+                        break
+                    yield result
+            completed = True
+        finally:
+            if not completed:
+                stop.set()
+                for runner in runners:
+                    runner.cancel()
+            for w in workers:
+                w.join()
+            for runner in runners:
+                runner._threaded = False
+
+    def _run_parallel(self, specs):
+        """Run specs on a pool of worker threads.
+
+        Results are yielded in the order of specs regardless of the order
+        in which they complete. Closing the generator early cancels the
+        tests still in flight.
+        """
+        pending = Queue.Queue()
+        for i, spec in enumerate(specs):
+            pending.put((i, spec))
+        results = {}
+        done = threading.Condition()
+
+        def worker():
+            while not self._cancelled.is_set():
+                try:
+                    i, spec = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                result = self._run_test(spec, chdir=False)
+                with done:
+                    results[i] = result
+                    done.notify()
+
+        workers = []
+        for _ in range(min(self.options.jobs, len(specs))):
+            w = threading.Thread(target=worker)
+            w.daemon = True
+            w.start()
+            workers.append(w)
+        log.debug('Running %s tests on %s workers', len(specs), len(workers))
+
+        yielded = 0
+        try:
+            for i in range(len(specs)):
+                with done:
+                    while i not in results:
+                        # Wait with a timeout so KeyboardInterrupt
+                        # still reaches the main thread.
+                        done.wait(1)
+                    result = results.pop(i)
+                yield result
+                yielded += 1
+        finally:
+            if yielded < len(specs):
+                self.cancel()
+            for w in workers:
+                w.join()
+            self._cancelled.clear()
+
+    def _run_test(self, spec, chdir=True):
         result = {
             'test': spec.name,
             'returncode': 0
@@ -189,13 +503,15 @@ class Runner(object):
         cwd = os.getcwd()
         try:
             if spec.reset:
-                self.builder.reset()
+                self.builder.reset(partial=spec.reset == 'partial')
             basedir = spec.get('dirname')
             if basedir:
                 result['dirname'] = basedir
-                os.chdir(basedir)
+                if chdir:
+                    os.chdir(basedir)
             result.update(self.run(spec, 'setup'))
-            if result.get('returncode', 0) == 0:
+            if (result.get('returncode', 0) == 0 and
+                    not self._cancelled.is_set()):
                 result.update(self.run(spec))
         except DeployError as e:
             result.update(e.result)
@@ -214,7 +530,8 @@ class Runner(object):
             result['output'] = '{}\n{}'.format(
                 result.get('output', ''), traceback.format_exc())
         finally:
-            os.chdir(cwd)
+            if chdir:
+                os.chdir(cwd)
             td = self.run(spec, 'teardown')
             if td.get('returncode') != 0:
                 log.error('Failed to teardown test %s' % spec)
@@ -222,6 +539,22 @@ class Runner(object):
                 # otherwise a successful teardown could overwrite
                 # the failure code of a main phase test
                 result.update(td)
+            elif 'teardown_duration' in td:
+                result['teardown_duration'] = td['teardown_duration']
             suite = spec.get('suite')
             result['suite'] = suite and suite.name or None
+            self._record(spec, result)
             return result
+
+    def _record(self, spec, result):
+        """Add the phase durations of result to the history."""
+        history = getattr(self.options, 'history_db', None)
+        if not history or self.options.dryrun:
+            return
+        try:
+            history.record(spec_id(spec),
+                           result.get('setup_duration'),
+                           result.get('duration'),
+                           result.get('teardown_duration'))
+        except Exception as e:
+            log.warning('Failed to record test durations: %s', e)
@@ -0,0 +1,100 @@
+"""Split the tests of a suite across several bundletester runs."""
+import argparse
+import hashlib
+import json
+import logging
+
+from bundletester.spec import spec_id, test_id
+from bundletester.testplan import TestPlan
+
+log = logging.getLogger('shard')
+
+
+def parse_shard(value):
+    """Parse an ``INDEX/COUNT`` shard argument, INDEX counting from 1."""
+    try:
+        index, count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Expected INDEX/COUNT, got '{}'".format(value))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            'Shard index must be between 1 and {}'.format(count))
+    return index, count
+
+
+def load_durations(paths):
+    """Return the test durations recorded in JSON reports."""
+    durations = {}
+    for path in paths or []:
+        with open(path) as fp:
+            report = json.load(fp)
+        for test in report.get('tests', []):
+            if 'duration' in test:
+                durations[test_id(test.get('suite'), test['test'])] = \
+                    test['duration']
+    return durations
+
+
+def assign(ids, count, durations=None):
+    """Assign each test id to a shard, returning a dict of id -> shard
+    index (from 1).
+
+    With known durations, tests are dealt longest first to the least
+    loaded shard, tests without history counting as the mean duration.
+    Otherwise tests are spread by a hash of their id.
+    """
+    durations = dict((i, durations[i]) for i in ids
+                     if durations and i in durations)
+    if not durations:
+        return dict(
+            (i, int(hashlib.md5(i.encode('utf-8')).hexdigest(), 16) %
+             count + 1) for i in ids)
+
+    mean = sum(durations.values()) / len(durations)
+    loads = [0.0] * count
+    shards = {}
+    for i in sorted(ids, key=lambda i: (-durations.get(i, mean), i)):
+        shard = loads.index(min(loads))
+        loads[shard] += durations.get(i, mean)
+        shards[i] = shard + 1
+    log.debug('Estimated shard durations: %s', loads)
+    return shards
+
+
+def select(suite, index, count, durations=None):
+    """Remove the tests which don't belong to shard index of count from
+    suite, along with suites left empty. Returns the plan of the whole
+    suite, before sharding.
+    """
+    test_plan = TestPlan(suite)
+    ids = test_plan.ids()
+    shards = assign(ids, count, durations)
+    test_plan.filter(lambda spec: shards[spec_id(spec)] == index)
+    return ids
+
+
+def merge(reports):
+    """Merge the JSON reports of the shards of a run into one report.
+
+    Tests are ordered as in the plan of the run.
+    """
+    if not reports:
+        raise ValueError('No reports to merge')
+    merged = dict((k, v) for k, v in reports[0].items() if k != 'shard')
+    positions = {}
+    for report in reports:
+        if report.get('revision') != merged.get('revision'):
+            log.warning('Merging reports of different revisions: %s, %s',
+                        merged.get('revision'), report.get('revision'))
+        shard = report.get('shard') or {}
+        for i, id_ in enumerate(shard.get('plan', [])):
+            positions.setdefault(id_, i)
+    tests = []
+    for report in reports:
+        tests.extend(report.get('tests', []))
+    end = len(positions)
+    tests.sort(key=lambda t: positions.get(
+        test_id(t.get('suite'), t['test']), end))
+    merged['tests'] = tests
+    return merged
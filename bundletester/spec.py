@@ -1,12 +1,18 @@
-import errno
 import glob
+import logging
 import os
-import subprocess
-from distutils.spawn import find_executable
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
 from config import Parser
-import yaml
 
-from bundletester import (config, models, utils)
+from bundletester import (
+    bundlefile, changes, config, makefile, models, probe, utils, yamlfiles)
+
+log = logging.getLogger('spec')
+
+# Charms of a bundle searched for tests at once
+DISCOVERY_JOBS = 8
 
 
 def normalize_path(path, relto):
@@ -16,10 +22,105 @@ def normalize_path(path, relto):
     return path
 
 
+def test_id(suite, test):
+    """Return the id of a test, stable across runs and hosts."""
+    return '{}::{}'.format(suite or '', test)
+
+
+def spec_id(spec):
+    suite = spec.get('suite')
+    return test_id(suite and suite.name, spec.name)
+
+
+# The keys of a spec which aren't config
+SPEC_FIELDS = ('name', 'executable', 'dirname', 'suite')
+
+
+class SpecRecord(object):
+    """A test, whose config is looked up through layers: keys set on the
+    record, then its control file, then the config of its suite (tests.yaml
+    over the defaults).
+
+    Lists add up through the layers, as config.Parser merges them, except
+    makefile, which the control file replaces. Nothing is copied into the
+    record, and setting a key only overrides it for this record.
+    """
+    __slots__ = SPEC_FIELDS + ('parent', 'control', 'overrides')
+
+    def __init__(self, name, executable, dirname=None, suite=None,
+                 parent=None, control=None):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'executable', executable)
+        object.__setattr__(self, 'dirname', dirname)
+        object.__setattr__(self, 'suite', suite)
+        object.__setattr__(self, 'parent', parent)
+        object.__setattr__(self, 'control', control)
+        object.__setattr__(self, 'overrides', None)
+
+    def _lookup(self, key):
+        """Return whether key is set, and its value."""
+        if key in SPEC_FIELDS:
+            return True, object.__getattribute__(self, key)
+        if self.overrides and key in self.overrides:
+            return True, self.overrides[key]
+        parent = config.DEFAULTS if self.parent is None else self.parent
+        found, value = key in parent, parent.get(key)
+        if self.control and key in self.control:
+            own = self.control[key]
+            if isinstance(value, list) and key != 'makefile':
+                value = value + (own if isinstance(own, list) else [own])
+            else:
+                value = own
+            found = True
+        # Copies, so changing them leaves the shared layers alone
+        return found, yamlfiles.thaw(value)
+
+    def get(self, key, default=None):
+        found, value = self._lookup(key)
+        return value if found else default
+
+    def __getitem__(self, key):
+        found, value = self._lookup(key)
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def __getattr__(self, key):
+        if key.startswith('__'):
+            raise AttributeError(key)
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        if key in SPEC_FIELDS:
+            object.__setattr__(self, key, value)
+            return
+        if self.overrides is None:
+            object.__setattr__(self, 'overrides', {})
+        self.overrides[key] = value
+
+    __setattr__ = __setitem__
+
+    def __contains__(self, key):
+        return self._lookup(key)[0]
+
+    def keys(self):
+        keys = list(SPEC_FIELDS)
+        parent = config.DEFAULTS if self.parent is None else self.parent
+        for layer in (parent, self.control, self.overrides):
+            keys.extend(k for k in layer or () if k not in keys)
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __repr__(self):
+        return '<Spec {}>'.format(spec_id(self))
+
+
 def Spec(cmd, parent=None, dirname=None, suite=None, name=None):
     testfile = cmd
     if isinstance(cmd, list):
-        testfile = find_executable(cmd[0])
+        testfile = probe.which(cmd[0])
         if not testfile:
             raise OSError(
                 "Couldn't find executable for command '%s'" % cmd[0])
@@ -36,12 +137,9 @@ def Spec(cmd, parent=None, dirname=None, suite=None, name=None):
     control_file = "%s.yaml" % base
     if not os.path.exists(control_file):
         control_file = None
-    result = config.Parser(path=control_file, parent=parent)
-    result['name'] = name or os.path.basename(testfile)
-    result['executable'] = cmd
-    result['dirname'] = dirname
-    result['suite'] = suite
-    return result
+    control = yamlfiles.load(control_file) if control_file else None
+    return SpecRecord(name or os.path.basename(testfile), cmd, dirname,
+                      suite, parent, control or None)
 
 
 class Suite(list):
@@ -55,6 +153,11 @@ class Suite(list):
         self.directory = model['directory']
         self.testdir = model['testdir']
         self.name = model.get('name')
+        # Charm suites still being discovered, when streaming
+        self.pending = None
+        # Of the charms of a bundle, with --changed-since
+        self.charm_fingerprints = {}
+        self.unchanged = set()
         if not self.config.bundle:
             self.config.bundle = model.get('bundle')
 
@@ -137,12 +240,15 @@ class Suite(list):
         cmd = ['juju-wait', '-v']
         if self.options.environment:
             cmd.extend(['-m', self.options.environment])
-        if self.config.deployment_timeout is not None:
-            cmd.extend(['-t', str(self.config.deployment_timeout)])
-        else:
-            cmd.extend(['-t', os.getenv('JUJU_DEPLOYMENT_TIMEOUT', '5400')])
+        cmd.extend(['-t', str(self.deployment_timeout())])
         return cmd
 
+    def deployment_timeout(self):
+        """Return the seconds allowed for the deployment to settle."""
+        if self.config.deployment_timeout is not None:
+            return self.config.deployment_timeout
+        return int(os.getenv('JUJU_DEPLOYMENT_TIMEOUT', '5400'))
+
     def deploy_cmd(self):
         """Return the bundle deploy command for this suite.
 
@@ -195,11 +301,11 @@ class Suite(list):
                          in self.options.tests]
             tests = tests.intersection(set(filterset))
 
-        exec_tests = []
-        for test in sorted(tests):
-            if os.path.isfile(test) and os.access(test, os.X_OK | os.R_OK):
-                exec_tests.append(test)
-                self.spec(test, dirname=self.model['directory'], suite=self)
+        exec_tests = [test for test in sorted(tests)
+                      if os.path.isfile(test) and
+                      os.access(test, os.X_OK | os.R_OK)]
+        for test in self.order_tests(exec_tests):
+            self.spec(test, dirname=self.model['directory'], suite=self)
 
         # When a test pattern is provided (other than the default), expect
         # at least one executable glob match, otherwise fail.
@@ -215,6 +321,32 @@ class Suite(list):
             raise OSError('Expected executable test files: '
                           '{}'.format(self.options.tests))
 
+    def walk(self):
+        """Yield this suite and all the suites nested in it."""
+        yield self
+        for element in self:
+            if isinstance(element, Suite):
+                for suite in element.walk():
+                    yield suite
+
+    def order_tests(self, tests):
+        """Return tests in the order they should run.
+
+        Tests pinned in tests.yaml run first, in the order given there.
+        With --order duration the others run longest first, going by the
+        durations in the history; tests without history count as longest.
+        """
+        pinned = [os.path.join(self.testdir, t)
+                  for t in self.config.pinned or []]
+        first = [t for t in pinned if t in tests]
+        rest = [t for t in tests if t not in first]
+        history = getattr(self.options, 'history_db', None)
+        if getattr(self.options, 'order', None) == 'duration' and history:
+            durations = history.durations()
+            rest.sort(key=lambda t: -durations.get(
+                test_id(self.name, os.path.basename(t)), float('inf')))
+        return first + rest
+
     def find_suite(self):
         """Find and prepend charms tests to our suite of tests.
         bundle: path to bundle file
@@ -226,40 +358,155 @@ class Suite(list):
         if self.excluded():
             return
 
+        cache = getattr(self.options, 'discovery_store', None)
+        if getattr(self.options, 'order', None) == 'duration':
+            # The order changes with every run
+            cache = None
+        if not (cache and cache.restore(self)):
+            self.find_own_tests()
+            if cache:
+                cache.store(self)
+
+        if isinstance(self.model, models.Bundle):
+            if getattr(self.options, 'stream', None) is True:
+                self.pending = self.stream_charm_suites()
+                return
+            for charm_suite in self.charm_suites(self._charms()):
+                if len(charm_suite):
+                    self.insert(0, charm_suite)
+
+    def _charms(self):
+        deployment = utils.fetch_deployment(self.config.bundle,
+                                            self.options.deployment)
+        return deployment.get_charms()
+
+    def find_own_tests(self):
+        """Find the tests of this suite, leaving out nested suites."""
         is_bundle = isinstance(self.model, models.Bundle)
         is_charm = isinstance(self.model, models.Charm)
 
         if (is_charm or is_bundle) and not self.options.skip_implicit:
             self.find_implicit_tests()
-
-        if isinstance(self.model, models.Bundle):
-            deployment = utils.fetch_deployment(self.config.bundle,
-                                                self.options.deployment)
-            for charm in deployment.get_charms():
-                model = models.Charm.from_deployer_charm(charm)
-                charm_suite = Suite(model, self.options,
-                                    parent_config=self.config)
-                charm_suite.find_suite()
-                if len(charm_suite):
-                    self.insert(0, charm_suite)
         self.find_tests()
         if is_bundle and not self.options.skip_implicit:
             self.conditional_matrix(self.model['directory'])
 
+    def _discover_charm(self, charm):
+        """Return the suite of charm and None, or None and an error."""
+        try:
+            model = models.Charm.from_deployer_charm(
+                charm, getattr(self.options, 'charm_staging', None) or
+                'auto')
+            charm_suite = Suite(model, self.options,
+                                parent_config=self.config)
+            baseline = getattr(self.options, 'baseline', None)
+            if isinstance(baseline, dict):
+                digest = changes.fingerprint(model['directory'])
+                self.charm_fingerprints[charm_suite.name] = digest
+                if baseline.get(charm_suite.name) == digest:
+                    log.info('%s is unchanged, not testing it',
+                             charm_suite.name)
+                    self.unchanged.add(charm_suite.name)
+                    return charm_suite, None
+            charm_suite.find_suite()
+            return charm_suite, None
+        except Exception as e:
+            log.debug('Failed to discover %s', charm.name, exc_info=True)
+            return None, '{}: {}'.format(charm.name, e)
+
+    def iter_charm_suites(self, charms):
+        """Yield (suite, error) for each of the charms of a bundle, in
+        order, as soon as it has been copied and searched for tests.
+
+        Charms not started yet are dropped if the iterator is closed early.
+        """
+        if not charms:
+            return
+        pool = ThreadPool(min(DISCOVERY_JOBS, len(charms)))
+        finished = False
+        try:
+            for result in pool.imap(self._discover_charm, charms):
+                yield result
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+    def stream_charm_suites(self):
+        """Start discovering the charms of this bundle in the background.
+
+        Returns an iterator of (suite, error) for each charm, in order,
+        like iter_charm_suites. Fetching the charms happens in the
+        background too, so its errors come out of the iterator as well.
+        Closing the iterator stops discovering charms.
+        """
+        results = Queue.Queue()
+        stopped = threading.Event()
+
+        def discover():
+            try:
+                charms = self._charms()
+                if stopped.is_set():
+                    return
+                discovered = self.iter_charm_suites(charms)
+                try:
+                    for result in discovered:
+                        if stopped.is_set():
+                            break
+                        results.put(result)
+                finally:
+                    discovered.close()
+            except Exception as e:
+                label = self.name or self.model.get('bundle') or \
+                    self.directory
+                log.debug('Failed to fetch the charms of %s', label,
+                          exc_info=True)
+                results.put((None, '{}: {}'.format(label, e)))
+            finally:
+                results.put(None)
+
+        thread = threading.Thread(target=discover)
+        thread.daemon = True
+        thread.start()
+
+        def drain():
+            try:
+                while True:
+                    try:
+                        # Time out so KeyboardInterrupt still gets through
+                        result = results.get(timeout=1)
+                    except Queue.Empty:
+                        continue
+                    if result is None:
+                        return
+                    yield result
+            finally:
+                stopped.set()
+        return drain()
+
+    def charm_suites(self, charms):
+        """Return the suites of the charms of a bundle, in order.
+
+        The charms are copied and searched for tests concurrently. Errors
+        are collected for every charm and raised together at the end.
+        """
+        results = list(self.iter_charm_suites(charms))
+        errors = [error for _, error in results if error]
+        if errors:
+            raise OSError('Failed to discover the tests of {} charm(s):\n  '
+                          '{}'.format(len(errors), '\n  '.join(errors)))
+        return [charm_suite for charm_suite, _ in results]
+
     def conditional_make(self, target, entitydir, suite=None):
-        cwd = os.getcwd()
-        os.chdir(entitydir)
-        p = subprocess.Popen(['make', '-ns', target],
-                             stdout=open('/dev/null', 'w'),
-                             stderr=subprocess.STDOUT)
-        ec = p.wait()
-        if ec == 0:
+        if target in makefile.targets(entitydir):
             # The makefile target exists, add the spec
             self.spec(['make', '-s', target],
                       name="make %s" % target,
                       dirname=entitydir,
                       suite=suite)
-        os.chdir(cwd)
 
     def conditional_matrix(self, dirname):
         """
@@ -270,14 +517,7 @@ class Suite(list):
             return
         if self.options.no_matrix:
             return
-        try:
-            subprocess.call(['juju-matrix', '--help'],
-                            stdout=open('/dev/null', 'w'),
-                            stderr=subprocess.STDOUT)
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise
-        else:
+        if probe.which('juju-matrix'):
             controller, _ = self.options.environment.split(':')
             self.spec(['juju-matrix', '-s', 'raw', '-c', controller],
                       name='juju-matrix', dirname=dirname)
@@ -309,27 +549,9 @@ def filter_yamls(yamls):
     if not yamls:
         return
 
-    result = []
-    for yamlfn in yamls:
-        if yamlfn.endswith('metrics.yaml'):
-            continue
-        data = yaml.safe_load(open(yamlfn))
-        if not isinstance(data, dict):
-            continue
-        # v4 bundle format
-        if 'services' in data and 'services' not in data['services']:
-            result.append(yamlfn)
-            continue
-        for possible in data.values():
-            if isinstance(possible, dict) and 'services' in possible:
-                keys = sorted(possible['services'].keys())
-                if keys == ['default', 'description', 'type']:
-                    # looks like a charm, not a bundle
-                    continue
-                # v3 bundle format
-                result.append(yamlfn)
-                break
-    return result
+    return [yamlfn for yamlfn in yamls
+            if not yamlfn.endswith('metrics.yaml') and
+            bundlefile.is_bundle(yamlfn)]
 
 
 def find_bundle_file(directory, bundle, filter_yamls=filter_yamls):
@@ -365,7 +587,7 @@ def CharmClassifier(directory, options):
     if not os.path.exists(metadata):
         return None
     testdir = utils.find_testdir(directory)
-    metadata = yaml.safe_load(open(metadata))
+    metadata = yamlfiles.load(metadata)
     return models.Charm({
         'metadata': metadata,
         'testdir': testdir,
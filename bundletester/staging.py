@@ -0,0 +1,107 @@
+"""Stage a directory tree at a new path with as little copying as possible.
+
+Modes:
+  reflink   copy-on-write clone (btrfs, xfs, ...), via cp --reflink
+  hardlink  a tree of new directories with hardlinks to the files
+  symlink   a symlink to the whole tree
+  copy      a full copy
+  auto      a reflink when the filesystem supports it, else a copy
+
+Only copy and reflink trees can be modified without touching the source,
+so hardlink and symlink trees are read-only and never chosen by auto.
+"""
+import errno
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+log = logging.getLogger('staging')
+
+MODES = ['auto', 'reflink', 'hardlink', 'symlink', 'copy']
+
+
+def tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def reflink(src, dst):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['cp', '-a', '--reflink=always', src, dst],
+                              stdout=devnull, stderr=devnull)
+
+
+def hardlink(src, dst):
+    for root, dirs, files in os.walk(src):
+        target = os.path.normpath(
+            os.path.join(dst, os.path.relpath(root, src)))
+        os.mkdir(target)
+        shutil.copystat(root, target)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+                if name in dirs:
+                    # Don't descend into symlinked directories
+                    dirs.remove(name)
+            elif name in files:
+                os.link(path, os.path.join(target, name))
+
+
+def symlink(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+
+
+def copy(src, dst):
+    shutil.copytree(src, dst, symlinks=True)
+
+
+STAGERS = {
+    'reflink': reflink,
+    'hardlink': hardlink,
+    'symlink': symlink,
+    'copy': copy,
+}
+
+
+def _clear(path):
+    if os.path.islink(path):
+        os.remove(path)
+    elif os.path.exists(path):
+        shutil.rmtree(path)
+
+
+def stage(src, dst, mode='auto'):
+    """Stage src at dst, returning a dict of the mode used, the size of
+    the tree, the bytes written and the seconds it took."""
+    start = time.time()
+    candidates = ['reflink', 'copy'] if mode == 'auto' else [mode]
+    for candidate in candidates:
+        try:
+            STAGERS[candidate](src, dst)
+            break
+        except (OSError, subprocess.CalledProcessError) as e:
+            _clear(dst)
+            if candidate == candidates[-1]:
+                raise
+            if isinstance(e, OSError) and e.errno not in (
+                    errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            log.debug('Unable to %s %s: %s', candidate, src, e)
+    size = tree_size(src)
+    stats = {
+        'mode': candidate,
+        'size': size,
+        'written': size if candidate == 'copy' else 0,
+        'seconds': round(time.time() - start, 3),
+    }
+    log.debug('Staged %s at %s: %s', src, dst, stats)
+    return stats
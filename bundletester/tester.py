@@ -11,36 +11,92 @@ import textwrap
 import pkg_resources
 
 from bundletester import (
+    changes,
+    discovery,
+    history,
+    probe,
     reporter,
     runner,
+    shard,
     spec,
+    staging,
+    testplan,
     utils,
+    venvcache,
+    yamlfiles,
     fetchers,
 )
 
 
 def get_juju_major_version():
-    return int(subprocess.check_output(
-        ["juju", "version"]).split(b'.')[0])
+    return int(probe.juju_version().split('.')[0])
 
 
 def current_environment():
     return subprocess.check_output(['juju', 'switch']).strip()
 
 
+def expand_environments(values, count):
+    """Return the list of models named by the -e arguments, and the ones
+    among them which are expanded from a '{}' template and need creating.
+    """
+    environments, new_models = [], []
+    for value in values or []:
+        for name in value.split(','):
+            if not name:
+                continue
+            if '{}' in name:
+                names = [name.format(i) for i in range(1, count + 1)]
+                environments.extend(names)
+                new_models.extend(names)
+            else:
+                environments.append(name)
+    return environments, new_models
+
+
+def create_models(models):
+    """Add the models which don't exist yet, returning those added."""
+    created = []
+    for model in models:
+        controller, name = model.split(':', 1)
+        with open(os.devnull, 'w') as devnull:
+            exists = subprocess.call(['juju', 'show-model', model],
+                                     stdout=devnull,
+                                     stderr=subprocess.STDOUT) == 0
+        if not exists:
+            logging.info('Adding model %s', model)
+            subprocess.check_call(['juju', 'add-model', name,
+                                   '-c', controller])
+            created.append(model)
+    return created
+
+
+def destroy_models(models):
+    for model in models:
+        logging.info('Destroying model %s', model)
+        subprocess.call(['juju', 'destroy-model', '-y', model])
+
+
 def validate():
     # Minimally verify we expect we can continue
-    subprocess.check_output(['juju', 'version'])
+    probe.juju_version()
 
 
 def configure():
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
-        '-e', '--environment',
+        '-e', '--environment', action='append',
         help=('Juju environment or model name. '
               'For Juju 2 models, must be specified with the '
-              '<controller>:<model> notation.'))
+              '<controller>:<model> notation. Repeat, or separate names '
+              'with commas, to run charm suites concurrently on several '
+              'models. A name containing {} is a template for '
+              '--model-count models, created as needed (Juju 2 only).'))
+    parser.add_argument('--model-count', dest='model_count', type=int,
+                        default=2,
+                        help="Number of models to create from an "
+                        "-e template (default: 2).")
     parser.add_argument('-t', '--testdir', default=os.getcwd())
     parser.add_argument('-b', '-c', '--bundle',
                         type=str,
@@ -61,12 +117,26 @@ def configure():
                         type=argparse.FileType('w'))
     parser.add_argument('-n', '--dry-run', action="store_true",
                         dest="dryrun")
+    parser.add_argument('--log-dir', dest="log_dir",
+                        help="Directory to keep the full output of each "
+                        "test in. Defaults to a new directory under "
+                        "logs/ in the cache; the logs of the last %s runs "
+                        "are kept there." % utils.KEEP_RUN_LOGS)
     parser.add_argument('-r', '--reporter', default="spec",
                         choices=reporter.FACTORY.keys())
     parser.add_argument('-v', '--verbose', action="store_true")
 
     parser.add_argument('-F', '--allow-failure', dest="failfast",
                         action="store_false")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of tests marked 'parallel' to run "
+                        "concurrently against the same model.")
+    parser.add_argument('--timeout', type=int,
+                        help="Max seconds for each phase (setup, test, "
+                        "teardown) of a test, unless set in tests.yaml.")
+    parser.add_argument('--idle-timeout', dest="idle_timeout", type=int,
+                        help="Max seconds a test phase may go without "
+                        "output, unless set in tests.yaml.")
     parser.add_argument('-s', '--skip-implicit', action="store_true",
                         help="Don't include automatically generated tests")
     parser.add_argument('-x', '--exclude', dest="exclude", action="append")
@@ -75,6 +145,61 @@ def configure():
                         "override the one in the charm or bundle "
                         "being tested.")
     parser.add_argument('--test-pattern', dest="test_pattern")
+    parser.add_argument('--order', choices=['name', 'duration'],
+                        default='name',
+                        help="Order of the tests of each suite. 'duration' "
+                        "runs the longest tests first, going by the "
+                        "durations recorded in earlier runs.")
+    parser.add_argument('--no-history', dest="history",
+                        action="store_false",
+                        help="Don't record test durations.")
+    parser.add_argument('--no-cache', dest="no_cache", action="store_true",
+                        help="Don't reuse virtualenvs built by earlier "
+                        "runs.")
+    parser.add_argument('--venv-cache-size', dest="venv_cache_size",
+                        type=int, default=venvcache.DEFAULT_SIZE,
+                        metavar='MiB',
+                        help="Size above which least recently used "
+                        "cached virtualenvs are removed (default: "
+                        "%(default)s).")
+    parser.add_argument('--wheelhouse', action="store_true",
+                        help="Install python packages from wheels cached "
+                        "by earlier runs, only building the missing ones.")
+    parser.add_argument('--find-links', dest="find_links",
+                        action="append", metavar='DIR',
+                        help="Extra directory of wheels and sdists to "
+                        "use in wheelhouse mode.")
+    parser.add_argument('--charm-staging', dest="charm_staging",
+                        choices=staging.MODES, default='auto',
+                        help="How the charms of a bundle are staged for "
+                        "testing: auto (reflink, else copy), reflink, "
+                        "copy, or the read-only hardlink and symlink, "
+                        "which share files with the charm cache.")
+    parser.add_argument('--stream', action="store_true",
+                        help="Start building, deploying and testing while "
+                        "the charms of a bundle are still being fetched "
+                        "and searched for tests. Ignored with --shard or "
+                        "several models.")
+    parser.add_argument('--discovery-cache', dest="discovery_cache",
+                        action="store_true",
+                        help="Reuse the tests found in suites which are "
+                        "unchanged since an earlier run.")
+    parser.add_argument('--shard', type=shard.parse_shard,
+                        metavar='INDEX/COUNT',
+                        help="Only run the INDEX-th (from 1) of COUNT "
+                        "roughly equal parts of the tests. Merge the JSON "
+                        "reports of all shards with bundletester-merge.")
+    parser.add_argument('--shard-durations', dest="shard_durations",
+                        action="append", metavar='RESULTS.json',
+                        help="JSON report of an earlier run, used to "
+                        "balance shards by test duration.")
+    parser.add_argument('--changed-since', dest="changed_since",
+                        metavar='REF|RESULTS.json',
+                        help="Only test the charms of the bundle which "
+                        "changed since an earlier run: the one of a JSON "
+                        "report, or the last recorded one ('last') or the "
+                        "last recorded run of a bundle revision. Bundle "
+                        "tests always run.")
     parser.add_argument('--version', action="store_true",
                         help="Print the current version")
     parser.add_argument('tests', nargs="*")
@@ -93,10 +218,15 @@ def configure():
             pkg_resources.get_distribution("bundletester").version))
         sys.exit()
 
-    if not options.environment:
-        options.environment = current_environment()
+    options.environments, options.new_models = expand_environments(
+        options.environment, options.model_count)
+    if not options.environments:
+        options.environments = [current_environment()]
+    options.environment = options.environments[0]
 
     options.juju_major_version = get_juju_major_version()
+    if options.new_models and options.juju_major_version == 1:
+        sys.exit('Model templates require Juju 2 or later.')
 
     # Set the environment variable BUNDLE if the bundle argument was provided.
     if options.bundle:
@@ -127,9 +257,13 @@ def main(options=None):
         options.output = sys.stdout
 
     tmpdir = None
+    created_models = []
     try:
         try:
             fetcher = fetchers.get_fetcher(options.testdir)
+            # What is tested, the same from run to run
+            source = '{}#{}'.format(getattr(fetcher, 'path', fetcher.url),
+                                    getattr(options, 'bundle', None) or '')
             tmpdir = tempfile.mkdtemp(prefix='bundletester-')
             options.fetcher = fetcher
             options.testdir = fetcher.fetch(tmpdir)
@@ -137,28 +271,70 @@ def main(options=None):
             sys.stderr.write("{}\n".format(e))
             return get_return_data(1, None)
 
+        if not getattr(options, 'log_dir', None):
+            # Outlives the run, as the reports point into it
+            options.log_dir = utils.run_log_dir()
+            sys.stderr.write("Test logs in {}\n".format(options.log_dir))
+        # The History the run records to, when enabled by the flag
+        options.history_db = history.History(scope=source) \
+            if getattr(options, 'history', None) is True else None
+        options.discovery_store = discovery.DiscoveryCache() \
+            if getattr(options, 'discovery_cache', None) is True else None
+        if getattr(options, 'changed_since', None):
+            options.baseline = changes.load_baseline(options.changed_since,
+                                                     options.history_db)
+
+        if getattr(options, 'shard', None) or \
+                len(getattr(options, 'environments', None) or []) > 1:
+            # Both need every test known up front
+            options.stream = False
         suite = spec.SuiteFactory(options, options.testdir)
 
-        if not suite:
+        if suite is not None and suite.unchanged and \
+                not (suite or suite.pending):
+            sys.stderr.write("No Charms Changed\n")
+            return get_return_data(0, suite)
+        if suite is None or not (suite or suite.pending):
             sys.stderr.write("No Tests Found\n")
             return get_return_data(3, None)
 
+        if getattr(options, 'shard', None):
+            index, count = options.shard
+            options.shard_plan = shard.select(
+                suite, index, count,
+                shard.load_durations(options.shard_durations))
+
         report = reporter.get_reporter(options.reporter,
                                        options.output,
                                        options)
-        report.set_suite(suite)
-        run = runner.Runner(suite, options)
+        test_plan = testplan.TestPlan(suite)
+        report.set_suite(suite, test_plan)
+        run = runner.Runner(suite, options, plan=test_plan)
         report.header()
-        if len(suite):
+        if len(test_plan) or suite.pending:
+            created_models = create_models(
+                getattr(options, 'new_models', None) or [])
             with utils.juju_env(
                     options.environment, options.juju_major_version):
                 [report.emit(result) for result in run()]
+        if isinstance(getattr(options, 'baseline', None), dict):
+            options.charms = changes.passed(suite, test_plan)
+            if options.history_db:
+                options.history_db.record_charms(
+                    str(options.fetcher.get_revision(
+                        options.testdir)).strip(),
+                    options.charms)
         report.summary()
         return_code = report.exit()
         status = get_return_data(return_code, suite)
     finally:
+        if created_models and not options.no_destroy:
+            destroy_models(created_models)
+        if getattr(options, 'history_db', None):
+            options.history_db.close()
         if tmpdir:
             shutil.rmtree(tmpdir)
+        yamlfiles.log_stats()
     return status
 
 
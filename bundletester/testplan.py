@@ -0,0 +1,154 @@
+"""The tests of a discovered suite tree, compiled into a flat run plan.
+
+Tests are kept in run order, depth first, so the tests of every suite
+(nested suites included) are one contiguous slice of the plan. The setup
+and teardown scripts of each test are resolved once, when the plan is
+compiled, and results are counted by suite and status as they come in.
+"""
+import os
+from collections import defaultdict, namedtuple
+
+from bundletester.spec import Suite, spec_id
+
+# suite is the index of the test's suite in TestPlan.suites
+Test = namedtuple('Test', ['index', 'id', 'suite', 'spec', 'setup',
+                           'teardown'])
+
+
+def relative_to(filenames, basefile):
+    """Normalize files relative to basefile turning partial names into files in
+    the same dir as basefile
+    """
+    results = []
+    if isinstance(basefile, list):
+        basefile = basefile[0]
+    if basefile is None:
+        return results
+    dirname = os.path.dirname(basefile)
+    for f in filenames:
+        if isinstance(f, list):
+            f = f[0]
+        path = os.path.abspath(os.path.join(dirname, f))
+        if os.path.exists(path):
+            results.append(path)
+    return results
+
+
+class TestPlan(object):
+    def __init__(self, suite):
+        self.root = suite
+        self._results = defaultdict(int)
+        self._statuses = defaultdict(int)
+        self.seconds = 0
+        # Results of tests killed by a timeout, counted in their code too
+        self.timeouts = 0
+        self._compile()
+
+    def _compile(self):
+        self.suites = []
+        # Index of the parent of each suite, None for the root
+        self.parents = []
+        self.tests = []
+        # (start, end) of the tests of each suite, nested suites included
+        self._ranges = []
+        self._suite_index = {}
+        self._by_spec = {}
+        if self.root is not None:
+            self._add_suite(self.root, None)
+
+    def _add_suite(self, suite, parent):
+        index = len(self.suites)
+        self.suites.append(suite)
+        self.parents.append(parent)
+        self._ranges.append(None)
+        self._suite_index[id(suite)] = index
+        start = len(self.tests)
+        for element in suite:
+            if isinstance(element, Suite):
+                self._add_suite(element, index)
+                continue
+            testdir = (element.get('suite') or suite).testdir
+            test = Test(len(self.tests), spec_id(element), index, element,
+                        relative_to(element.setup or [], testdir),
+                        relative_to(reversed(element.teardown or []),
+                                    testdir))
+            self.tests.append(test)
+            self._by_spec[id(element)] = test
+        self._ranges[index] = (start, len(self.tests))
+
+    def refresh(self):
+        """Compile the plan again, after suites were added to the tree.
+        Results counted so far are kept."""
+        self._compile()
+
+    def __len__(self):
+        return len(self.tests)
+
+    def __iter__(self):
+        return iter(self.tests)
+
+    def ids(self):
+        return [test.id for test in self.tests]
+
+    def get(self, spec):
+        """Return the planned Test of spec, or None."""
+        return self._by_spec.get(id(spec))
+
+    def _tests(self, suite):
+        start, end = self._ranges[self._suite_index[id(suite)]]
+        return self.tests[start:end]
+
+    def specs(self, suite=None):
+        """Return the specs of suite (the root by default) and its nested
+        suites, in run order."""
+        if suite is None:
+            return [test.spec for test in self.tests]
+        return [test.spec for test in self._tests(suite)]
+
+    def own_specs(self, suite):
+        """Return the specs of suite, leaving out its nested suites."""
+        index = self._suite_index[id(suite)]
+        return [test.spec for test in self._tests(suite)
+                if test.suite == index]
+
+    def children(self, suite):
+        """Return the suites nested directly in suite."""
+        index = self._suite_index[id(suite)]
+        return [s for s, parent in zip(self.suites, self.parents)
+                if parent == index]
+
+    def count(self, suite=None):
+        """Return the number of tests in suite, nested suites included."""
+        if suite is None:
+            return len(self.tests)
+        return len(self._tests(suite))
+
+    def filter(self, keep):
+        """Remove the tests for which keep(spec) is false from the plan
+        and from the suite tree, along with suites left empty."""
+        kept = set()
+        # Nested suites come after their parent, so are filtered first
+        for suite in reversed(self.suites):
+            suite[:] = [e for e in suite
+                        if (id(e) in kept if isinstance(e, Suite)
+                            else keep(e))]
+            if list.__len__(suite):
+                kept.add(id(suite))
+        self._compile()
+
+    def add_result(self, result):
+        """Count a test result."""
+        code = result.get('returncode')
+        self._results[(result.get('suite'), code)] += 1
+        self._statuses[code] += 1
+        self.seconds += result.get('duration', 0)
+        if result.get('timeout'):
+            self.timeouts += 1
+
+    def results(self, suite=None):
+        """Return a dict of returncode -> number of results, of all suites
+        or of the suite named suite."""
+        if suite is None:
+            return dict(self._statuses)
+        return dict((code, n) for (name, code), n in self._results.items()
+                    if name == suite)
@@ -1,17 +1,25 @@
+from collections import deque
 from contextlib import contextmanager
 import logging
 import os
+import shutil
+import time
 
-from deployer.config import ConfigStack
+from bundletester import bundlefile
 
 log = logging.getLogger(__name__)
 
+# Bytes of process output kept in memory when it is also logged to a file
+OUTPUT_TAIL = 64 * 1024
+# Number of runs whose logs are kept in the cache when no --log-dir is given
+KEEP_RUN_LOGS = 10
+
 
 def fetch_deployment(bundle_yaml, deployment=None):
     """Use bundle file to pull relevant charms"""
     if not bundle_yaml or not os.path.exists(bundle_yaml):
         raise OSError("Missing required bundle file: %s" % bundle_yaml)
-    c = ConfigStack([bundle_yaml])
+    c = bundlefile.BundleStack([bundle_yaml])
     if not deployment and len(c.keys()) == 1:
         deployment = c.get(c.keys()[0])
     elif deployment:
@@ -22,6 +30,31 @@ def fetch_deployment(bundle_yaml, deployment=None):
     return deployment
 
 
+def cache_dir(*names):
+    """Return (creating it if needed) a directory in bundletester's
+    persistent cache, $XDG_CACHE_HOME/bundletester by default."""
+    base = os.environ.get('BUNDLETESTER_CACHE') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'bundletester')
+    path = os.path.join(base, *names)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def run_log_dir(keep=KEEP_RUN_LOGS):
+    """Return a new directory in the cache for the logs of this run,
+    removing those of all but the keep most recent runs."""
+    base = cache_dir('logs')
+    name = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+    runs = sorted(os.listdir(base))
+    for old in runs[:max(len(runs) - keep + 1, 0)]:
+        shutil.rmtree(os.path.join(base, old), ignore_errors=True)
+    path = os.path.join(base, name)
+    os.makedirs(path)
+    return path
+
+
 def find_testdir(directory):
     testdir = os.path.join(directory, 'tests')
     if os.path.exists(testdir):
@@ -29,11 +62,16 @@ def find_testdir(directory):
     return None
 
 
+def juju_model_var(juju_major_version):
+    """Return the environment variable selecting the juju model."""
+    if juju_major_version == 1:
+        return 'JUJU_ENV'
+    return 'JUJU_MODEL'
+
+
 @contextmanager
 def juju_env(env, juju_major_version):
-    juju_model = 'JUJU_MODEL'
-    if juju_major_version == 1:
-        juju_model = 'JUJU_ENV'
+    juju_model = juju_model_var(juju_major_version)
     orig_env = os.environ.get(juju_model, '')
     if env != orig_env:
         log.debug('Updating %s: "%s" -> "%s"', juju_model, orig_env, env)
@@ -44,3 +82,49 @@ def juju_env(env, juju_major_version):
         if env != orig_env:
             log.debug('Updating %s: "%s" -> "%s"', juju_model, env, orig_env)
             os.environ[juju_model] = orig_env
+
+
+class OutputCapture(object):
+    """Collect the output of a process.
+
+    If path is given the complete output is streamed to that file and
+    only the last ``limit`` bytes are kept in memory, otherwise all of it
+    is kept in memory.
+    """
+    def __init__(self, path=None, limit=OUTPUT_TAIL):
+        self.path = path
+        self.limit = limit if path else None
+        self.truncated = False
+        self._chunks = deque()
+        self._size = 0
+        self._fp = None
+        if path:
+            dirname = os.path.dirname(path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self._fp = open(path, 'wb')
+
+    def write(self, data):
+        if self._fp:
+            self._fp.write(data)
+        self._chunks.append(data)
+        self._size += len(data)
+        if self.limit:
+            while self._size - len(self._chunks[0]) >= self.limit:
+                self._size -= len(self._chunks.popleft())
+                self.truncated = True
+
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
+    def getvalue(self):
+        """Return the captured output, or its tail if it was truncated."""
+        data = ''.join(self._chunks)
+        if self.limit and len(data) > self.limit:
+            data = data[-self.limit:]
+            self.truncated = True
+        if self.truncated:
+            data = '[output truncated, see {}]\n{}'.format(self.path, data)
+        return data
@@ -0,0 +1,128 @@
+"""Virtualenvs kept across runs, keyed by what is installed in them."""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from bundletester import utils
+
+log = logging.getLogger('venvcache')
+
+# Created in a virtualenv once its packages are installed, and touched
+# whenever it is used
+READY = '.bundletester-ready'
+# Default size limit of the cache, in MiB
+DEFAULT_SIZE = 2048
+
+
+def venv_key(python, requirements=(), packages=()):
+    """Return the cache key of a virtualenv.
+
+    python: path of the interpreter
+    requirements: paths of the requirement files
+    packages: python package specs
+    """
+    real = os.path.realpath(python)
+    parts = [real, os.stat(real).st_mtime if os.path.exists(real) else None]
+    for path in requirements:
+        with open(path, 'rb') as fp:
+            parts.append(hashlib.sha256(fp.read()).hexdigest())
+    parts.append(sorted(set(packages)))
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()[:32]
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class VenvCache(object):
+    """A directory of virtualenvs, evicted least recently used first once
+    their total size exceeds max_size MiB. The cache only grows when a
+    virtualenv is built, so that is when eviction runs.
+
+    Each virtualenv has a lock file. It is held exclusively while the
+    virtualenv is built and shared while it is in use, for as long as the
+    cache object lives, so other runs don't evict it.
+    """
+    def __init__(self, path=None, max_size=DEFAULT_SIZE):
+        self.path = path or utils.cache_dir('venvs')
+        self.max_size = max_size
+        self._locks = []
+
+    def _lock(self, key, mode):
+        fp = open(os.path.join(self.path, key + '.lock'), 'a')
+        try:
+            fcntl.flock(fp, mode)
+        except IOError:
+            fp.close()
+            raise
+        return fp
+
+    def get(self, key, build):
+        """Return the path of the virtualenv for key, first calling
+        build(path) to create it if it isn't in the cache.
+        """
+        path = os.path.join(self.path, key)
+        ready = os.path.join(path, READY)
+        lock = self._lock(key, fcntl.LOCK_SH)
+        built = False
+        try:
+            if os.path.exists(ready):
+                log.debug('Reusing cached virtualenv %s', path)
+            else:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # Another run may have built it meanwhile
+                if not os.path.exists(ready):
+                    if os.path.exists(path):
+                        # Left behind by a failed build
+                        shutil.rmtree(path)
+                    log.debug('Building virtualenv %s', path)
+                    build(path)
+                    open(ready, 'w').close()
+                    built = True
+                fcntl.flock(lock, fcntl.LOCK_SH)
+            os.utime(ready, None)
+        except Exception:
+            lock.close()
+            raise
+        self._locks.append(lock)
+        if built:
+            self.evict()
+        return path
+
+    def evict(self):
+        """Remove least recently used virtualenvs not in use while the
+        cache is over its size limit."""
+        if not self.max_size:
+            return
+        entries = []
+        for key in os.listdir(self.path):
+            ready = os.path.join(self.path, key, READY)
+            if os.path.exists(ready):
+                entries.append((os.stat(ready).st_mtime, key))
+        sizes = dict((key, dir_size(os.path.join(self.path, key)))
+                     for _, key in entries)
+        total = sum(sizes.values())
+        for _, key in sorted(entries):
+            if total <= self.max_size * 1024 * 1024:
+                break
+            try:
+                lock = self._lock(key, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # In use
+                continue
+            try:
+                log.debug('Evicting cached virtualenv %s', key)
+                shutil.rmtree(os.path.join(self.path, key))
+                total -= sizes[key]
+            finally:
+                lock.close()
@@ -0,0 +1,105 @@
+"""Load yaml files once per process.
+
+Documents are parsed with libyaml's CSafeLoader when it is built, and
+remembered by file (device and inode, so renaming a directory keeps them)
+until the file's mtime, ctime or size changes. The ctime is set when a file
+is created, so a new file reusing the inode of a deleted one isn't taken
+for it even if its mtime was copied.
+They are returned as read-only views, as every caller shares them; thaw()
+gives a private, mutable copy.
+"""
+import logging
+import os
+import threading
+import time
+
+import yaml
+
+log = logging.getLogger('yamlfiles')
+
+# The C loader is much faster than the pure Python one, when built
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+_lock = threading.Lock()
+_documents = {}
+_stats = {'parses': 0, 'hits': 0, 'seconds': 0.0}
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError('%s is read-only, thaw() it first'
+                    % type(self).__name__)
+
+
+class FrozenDict(dict):
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _read_only
+
+
+class FrozenList(list):
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = \
+        __iadd__ = __imul__ = append = extend = insert = pop = remove = \
+        reverse = sort = _read_only
+
+
+def freeze(data):
+    """Return a read-only view of loaded yaml data."""
+    if isinstance(data, dict):
+        return FrozenDict((k, freeze(v)) for k, v in data.items())
+    if isinstance(data, list):
+        return FrozenList(freeze(v) for v in data)
+    return data
+
+
+def thaw(data):
+    """Return a plain, mutable copy of (a view of) loaded yaml data."""
+    if isinstance(data, dict):
+        return dict((k, thaw(v)) for k, v in data.items())
+    if isinstance(data, list):
+        return [thaw(v) for v in data]
+    return data
+
+
+def parse(stream):
+    """Parse a yaml document, counting the parse in the stats."""
+    start = time.time()
+    data = yaml.load(stream, Loader=Loader)
+    with _lock:
+        _stats['parses'] += 1
+        _stats['seconds'] += time.time() - start
+    return data
+
+
+def load(path):
+    """Return a read-only view of the yaml document in the file at path."""
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino)
+    stamp = (st.st_mtime, st.st_ctime, st.st_size)
+    with _lock:
+        cached = _documents.get(key)
+        if cached and cached[0] == stamp:
+            _stats['hits'] += 1
+            return cached[1]
+    with open(path) as fp:
+        view = freeze(parse(fp))
+    with _lock:
+        _documents[key] = (stamp, view)
+    return view
+
+
+def stats():
+    """Return the number of parses, the seconds they took and the number
+    of loads served from memory."""
+    with _lock:
+        return dict(_stats)
+
+
+def log_stats():
+    log.info('Parsed %(parses)d yaml documents in %(seconds).3fs, '
+             'reused %(hits)d', stats())
+
+
+def reset():
+    """Forget the loaded documents and the stats."""
+    with _lock:
+        _documents.clear()
+        _stats.update(parses=0, hits=0, seconds=0.0)
@@ -25,7 +25,8 @@ SETUP = {
     'entry_points': {
         'console_scripts': [
             'bundletester = bundletester.tester:entrypoint',
-            'bundlewatcher = bundletester.watcher:main'
+            'bundlewatcher = bundletester.watcher:main',
+            'bundletester-merge = bundletester.merge:main'
         ]
     },
     'install_requires': reqs,
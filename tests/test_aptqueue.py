@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from bundletester import aptqueue
+
+
+class TestAptQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.queue = aptqueue.AptQueue(self.tmpdir)
+
+    def queue_request(self, name, pid, sources, packages):
+        with open(os.path.join(self.tmpdir, name + '.request'), 'w') as fp:
+            json.dump({'pid': pid, 'sources': sources,
+                       'packages': packages}, fp)
+
+    def test_run(self):
+        execute = mock.Mock()
+        waited = self.queue.run(['ppa:a/b'], ['a'], execute)
+        execute.assert_called_once_with(['ppa:a/b'], ['a'])
+        self.assertGreaterEqual(waited, 0)
+        self.assertEqual(os.listdir(self.tmpdir), ['lock'])
+
+    def test_merges_queued_requests(self):
+        self.queue_request('0-other', os.getppid(), ['ppa:c/d'], ['a', 'c'])
+        execute = mock.Mock()
+        self.queue.run([], ['a', 'b'], execute)
+        execute.assert_called_once_with(['ppa:c/d'], ['a', 'c', 'b'])
+        # Marked done for the other process, which will skip it
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, '0-other.done')))
+
+    @mock.patch('bundletester.aptqueue._alive')
+    def test_drops_requests_of_dead_processes(self, alive):
+        alive.side_effect = lambda pid: pid == os.getpid()
+        self.queue_request('0-dead', 1234567, [], ['dead'])
+        execute = mock.Mock()
+        self.queue.run([], ['a'], execute)
+        execute.assert_called_once_with([], ['a'])
+        self.assertEqual(os.listdir(self.tmpdir), ['lock'])
+
+    def test_skips_request_done_by_another_process(self):
+        def execute(sources, packages):
+            raise AssertionError('Should not run')
+
+        def flock(fp, mode):
+            # Another process runs our request while we wait for the lock
+            for name in os.listdir(self.tmpdir):
+                if name.endswith('.request'):
+                    path = os.path.join(self.tmpdir, name)
+                    os.rename(path, path[:-len('.request')] + '.done')
+
+        with mock.patch('fcntl.flock', flock):
+            self.queue.run([], ['a'], execute)
+        self.assertEqual(os.listdir(self.tmpdir), ['lock'])
+
+    def test_failure_marks_other_requests_failed(self):
+        self.queue_request('0-other', os.getppid(), [], ['c'])
+        execute = mock.Mock(side_effect=RuntimeError)
+        self.assertRaises(RuntimeError, self.queue.run, [], ['a'], execute)
+        self.assertEqual(execute.call_args_list,
+                         [mock.call([], ['c', 'a']), mock.call([], ['a'])])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['0-other.failed', 'lock'])
+
+    def test_failure_of_others_retries_own(self):
+        self.queue_request('0-other', os.getppid(), [], ['bad'])
+
+        def execute(sources, packages):
+            if 'bad' in packages:
+                raise RuntimeError('Unable to locate package bad')
+        self.queue.run([], ['a'], execute)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['0-other.failed', 'lock'])
+
+    def test_failed_request_runs_alone(self):
+        self.queue_request('0-other', os.getppid(), [], ['c'])
+        execute = mock.Mock()
+
+        def flock(fp, mode):
+            # The merged transaction failed in another process
+            for name in os.listdir(self.tmpdir):
+                if name.endswith('.request') and name != '0-other.request':
+                    path = os.path.join(self.tmpdir, name)
+                    os.rename(path, path[:-len('.request')] + '.failed')
+
+        with mock.patch('fcntl.flock', flock):
+            self.queue.run([], ['a'], execute)
+        execute.assert_called_once_with([], ['a'])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['0-other.request', 'lock'])
@@ -1,4 +1,10 @@
 import mock
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 
 from bundletester import builder
@@ -30,15 +36,144 @@ class TestBuilder(unittest.TestCase):
                          mock.call(['sudo', 'apt-add-repository',
                                     '--yes', 'ppa:foo']))
 
-    @mock.patch('subprocess.check_call')
-    def test_builder_packages(self, mcall):
+    def use_tmp_cache(self):
+        cache = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache)
+        patcher = mock.patch.dict(os.environ, {'BUNDLETESTER_CACHE': cache})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return cache
+
+    @mock.patch('bundletester.builder.missing_packages')
+    @mock.patch('bundletester.builder.Builder._run_apt_command')
+    def test_builder_packages(self, mcall, missing):
+        self.use_tmp_cache()
+        missing.side_effect = lambda packages: packages
         parser = config.Parser()
         b = builder.Builder(parser,  None)
         parser.packages.extend(['a', 'b'])
         b.install_packages()
         self.assertEqual(mcall.call_args,
                          mock.call(['sudo', 'apt-get', 'install', '-qq', '-y',
-                                    'a', 'b'], env=mock.ANY))
+                                    'a', 'b']))
+
+    @mock.patch('bundletester.builder.configured_sources')
+    @mock.patch('bundletester.builder.missing_packages')
+    @mock.patch('bundletester.builder.Builder._run_apt_command')
+    @mock.patch('subprocess.check_call')
+    def test_builder_system_packages_batched(self, mcall, mapt, missing,
+                                             configured):
+        self.use_tmp_cache()
+        configured.return_value = set([
+            'deb http://ppa.launchpad.net/juju/stable/ubuntu xenial main'])
+        missing.side_effect = lambda packages: [
+            p for p in packages if p != 'installed']
+        top = config.Parser(sources=['ppa:juju/stable'], packages=['a'])
+        charm = config.Parser(sources=['ppa:foo/bar'],
+                              packages=['installed', 'a', 'b'])
+        b = builder.Builder(top, None)
+        b.install_system_packages([top, charm])
+        self.assertEqual(mcall.call_args_list, [
+            mock.call(['sudo', 'apt-add-repository', '--yes',
+                       'ppa:foo/bar'])])
+        self.assertEqual(mapt.call_args_list, [
+            mock.call(['sudo', 'apt-get', 'update', '-qq']),
+            mock.call(['sudo', 'apt-get', 'install', '-qq', '-y', 'a', 'b']),
+        ])
+
+    @mock.patch('time.sleep')
+    @mock.patch('subprocess.Popen')
+    def test_run_apt_command_retries_lock_errors(self, popen, sleep):
+        def proc(output, returncode):
+            p = mock.Mock(returncode=returncode)
+            p.communicate.return_value = (output, None)
+            return p
+        popen.side_effect = [
+            proc('E: Could not get lock /var/lib/dpkg/lock - open\n', 100),
+            proc('E: Unable to lock the administration directory\n', 100),
+            proc('done\n', 0)]
+        b = builder.Builder(config.Parser(), None)
+        b._run_apt_command(['apt-get', 'update'])
+        self.assertEqual(popen.call_count, 3)
+        delays = [c[0][0] for c in sleep.call_args_list]
+        self.assertTrue(2.5 <= delays[0] <= 7.5)
+        self.assertTrue(5 <= delays[1] <= 15)
+
+    @mock.patch('time.sleep')
+    @mock.patch('subprocess.Popen')
+    def test_run_apt_command_other_errors_fail(self, popen, sleep):
+        popen.return_value.communicate.return_value = (
+            'E: Unable to locate package nope\n', None)
+        popen.return_value.returncode = 100
+        b = builder.Builder(config.Parser(), None)
+        self.assertRaises(subprocess.CalledProcessError,
+                          b._run_apt_command, ['apt-get', 'install', 'nope'])
+        self.assertFalse(sleep.called)
+
+    @mock.patch('bundletester.builder.missing_packages')
+    @mock.patch('subprocess.check_call')
+    def test_builder_system_packages_noop(self, mcall, missing):
+        missing.return_value = []
+        b = builder.Builder(config.Parser(packages=['a']), None)
+        b.install_system_packages([b.config])
+        self.assertFalse(mcall.called)
+
+    def test_source_configured(self):
+        configured = set([
+            'deb http://ppa.launchpad.net/juju/stable/ubuntu xenial main',
+            'deb http://ppa.launchpad.net/user/ppa/ubuntu xenial main',
+            'deb http://example.com/ubuntu xenial main'])
+        self.assertTrue(builder.source_configured('ppa:juju/stable',
+                                                  configured))
+        self.assertTrue(builder.source_configured('ppa:user', configured))
+        self.assertFalse(builder.source_configured('ppa:juju/devel',
+                                                   configured))
+        self.assertTrue(builder.source_configured(
+            'deb  http://example.com/ubuntu xenial main', configured))
+
+    @mock.patch('subprocess.Popen')
+    def test_missing_packages(self, popen):
+        popen.return_value.communicate.return_value = (
+            b'a install ok installed\nb deinstall ok config-files\n', None)
+        self.assertEqual(
+            builder.missing_packages(['a', 'b', 'c', 'a=1.0']),
+            ['b', 'c', 'a=1.0'])
+        self.assertEqual(popen.call_args[0][0][-3:], ['a', 'b', 'c'])
+
+    def make_wheelhouse_builder(self):
+        cache = self.use_tmp_cache()
+        parser = config.Parser(virtualenv=True, python_packages=['a'])
+        f = O()
+        f.wheelhouse = True
+        f.find_links = ['deps']
+        f.environment = None
+        f.testdir = cache
+        return builder.Builder(parser, f), os.path.join(cache, 'wheelhouse')
+
+    @mock.patch('subprocess.check_call')
+    @mock.patch('subprocess.call')
+    def test_builder_wheelhouse_warm(self, mcall, mcheck_call):
+        b, wheelhouse = self.make_wheelhouse_builder()
+        mcall.return_value = 0
+        b.install_python_packages()
+        self.assertEqual(mcall.call_args, mock.call(
+            ['pip', 'install', '-U', '--no-index', '--find-links',
+             wheelhouse, '--find-links', 'deps', 'a']))
+        self.assertFalse(mcheck_call.called)
+
+    @mock.patch('subprocess.check_call')
+    @mock.patch('subprocess.call')
+    def test_builder_wheelhouse_builds_missing(self, mcall, mcheck_call):
+        b, wheelhouse = self.make_wheelhouse_builder()
+        mcall.return_value = 1
+        b.install_python_packages('venv/bin/pip')
+        offline = ['venv/bin/pip', 'install', '-U', '--no-index',
+                   '--find-links', wheelhouse, '--find-links', 'deps', 'a']
+        self.assertEqual(mcheck_call.call_args_list, [
+            mock.call(['venv/bin/pip', 'wheel', '--wheel-dir', wheelhouse,
+                       '--find-links', wheelhouse, '--find-links', 'deps',
+                       'a']),
+            mock.call(offline)])
 
     @mock.patch('subprocess.call')
     def test_builder_bootstrap_dryrun(self, mcall):
@@ -49,3 +184,233 @@ class TestBuilder(unittest.TestCase):
         b = builder.Builder(parser, f)
         b.bootstrap()
         self.assertFalse(mcall.called)
+
+    def make_builder(self, applications):
+        parser = config.Parser()
+        f = O()
+        f.dryrun = False
+        f.environment = None
+        f.juju_major_version = 2
+        b = builder.Builder(parser, f)
+        b.environment = mock.Mock()
+        b.environment.status.side_effect = lambda: {
+            'applications': dict(applications)}
+        b.environment.get_config.return_value = {}
+        b.environment.client.get_watch.side_effect = NotImplementedError
+        return b
+
+    def test_reset_skipped_when_unchanged(self):
+        applications = {'mysql': {'charm': 'cs:mysql', 'units': {}}}
+
+        def reset(**kw):
+            applications.clear()
+        b = self.make_builder(applications)
+        b.environment.reset.side_effect = reset
+        b.reset()
+        self.assertEqual(b.environment.reset.call_count, 1)
+        b.reset()
+        self.assertEqual(b.environment.reset.call_count, 1)
+        applications['wordpress'] = {'charm': 'cs:wordpress'}
+        b.reset()
+        self.assertEqual(b.environment.reset.call_count, 2)
+
+    def test_partial_reset_removes_added(self):
+        applications = {'mysql': {'charm': 'cs:mysql', 'units': {}}}
+        b = self.make_builder(applications)
+        b.mark_baseline()
+        applications['wordpress'] = {'charm': 'cs:wordpress'}
+        b.environment.client.destroy_application.side_effect = \
+            applications.pop
+        b.reset(partial=True)
+        b.environment.client.destroy_application.assert_called_once_with(
+            'wordpress')
+        self.assertFalse(b.environment.reset.called)
+
+    def test_partial_reset_falls_back_to_full(self):
+        applications = {'mysql': {'charm': 'cs:mysql', 'units': {}}}
+
+        def reset(**kw):
+            applications.clear()
+        b = self.make_builder(applications)
+        b.environment.reset.side_effect = reset
+        b.mark_baseline()
+        applications['mysql'] = {'charm': 'cs:mysql', 'units': {'mysql/0': {}}}
+        b.reset(partial=True)
+        self.assertTrue(b.environment.reset.called)
+
+    def test_wait_for_removal_watches(self):
+        b = self.make_builder({'mysql': {}, 'wordpress': {}})
+        watch = mock.MagicMock()
+        watch.__iter__.return_value = iter([
+            [['application', 'change', {'name': 'mysql'}],
+             ['application', 'change', {'name': 'wordpress'}],
+             ['machine', 'change', {'id': '0'}]],
+            [['application', 'remove', {'name': 'wordpress'}]],
+            [['unit', 'remove', {'name': 'mysql/0'}],
+             ['application', 'remove', {'name': 'mysql'}]],
+            [['application', 'change', {'name': 'never-reached'}]],
+        ])
+        b.environment.client.get_watch.side_effect = None
+        b.environment.client.get_watch.return_value = watch
+        b._wait_for_removal()
+        self.assertTrue(watch.stop.called)
+        self.assertEqual(b.environment.status.call_count, 1)
+
+    def test_wait_for_removal_watches_names(self):
+        b = self.make_builder({'mysql': {}, 'wordpress': {}})
+        watch = mock.MagicMock()
+        watch.__iter__.return_value = iter([
+            [['service', 'change', {'Name': 'mysql'}],
+             ['service', 'change', {'Name': 'wordpress'}]],
+            [['service', 'remove', {'Name': 'wordpress'}]],
+        ])
+        b.environment.client.get_watch.side_effect = None
+        b.environment.client.get_watch.return_value = watch
+        b._wait_for_removal(['wordpress'])
+        self.assertEqual(b.environment.status.call_count, 1)
+
+    def make_blocked_watch(self, b, closed):
+        def deltas():
+            yield [['application', 'change', {'name': 'mysql'}]]
+            closed.wait(5)
+            raise IOError('Connection closed')
+        watch = mock.MagicMock()
+        watch.__iter__.return_value = deltas()
+        watch.conn.close.side_effect = closed.set
+        b.environment.client.get_watch.side_effect = None
+        b.environment.client.get_watch.return_value = watch
+        return watch
+
+    def test_wait_for_removal_watch_timeout(self):
+        b = self.make_builder({'mysql': {}})
+        b.config.reset_timeout = 0.2
+        self.make_blocked_watch(b, threading.Event())
+        start = time.time()
+        self.assertRaises(RuntimeError, b._wait_for_removal)
+        self.assertLess(time.time() - start, 2)
+
+    def test_wait_for_removal_empty_model(self):
+        # The watch of an empty model blocks, it is never started
+        b = self.make_builder({})
+        watch = self.make_blocked_watch(b, threading.Event())
+        b._wait_for_removal()
+        self.assertFalse(watch.__iter__.called)
+
+    def test_wait_for_removal_watch_expires_after_removal(self):
+        # Removed before the watch saw it, the last status check passes
+        applications = {'mysql': {}}
+        b = self.make_builder(applications)
+        b.config.reset_timeout = 0.2
+        closed = threading.Event()
+        self.make_blocked_watch(b, closed)
+        b.environment.client.get_watch.return_value.conn.close.side_effect \
+            = lambda: (applications.clear(), closed.set())
+        b._wait_for_removal()
+        self.assertEqual(b.environment.status.call_count, 2)
+
+    @mock.patch('time.sleep')
+    def test_wait_for_removal_polls_with_backoff(self, sleep):
+        statuses = [['mysql', 'wordpress']] * 4 + [['mysql'], []]
+        b = self.make_builder({})
+        b.environment.status.side_effect = lambda: {
+            'applications': dict.fromkeys(statuses.pop(0))}
+        b._wait_for_removal()
+        self.assertEqual([c[0][0] for c in sleep.call_args_list],
+                         [0.5, 1, 2, 4, 8])
+
+    def make_wait_builder(self, statuses):
+        b = self.make_builder({})
+        b.DEPLOYMENT_POLL = 0
+        b.environment.status.side_effect = lambda: {
+            'applications': statuses.pop(0) if len(statuses) > 1
+            else statuses[0]}
+        return b
+
+    def test_wait_for_deployment(self):
+        def unit(workload, agent, **extra):
+            d = {'workload-status': {'current': workload},
+                 'juju-status': {'current': agent}}
+            d.update(extra)
+            return d
+        statuses = [
+            {'mysql': {'units': {'mysql/0': unit('maintenance',
+                                                 'executing')}},
+             'wordpress': {'units': {'wordpress/0': unit('active', 'idle')}}},
+            {'mysql': {'units': {'mysql/0': unit(
+                'active', 'idle', subordinates={
+                    'nrpe/0': unit('waiting', 'executing')})}},
+             'wordpress': {'units': {'wordpress/0': unit('active', 'idle')}}},
+            {'mysql': {'units': {'mysql/0': unit('active', 'idle')}},
+             'nrpe': {},
+             'wordpress': {'units': {'wordpress/0': unit('active', 'idle')}}},
+        ]
+        b = self.make_wait_builder(statuses)
+        ready = b.wait_for_deployment(60)
+        self.assertEqual(sorted(ready), ['mysql', 'nrpe', 'wordpress'])
+        # Then idle for DEPLOYMENT_SETTLE polls
+        self.assertEqual(b.environment.status.call_count, 5)
+
+    def test_wait_for_deployment_idle_between_hooks(self):
+        def unit(workload, agent):
+            return {'units': {'mysql/0': {
+                'workload-status': {'current': workload},
+                'juju-status': {'current': agent}}}}
+        statuses = [
+            {'mysql': unit('active', 'idle')},
+            {'mysql': unit('maintenance', 'executing')},
+            {'mysql': unit('active', 'idle')},
+            {'mysql': unit('active', 'idle')},
+            {'mysql': unit('active', 'executing')},
+            {'mysql': unit('active', 'idle')},
+        ]
+        b = self.make_wait_builder(statuses)
+        b.wait_for_deployment(60)
+        self.assertEqual(b.environment.status.call_count, 8)
+
+    def test_wait_for_deployment_fails_fast(self):
+        # API status format
+        statuses = [{'mysql': {'units': {'mysql/0': {
+            'workload-status': {'status': 'error',
+                                'info': 'hook failed: "install"'},
+            'agent-status': {'status': 'idle'}}}}}]
+        b = self.make_wait_builder(statuses)
+        with self.assertRaises(builder.DeploymentError) as e:
+            b.wait_for_deployment(60)
+        self.assertIn('hook failed: "install"', str(e.exception))
+
+    def test_wait_for_deployment_blocked(self):
+        statuses = [{'mysql': {'units': {'mysql/0': {
+            'workload-status': {'current': 'blocked',
+                                'message': 'Missing relation'},
+            'juju-status': {'current': 'idle'}}}}}]
+        b = self.make_wait_builder(statuses)
+        with self.assertRaises(builder.DeploymentError) as e:
+            b.wait_for_deployment(60)
+        self.assertIn('mysql/0: Missing relation', str(e.exception))
+
+    def test_wait_for_deployment_blocked_until_related(self):
+        def unit(workload, agent):
+            return {'workload-status': {'current': workload,
+                                        'message': 'Missing relation'},
+                    'juju-status': {'current': agent}}
+        statuses = [
+            {'mysql': {'units': {'mysql/0': unit('active', 'executing')}},
+             'wordpress': {'units': {'wordpress/0': unit('blocked',
+                                                         'idle')}}},
+            {'mysql': {'units': {'mysql/0': unit('active', 'idle')}},
+             'wordpress': {'units': {'wordpress/0': unit('maintenance',
+                                                         'executing')}}},
+            {'mysql': {'units': {'mysql/0': unit('active', 'idle')}},
+             'wordpress': {'units': {'wordpress/0': unit('active', 'idle')}}},
+        ]
+        b = self.make_wait_builder(statuses)
+        ready = b.wait_for_deployment(60)
+        self.assertEqual(sorted(ready), ['mysql', 'wordpress'])
+        self.assertEqual(b.environment.status.call_count, 5)
+
+    def test_wait_for_deployment_timeout(self):
+        statuses = [{'mysql': {'units': {'mysql/0': {
+            'workload-status': {'current': 'maintenance'},
+            'juju-status': {'current': 'executing'}}}}}]
+        b = self.make_wait_builder(statuses)
+        self.assertRaises(builder.DeploymentError, b.wait_for_deployment, 0)
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import yaml
+from deployer.config import ConfigStack
+
+from bundletester import bundlefile
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+SAMPLES = {
+    'v4': 'series: trusty\nservices:\n  nats: {charm: cf-nats}\n',
+    'v3': 'base:\n  series: trusty\n  services:\n    nats: {}\n',
+    'charm config': 'options:\n  services:\n    default: 1\n'
+                    '    description: d\n    type: int\n',
+    'nested services': 'services:\n  services: {a: {}}\n',
+    'list': '- services\n- 1\n',
+    'scalar services': 'services: none\nother: [1, 2]\n',
+    'empty': '',
+    'alias': 'x: &s {nats: {}}\nservices: *s\n',
+    'merge': 'y:\n  <<: {services: {nats: {}}}\n',
+    'v3 then v4': 'base:\n  services: {a: {}}\nservices: {b: {}}\n',
+}
+
+
+class TestSniff(unittest.TestCase):
+
+    def sniff(self, text):
+        try:
+            return bundlefile.sniff(text)
+        except bundlefile._Undecided:
+            return 'undecided'
+
+    def test_agrees_with_classify(self):
+        for name, text in SAMPLES.items():
+            expected = bundlefile.classify(yaml.safe_load(text))
+            found = self.sniff(text)
+            if found != 'undecided':
+                self.assertEqual(found, expected, name)
+
+    def test_shapes(self):
+        self.assertEqual(self.sniff(SAMPLES['v4']), 4)
+        self.assertEqual(self.sniff(SAMPLES['v3']), 3)
+        self.assertEqual(self.sniff(SAMPLES['v3 then v4']), 4)
+        self.assertEqual(self.sniff(SAMPLES['charm config']), None)
+        self.assertEqual(self.sniff(SAMPLES['alias']), 'undecided')
+        self.assertEqual(self.sniff(SAMPLES['merge']), 'undecided')
+
+    def test_stops_early(self):
+        # Nothing after the services mapping is parsed
+        text = SAMPLES['v4'] + 'junk: [unclosed\n'
+        self.assertEqual(bundlefile.sniff(text), 4)
+        self.assertRaises(yaml.YAMLError, yaml.safe_load, text)
+
+
+class TestShape(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fp:
+            fp.write(text)
+        return path
+
+    def test_aliases_fall_back(self):
+        self.assertEqual(bundlefile.shape(self.write('a.yaml',
+                                                     SAMPLES['alias'])), 4)
+        self.assertEqual(bundlefile.shape(self.write('m.yaml',
+                                                     SAMPLES['merge'])), 3)
+
+    def test_cached_until_changed(self):
+        path = self.write('bundle.yaml', SAMPLES['v4'])
+        with mock.patch.object(bundlefile, 'sniff',
+                               wraps=bundlefile.sniff) as sniff:
+            self.assertEqual(bundlefile.shape(path), 4)
+            self.assertEqual(bundlefile.shape(path), 4)
+            self.assertEqual(sniff.call_count, 1)
+            self.write('bundle.yaml', SAMPLES['charm config'])
+            self.assertEqual(bundlefile.shape(path), None)
+            self.assertEqual(sniff.call_count, 2)
+
+
+class TestBundleStack(unittest.TestCase):
+
+    def test_same_as_deployer(self):
+        for name in ('bundle.yaml', 'bundle-v4.yaml'):
+            path = os.path.join(HERE, 'watcher', name)
+            ours, theirs = bundlefile.BundleStack([path]), ConfigStack([path])
+            self.assertEqual(ours.version, theirs.version)
+            self.assertEqual(ours.data, theirs.data)
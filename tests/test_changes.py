@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from bundletester import changes
+from bundletester import config
+from bundletester import models
+from bundletester import spec
+from bundletester import testplan
+
+
+class Options(object):
+    tests_yaml = None
+    exclude = None
+    skip_implicit = True
+    charm_staging = 'copy'
+
+    def __init__(self, baseline):
+        self.baseline = baseline
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.charm = os.path.join(self.tmpdir, 'mysql')
+        os.makedirs(os.path.join(self.charm, 'hooks'))
+        self.write('hooks/install', '#!/bin/sh\n')
+        self.write('metadata.yaml', 'name: mysql\n')
+
+    def write(self, name, content, root=None):
+        path = os.path.join(root or self.charm, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def test_same_content_same_fingerprint(self):
+        digest = changes.fingerprint(self.charm)
+        copy = os.path.join(self.tmpdir, 'copy')
+        shutil.copytree(self.charm, copy)
+        self.write('.git/HEAD', 'ref: refs/heads/master\n', copy)
+        self.write('hooks/install.pyc', 'junk', copy)
+        self.assertEqual(changes.fingerprint(copy), digest)
+
+    def test_changes(self):
+        digest = changes.fingerprint(self.charm)
+        os.chmod(os.path.join(self.charm, 'hooks', 'install'), 0o755)
+        chmodded = changes.fingerprint(self.charm)
+        self.assertNotEqual(chmodded, digest)
+        self.write('hooks/install', '#!/bin/bash\n')
+        self.assertNotEqual(changes.fingerprint(self.charm), chmodded)
+
+    def test_load_baseline(self):
+        report = self.write('results.json', json.dumps(
+            {'tests': [], 'charms': {'mysql': 'abc'}}), self.tmpdir)
+        self.assertEqual(changes.load_baseline(report), {'mysql': 'abc'})
+        history = mock.Mock()
+        history.charm_fingerprints.return_value = {'wp': 'def'}
+        self.assertEqual(changes.load_baseline('last', history),
+                         {'wp': 'def'})
+        history.charm_fingerprints.assert_called_once_with(None)
+        changes.load_baseline('1234', history)
+        history.charm_fingerprints.assert_called_with('1234')
+        self.assertEqual(changes.load_baseline('last'), {})
+
+
+def add_spec(suite):
+    suite.append(config.Parser(name='test', suite=suite))
+
+
+class TestSelection(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.charms = []
+        for name in ('mysql', 'wordpress'):
+            path = os.path.join(self.tmpdir, 'cache', name)
+            os.makedirs(path)
+            with open(os.path.join(path, 'metadata.yaml'), 'w') as fp:
+                fp.write('name: %s\n' % name)
+            charm = mock.Mock(path=path)
+            charm.name = name
+            self.charms.append(charm)
+        baseline = {
+            'mysql': changes.fingerprint(self.charms[0].path),
+            'wordpress': 'old',
+        }
+        self.suite = spec.Suite(models.Bundle({'directory': self.tmpdir,
+                                               'testdir': None,
+                                               'bundle': None}),
+                                Options(baseline))
+        self.suite._config = config.Parser()
+
+    def test_unchanged_charms_skipped(self):
+        with mock.patch.object(spec.Suite, 'find_tests', add_spec):
+            suites = self.suite.charm_suites(self.charms)
+        self.assertEqual([len(s) for s in suites], [0, 1])
+        self.assertEqual(self.suite.unchanged, set(['mysql']))
+        self.assertEqual(sorted(self.suite.charm_fingerprints),
+                         ['mysql', 'wordpress'])
+
+    def test_passed(self):
+        with mock.patch.object(spec.Suite, 'find_tests', add_spec):
+            suites = self.suite.charm_suites(self.charms)
+        self.suite.insert(0, suites[1])
+        plan = testplan.TestPlan(self.suite)
+        # Unchanged charms carry over, untested ones don't
+        self.assertEqual(changes.passed(self.suite, plan), {
+            'mysql': self.suite.charm_fingerprints['mysql']})
+        plan.add_result({'suite': 'wordpress', 'returncode': 0})
+        self.assertEqual(changes.passed(self.suite, plan),
+                         self.suite.charm_fingerprints)
+        plan.add_result({'suite': 'wordpress', 'returncode': 1})
+        self.assertNotIn('wordpress', changes.passed(self.suite, plan))
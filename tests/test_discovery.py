@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from bundletester import discovery
+from bundletester import models
+from bundletester import spec
+
+
+class Options(object):
+    tests = None
+    tests_yaml = None
+    test_pattern = None
+    skip_implicit = True
+    exclude = None
+    juju_major_version = 2
+    no_matrix = False
+    environment = None
+    deployment = None
+    order = 'name'
+
+    def __init__(self, cache):
+        self.discovery_store = cache
+
+
+class TestDiscoveryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        os.mkdir(os.path.join(self.tmpdir, 'cache'))
+        self.cache = discovery.DiscoveryCache(
+            os.path.join(self.tmpdir, 'cache'))
+        self.options = Options(self.cache)
+        self.charm = self.make_charm('run1')
+
+    def make_charm(self, name):
+        directory = os.path.join(self.tmpdir, name, 'charm')
+        os.makedirs(os.path.join(directory, 'tests'))
+        self.write(directory, 'tests.yaml', 'packages: [tree]\n')
+        for test in ('test01', 'test02'):
+            self.write(directory, test, '#!/bin/sh\n', 0o755)
+        self.write(directory, 'test02.yaml', 'setup: [setup02]\n')
+        return directory
+
+    def write(self, directory, name, content, mode=0o644):
+        path = os.path.join(directory, 'tests', name)
+        with open(path, 'w') as fp:
+            fp.write(content)
+        os.chmod(path, mode)
+
+    def find(self, directory):
+        model = models.Charm({
+            'name': 'charm',
+            'directory': directory,
+            'testdir': os.path.join(directory, 'tests'),
+        })
+        suite = spec.Suite(model, self.options)
+        suite.find_suite()
+        return suite
+
+    def assertFound(self, suite, directory):
+        self.assertEqual([t.name for t in suite], ['test01', 'test02'])
+        self.assertEqual(suite[0].executable,
+                         [os.path.join(directory, 'tests', 'test01')])
+        self.assertEqual(suite[1].dirname, directory)
+        self.assertEqual(suite[1].setup, ['setup02'])
+        self.assertEqual(suite[1].packages, ['tree'])
+        self.assertIs(suite[1]['suite'], suite)
+
+    def test_round_trip(self):
+        self.assertFound(self.find(self.charm), self.charm)
+        # The same charm fetched to another directory by a later run
+        other = os.path.join(self.tmpdir, 'run2', 'charm')
+        shutil.copytree(self.charm, other)
+        with mock.patch.object(spec.Suite, 'find_own_tests') as find:
+            suite = self.find(other)
+        self.assertFalse(find.called)
+        self.assertFound(suite, other)
+
+    def test_invalidated(self):
+        self.find(self.charm)
+        self.write(self.charm, 'test02.yaml', 'setup: [other]\n')
+        self.assertEqual(self.find(self.charm)[1].setup, ['other'])
+        self.write(self.charm, 'test03', '#!/bin/sh\n', 0o755)
+        self.assertEqual([t.name for t in self.find(self.charm)],
+                         ['test01', 'test02', 'test03'])
+        os.chmod(os.path.join(self.charm, 'tests', 'test03'), 0o644)
+        self.assertEqual([t.name for t in self.find(self.charm)],
+                         ['test01', 'test02'])
+
+    def test_options_invalidate(self):
+        self.find(self.charm)
+        self.options.tests = ['test02']
+        self.assertEqual([t.name for t in self.find(self.charm)],
+                         ['test02'])
+
+    def test_prune(self):
+        with mock.patch.object(discovery, 'MAX_ENTRIES', 1):
+            self.find(self.charm)
+            self.options.tests = ['test02']
+            self.find(self.charm)
+        self.assertEqual(len(os.listdir(self.cache.path)), 1)
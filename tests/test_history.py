@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from bundletester import history
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.history = history.History(os.path.join(self.tmpdir, 'h.db'))
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_durations(self):
+        self.history.record('suite::a', 1, 10, 1)
+        self.history.record('suite::a', 1, 20, None)
+        self.history.record('suite::b', None, 5, None)
+        self.assertEqual(self.history.durations(),
+                         {'suite::a': 16.5, 'suite::b': 5})
+
+    def test_durations_recent_runs(self):
+        self.history.record('suite::a', 0, 100, 0)
+        for _ in range(history.RECENT_RUNS):
+            self.history.record('suite::a', 0, 10, 0)
+        self.assertEqual(self.history.durations(), {'suite::a': 10})
+
+    def test_persisted(self):
+        self.history.record('suite::a', 0, 3, 0)
+        self.history.close()
+        self.history = history.History(self.history.path)
+        self.assertEqual(self.history.durations(), {'suite::a': 3})
+
+    def test_charm_fingerprints(self):
+        self.assertEqual(self.history.charm_fingerprints(), {})
+        with mock.patch('time.time', return_value=1):
+            self.history.record_charms('rev1', {'mysql': 'a', 'wp': 'b'})
+        with mock.patch('time.time', return_value=2):
+            self.history.record_charms('rev2', {'mysql': 'c'})
+        self.assertEqual(self.history.charm_fingerprints(), {'mysql': 'c'})
+        self.assertEqual(self.history.charm_fingerprints('rev1'),
+                         {'mysql': 'a', 'wp': 'b'})
+        self.assertEqual(self.history.charm_fingerprints('rev3'), {})
+
+    def test_scoped(self):
+        self.history.record('bundle::a', 0, 3, 0)
+        self.history.record_charms('rev1', {'mysql': 'a'})
+        other = history.History(self.history.path, scope='cs:bundle/other')
+        self.addCleanup(other.close)
+        self.assertEqual(other.durations(), {})
+        self.assertEqual(other.charm_fingerprints(), {})
+        other.record('bundle::a', 0, 10, 0)
+        self.assertEqual(self.history.durations(), {'bundle::a': 3})
+
+    def test_pruned(self):
+        for _ in range(history.RECENT_RUNS + 3):
+            self.history.record('suite::a', 0, 1, 0)
+        with mock.patch('time.time', return_value=0):
+            self.history.record('suite::old', 0, 1, 0)
+        self.history.close()
+        self.history = history.History(self.history.path)
+        self.assertEqual(self.history.durations(), {'suite::a': 1})
+        count = self.history._db.execute(
+            'SELECT COUNT(*) FROM test_durations').fetchone()[0]
+        self.assertEqual(count, history.RECENT_RUNS)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import textwrap
+import unittest
+
+import mock
+
+from bundletester import makefile
+
+
+class TestMakefile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, text, name='Makefile'):
+        with open(os.path.join(self.tmpdir, name), 'w') as fp:
+            fp.write(textwrap.dedent(text))
+
+    def test_parse(self):
+        targets, computed = makefile.parse(textwrap.dedent("""
+            PYTHON := python3
+            FLAGS ?= -v
+            .PHONY: lint test
+            all: lint \\
+                test
+            lint:
+            \t@flake8 hooks: unit_tests
+            test unit_test:: lint
+            %.o: %.c
+            define RECIPE
+            fake: target
+            endef
+            """))
+        self.assertEqual(targets, set(['all', 'lint', 'test', 'unit_test']))
+        self.assertFalse(computed)
+
+    def test_parse_computed(self):
+        self.assertTrue(makefile.parse('$(NAME)-test: lint\n')[1])
+
+    def test_parse_database(self):
+        output = textwrap.dedent("""
+            # Files
+
+            # Not a target:
+            Makefile:
+            #  Implicit rule search has been done.
+
+            lint: build
+            #  Phony target (prerequisite of .PHONY).
+
+            .PHONY: lint
+            """)
+        self.assertEqual(makefile.parse_database(output), set(['lint']))
+
+    def test_targets(self):
+        self.assertEqual(makefile.targets(self.tmpdir), frozenset())
+        self.write('lint:\n\ttrue\n')
+        self.assertEqual(makefile.targets(self.tmpdir), frozenset(['lint']))
+        with mock.patch('bundletester.makefile.parse') as parse:
+            self.assertEqual(makefile.targets(self.tmpdir),
+                             frozenset(['lint']))
+            self.assertFalse(parse.called)
+
+    @mock.patch('bundletester.makefile._database')
+    def test_targets_include(self, database):
+        database.return_value = set(['test'])
+        self.write('include common.mk\nlint:\n', name='GNUmakefile')
+        self.assertEqual(makefile.targets(self.tmpdir), frozenset(['test']))
+        database.assert_called_once_with(self.tmpdir)
@@ -0,0 +1,94 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import mock
+
+from bundletester import probe
+
+
+class TestProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        self.counter = os.path.join(self.tmpdir, 'runs')
+        self.tool = os.path.join(bindir, 'tool')
+        self.write_tool('1.0')
+        patcher = mock.patch.dict(os.environ, {
+            'BUNDLETESTER_CACHE': os.path.join(self.tmpdir, 'cache'),
+            'PATH': bindir + os.pathsep + os.environ['PATH']})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        probe.reset()
+        self.addCleanup(probe.reset)
+
+    def write_tool(self, version):
+        with open(self.tool, 'w') as fp:
+            fp.write('#!/bin/sh\necho x >> %s\necho %s\n' % (
+                self.counter, version))
+        os.chmod(self.tool, stat.S_IRWXU)
+
+    def runs(self):
+        with open(self.counter) as fp:
+            return len(fp.readlines())
+
+    def test_which(self):
+        self.assertEqual(probe.which('tool'), self.tool)
+        self.assertIsNone(probe.which('no-such-tool'))
+
+    def test_check_output_cached(self):
+        self.assertEqual(probe.check_output(['tool', 'version']), '1.0\n')
+        self.assertEqual(probe.check_output(['tool', 'version']), '1.0\n')
+        probe.reset()
+        # From the cache file
+        self.assertEqual(probe.check_output(['tool', 'version']), '1.0\n')
+        self.assertEqual(self.runs(), 1)
+
+    def test_check_output_binary_changed(self):
+        probe.check_output(['tool', 'version'])
+        probe.reset()
+        self.write_tool('2.0.0')
+        self.assertEqual(probe.check_output(['tool', 'version']),
+                         '2.0.0\n')
+        self.assertEqual(self.runs(), 2)
+
+    def test_check_output_missing(self):
+        self.assertRaises(OSError, probe.check_output, ['no-such-tool'])
+
+    def test_check_output_snap_refreshed(self):
+        wrapper = os.path.join(self.tmpdir, 'wrapper', 'snap')
+        os.makedirs(os.path.dirname(wrapper))
+        os.rename(self.tool, wrapper)
+        os.symlink(wrapper, self.tool)
+        snap_dir = os.path.join(self.tmpdir, 'snaps')
+        os.makedirs(os.path.join(snap_dir, 'tool', '10'))
+        current = os.path.join(snap_dir, 'tool', 'current')
+        os.symlink('10', current)
+        with mock.patch.object(probe, 'SNAP_DIR', snap_dir):
+            self.assertEqual(probe.check_output(['tool', 'version']),
+                             '1.0\n')
+            probe.reset()
+            probe.check_output(['tool', 'version'])
+            self.assertEqual(self.runs(), 1)
+            # snap refresh: the wrapper is the same, the revision isn't
+            os.remove(current)
+            os.mkdir(os.path.join(snap_dir, 'tool', '11'))
+            os.symlink('11', current)
+            probe.reset()
+            probe.check_output(['tool', 'version'])
+            self.assertEqual(self.runs(), 2)
+
+    def test_check_output_wrapper_not_kept(self):
+        wrapper = os.path.join(self.tmpdir, 'wrapper', 'multi')
+        os.makedirs(os.path.dirname(wrapper))
+        os.rename(self.tool, wrapper)
+        os.symlink(wrapper, self.tool)
+        probe.check_output(['tool', 'version'])
+        probe.reset()
+        probe.check_output(['tool', 'version'])
+        self.assertEqual(self.runs(), 2)
@@ -0,0 +1,79 @@
+import threading
+import time
+import unittest
+
+from bundletester import process
+from bundletester.utils import OutputCapture
+
+
+class TestEngine(unittest.TestCase):
+
+    def test_run(self):
+        output = OutputCapture()
+        p = process.run(['sh', '-c', 'echo out; echo err >&2; exit 3'],
+                        output)
+        self.assertEqual(p.returncode, 3)
+        self.assertEqual(output.getvalue(), 'out\nerr\n')
+
+    def test_multiplex(self):
+        engine = process.Engine()
+        slow = engine.start(process.Process(
+            ['sh', '-c', 'sleep 0.4; echo slow'], OutputCapture()))
+        fast = engine.start(process.Process(
+            ['sh', '-c', 'echo fast'], OutputCapture()))
+        start = time.time()
+        self.assertEqual(list(engine), [fast, slow])
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(slow.output.getvalue(), 'slow\n')
+        self.assertEqual(fast.output.getvalue(), 'fast\n')
+
+    def test_timeout_kills_group(self):
+        output = OutputCapture()
+        start = time.time()
+        p = process.run(['sh', '-c', 'sleep 30 & sleep 30'], output,
+                        timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(p.returncode, process.TIMEOUT)
+        self.assertIn('timeout of 0.5s exceeded', output.getvalue())
+
+    def test_timeout_after_output_closed(self):
+        output = OutputCapture()
+        start = time.time()
+        p = process.run(['sh', '-c', 'exec >/dev/null 2>&1; sleep 8'],
+                        output, timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(p.returncode, process.TIMEOUT)
+        self.assertIn('timeout of 0.5s exceeded', output.getvalue())
+
+    def test_abandoned_engine_kills(self):
+        engine = process.Engine()
+        p = engine.start(process.Process(['sleep', '30'], OutputCapture()))
+        engine.start(process.Process(['true'], OutputCapture()))
+        it = iter(engine)
+        next(it)
+        it.close()
+        self.assertEqual(engine.running, [])
+        self.assertIsNotNone(p.popen.poll())
+
+    def test_wait_shared(self):
+        engine = process.Engine()
+        outputs = {}
+
+        def run(seconds):
+            p = engine.start(process.Process(
+                ['sh', '-c', 'sleep %s; echo %s' % (seconds, seconds)],
+                OutputCapture()))
+            engine.wait(p)
+            outputs[seconds] = (p.returncode, p.output.getvalue())
+        threads = [threading.Thread(target=run, args=(s,))
+                   for s in (0.2, 0.6, 0.4)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Each thread's process completed, whoever drove the loop
+        self.assertLess(time.time() - start, 1.1)
+        self.assertEqual(outputs, {0.2: (0, '0.2\n'), 0.6: (0, '0.6\n'),
+                                   0.4: (0, '0.4\n')})
+        self.assertEqual(engine.running, [])
@@ -1,5 +1,8 @@
 import json
 import mock
+import os
+import re
+import tempfile
 import unittest
 from StringIO import StringIO
 from xml.etree import ElementTree
@@ -7,6 +10,11 @@ from xml.etree import ElementTree
 from bundletester import reporter
 
 
+def reporter_text(buf):
+    """Return the output of a reporter without terminal formatting."""
+    return re.sub(r'\x1b[^m]*m', '', buf.getvalue())
+
+
 class TestReporter(unittest.TestCase):
     def make_sample(self, exit=0, output=""):
         return {'returncode': exit,
@@ -24,12 +32,28 @@ class TestReporter(unittest.TestCase):
         output = buf.getvalue()
         self.assertTrue(output.endswith('.'))
 
+    def test_dot_reporter_timeout(self):
+        buf = StringIO()
+        r = reporter.DotReporter(fp=buf)
+        failed = self.make_sample(124)
+        failed['exit'] = 'test02'
+        r.emit(failed)
+        timed_out = dict(failed, timeout='test')
+        r.emit(timed_out)
+        self.assertTrue(buf.getvalue().endswith('FT'))
+        r.summary()
+        self.assertIn('TIMEOUT: 1', reporter_text(buf))
+        self.assertIn('FAIL: 1', reporter_text(buf))
+
     def get_report_output(self, report_type):
         buf = StringIO()
         opts = mock.Mock()
         opts.fetcher.get_revision.return_value = '1'
         opts.testdir = '/tmp/test'
         opts.bundle = False
+        opts.shard = None
+        opts.deployment_ready = None
+        opts.charms = None
         if report_type == "JSON":
             r = reporter.JSONReporter(fp=buf, options=opts)
         elif report_type == "XML":
@@ -57,3 +81,60 @@ class TestReporter(unittest.TestCase):
         self.assertEqual(tree.findall('testsuite')[0]
                          .findall("testcase")[1]
                          .find('error').attrib['message'], "Unknown")
+
+    def test_xml_reporter_timeout(self):
+        buf = StringIO()
+        opts = mock.Mock()
+        opts.fetcher.get_revision.return_value = '1'
+        opts.testdir = '/tmp/test'
+        r = reporter.XMLReporter(fp=buf, options=opts)
+        sample = self.make_sample(124)
+        sample['timeout'] = 'test'
+        r.emit(sample)
+        r.summary()
+        error = ElementTree.fromstring(buf.getvalue()).find(
+            'testsuite/testcase/error')
+        self.assertEqual(error.attrib['type'], 'TIMEOUT')
+        self.assertEqual(error.attrib['message'], 'Timeout in test phase')
+
+    def test_json_reporter_reads_output_file(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('complete output')
+        buf = StringIO()
+        opts = mock.Mock()
+        opts.fetcher.get_revision.return_value = '1'
+        opts.testdir = '/tmp/test'
+        opts.bundle = False
+        opts.shard = None
+        opts.deployment_ready = None
+        opts.charms = None
+        r = reporter.JSONReporter(fp=buf, options=opts)
+        sample = self.make_sample(1, output='output')
+        sample['output_file'] = path
+        r.emit(sample)
+        r.summary()
+        result = json.loads(buf.getvalue())
+        self.assertEqual(result['tests'][0]['output'], 'complete output')
+        self.assertEqual(r.messages[0]['output'], 'output')
+
+    def test_json_reporter_shard(self):
+        buf = StringIO()
+        opts = mock.Mock()
+        opts.fetcher.get_revision.return_value = '1'
+        opts.testdir = '/tmp/test'
+        opts.bundle = False
+        opts.shard = (1, 2)
+        opts.shard_plan = ['suite01::test02']
+        opts.deployment = 'wiki'
+        opts.deployment_ready = {'mysql': 12.5}
+        opts.charms = {'mysql': 'abc'}
+        r = reporter.JSONReporter(fp=buf, options=opts)
+        r.emit(self.make_sample())
+        r.summary()
+        result = json.loads(buf.getvalue())
+        self.assertEqual(result['shard'], {'index': 1, 'count': 2,
+                                           'plan': ['suite01::test02']})
+        self.assertEqual(result['deployment'], {'ready': {'mysql': 12.5}})
+        self.assertEqual(result['charms'], {'mysql': 'abc'})
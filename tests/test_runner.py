@@ -1,10 +1,16 @@
 import os
 import pkg_resources
 import logging
+import shutil
+import tempfile
+import time
 import unittest
 
+import mock
+
 from bundletester import config
 from bundletester import models
+from bundletester import process
 from bundletester import spec
 from bundletester import runner
 
@@ -50,3 +56,323 @@ class TestRunner(unittest.TestCase):
         results = list(run())
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0]['returncode'], 0)
+
+    def make_parallel_suite(self, tmpdir, sleeps):
+        options = O()
+        options.dryrun = False
+        options.environment = 'local'
+        options.failfast = True
+        options.tests_yaml = None
+        options.juju_major_version = 2
+        options.jobs = len(sleeps)
+        model = models.TestDir({'name': 'testdir',
+                                'directory': tmpdir,
+                                'testdir': tmpdir})
+        suite = spec.Suite(model, options=options)
+        suite._config = config.Parser(reset=False, parallel=True)
+        for i, (seconds, code) in enumerate(sleeps):
+            path = os.path.join(tmpdir, 'test%02d' % i)
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\nsleep %s\nexit %s\n' % (seconds, code))
+            os.chmod(path, 0o755)
+            suite.spec(path, dirname=tmpdir)
+        return suite, options
+
+    def test_run_parallel_ordered(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        suite, options = self.make_parallel_suite(
+            tmpdir, [(0.6, 0), (0.1, 0), (0.3, 0)])
+        run = runner.Runner(suite, options)
+
+        start = time.time()
+        results = list(run._run_suite(suite))
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual([r['test'] for r in results],
+                         ['test00', 'test01', 'test02'])
+
+    def test_run_parallel_failfast_cancels(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        suite, options = self.make_parallel_suite(
+            tmpdir, [(0, 1), (5, 0), (5, 0)])
+        run = runner.Runner(suite, options)
+        run.build = lambda: None
+        run.builder.bootstrap = lambda: None
+
+        start = time.time()
+        results = list(run())
+        self.assertLess(time.time() - start, 4.0)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['returncode'], 1)
+
+    def test_cancel_spares_teardown(self):
+        options = O()
+        options.dryrun = False
+        run = runner.Runner(None, options)
+        run.cancel()
+        start = time.time()
+        ec, output, _, _ = run._run(
+            ['sh', '-c', 'sleep 0.3; echo done'], None, cancellable=False)
+        self.assertGreater(time.time() - start, 0.3)
+        self.assertEqual(ec, 0)
+        self.assertIn('done', output)
+        ec, _, _, _ = run._run(['sleep', '30'], None)
+        self.assertNotEqual(ec, 0)
+
+    def test_reset_is_barrier(self):
+        options = O()
+        options.jobs = 4
+        run = runner.Runner(None, options)
+        specs = [
+            config.Parser(parallel=True, reset=False),
+            config.Parser(parallel=True, reset=False),
+            config.Parser(parallel=True, reset=True),
+            config.Parser(parallel=True, reset=False),
+            config.Parser(parallel='other', reset=False),
+        ]
+        self.assertEqual([len(b) for b in run._batches(specs)],
+                         [2, 1, 1, 1])
+
+    def test_run_timeout_kills_group(self):
+        options = O()
+        options.dryrun = False
+        run = runner.Runner(None, options)
+        start = time.time()
+        ec, output, _, timed_out = run._run(
+            ['sh', '-c', 'sleep 30 & sleep 30'], None, timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(ec, process.TIMEOUT)
+        self.assertTrue(timed_out)
+        self.assertIn('timeout of 0.5s exceeded', output)
+
+    def test_run_idle_timeout(self):
+        options = O()
+        options.dryrun = False
+        run = runner.Runner(None, options)
+        ec, output, _, _ = run._run(
+            ['sh', '-c', 'echo one; sleep 0.1; echo two; sleep 30'],
+            None, idle_timeout=0.5)
+        self.assertEqual(ec, process.TIMEOUT)
+        self.assertTrue(output.startswith('one\ntwo\n'))
+        self.assertIn('no output for 0.5s', output)
+
+    def test_run_records_timeout_phase(self):
+        options = O()
+        options.dryrun = False
+        options.timeout = 0.5
+        options.tests_yaml = None
+        model = models.TestDir({'name': 'testdir',
+                                'directory': TEST_FILES,
+                                'testdir': TEST_FILES})
+        suite = spec.Suite(model, options=options)
+        suite._config = config.Parser()
+        suite.spec(['sleep', '30'], dirname=TEST_FILES)
+        run = runner.Runner(suite, options)
+        result = run.run(suite[0])
+        self.assertEqual(result['returncode'], process.TIMEOUT)
+        self.assertEqual(result['timeout'], 'test')
+
+    def test_run_exit_124_not_timeout(self):
+        options = O()
+        options.dryrun = False
+        options.tests_yaml = None
+        model = models.TestDir({'name': 'testdir',
+                                'directory': TEST_FILES,
+                                'testdir': TEST_FILES})
+        suite = spec.Suite(model, options=options)
+        suite._config = config.Parser()
+        suite.spec(['sh', '-c', 'exit 124'], dirname=TEST_FILES)
+        run = runner.Runner(suite, options)
+        result = run.run(suite[0])
+        self.assertEqual(result['returncode'], 124)
+        self.assertNotIn('timeout', result)
+
+    def test_run_records_history(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        suite, options = self.make_parallel_suite(tmpdir, [(0, 0)])
+        suite._config = config.Parser(reset=False)
+        options.history_db = mock.Mock()
+        run = runner.Runner(suite, options)
+        result = run._run_test(suite[0], chdir=False)
+        self.assertEqual(result['returncode'], 0)
+        options.history_db.record.assert_called_once_with(
+            'testdir::test00', None, result['duration'], None)
+
+    def test_wait_for_deployment_native_failure(self):
+        options = O()
+        options.dryrun = False
+        suite = mock.Mock()
+        suite.config = config.Parser()
+        suite.deployment_timeout.return_value = 60
+        run = runner.Runner(suite, options)
+        run._builder = mock.Mock()
+        run._builder.wait_for_deployment.side_effect = \
+            runner.builder.DeploymentError('mysql/0 is in error: boom')
+        with self.assertRaises(runner.DeployError) as e:
+            run.wait_for_deployment(['juju-wait'])
+        self.assertEqual(e.exception.result['returncode'], 1)
+        self.assertEqual(e.exception.result['output'],
+                         'mysql/0 is in error: boom')
+        run._builder.wait_for_deployment.assert_called_once_with(60)
+
+    def test_wait_for_deployment_native_keeps_option(self):
+        options = O()
+        options.dryrun = False
+        options.deployment = 'wiki'
+        suite = mock.Mock()
+        suite.config = config.Parser()
+        suite.deployment_timeout.return_value = 60
+        run = runner.Runner(suite, options)
+        run._builder = mock.Mock()
+        run._builder.wait_for_deployment.return_value = {'mysql': 12.5}
+        run.wait_for_deployment(['juju-wait'])
+        self.assertEqual(options.deployment, 'wiki')
+        self.assertEqual(options.deployment_ready, {'mysql': 12.5})
+
+    @mock.patch('subprocess.check_output')
+    def test_wait_for_deployment_juju_wait(self, check_output):
+        options = O()
+        options.dryrun = False
+        suite = mock.Mock()
+        suite.config = config.Parser(deployment_wait='juju-wait')
+        run = runner.Runner(suite, options)
+        run._builder = mock.Mock()
+        run.wait_for_deployment(['juju-wait'])
+        check_output.assert_called_once_with(['juju-wait'])
+        self.assertFalse(run._builder.wait_for_deployment.called)
+
+    def test_run_log_dir(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        options = O()
+        options.dryrun = False
+        options.log_dir = tmpdir
+        run = runner.Runner(None, options)
+        ec, output, path, _ = run._run(['echo', 'hello'], None,
+                                       name='a test')
+        self.assertEqual(ec, 0)
+        self.assertEqual(output, 'hello\n')
+        self.assertEqual(path, os.path.join(tmpdir, '001-a_test.log'))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'hello\n')
+
+    def test_run_streamed(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        top, options = self.make_parallel_suite(tmpdir, [(0, 0)])
+        options.jobs = 1
+        top._config = config.Parser(reset=False)
+        charms = []
+        for name, tests in (('charm', 2), ('other', 1)):
+            charm, _ = self.make_parallel_suite(tmpdir, [(0, 0)] * tests)
+            charm.name = name
+            charm._config = config.Parser(reset=False)
+            charms.append(charm)
+        top.pending = iter([(charms[0], None), (None, 'bad: broken'),
+                            (charms[1], None)])
+        run = runner.Runner(top, options)
+        run._builder = mock.Mock()
+        self.assertEqual(len(run.plan), 1)
+
+        results = list(run._run_streamed(top))
+        self.assertEqual([(r['suite'], r['test']) for r in results], [
+            ('charm', 'test00'), ('charm', 'test01'),
+            ('bundletester', 'discovery'), ('other', 'test00'),
+            ('testdir', 'test00')])
+        # The tree and the plan are in run order
+        self.assertEqual(run.plan.ids(), [
+            'charm::test00', 'charm::test01', 'other::test00',
+            'testdir::test00'])
+        self.assertEqual(top[:2], charms)
+        self.assertIsNone(top.pending)
+        self.assertEqual(run._builder.install_system_packages.call_args_list,
+                         [mock.call([charms[0].config]),
+                          mock.call([charms[1].config])])
+
+    def test_run_streamed_stopped(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        top, options = self.make_parallel_suite(tmpdir, [(0, 0)])
+        closed = []
+
+        def pending():
+            try:
+                yield None, 'bad: broken'
+                yield None, 'worse: broken'
+            finally:
+                closed.append(True)
+        top.pending = pending()
+        run = runner.Runner(top, options)
+        results = run._run_streamed(top)
+        next(results)
+        results.close()
+        self.assertEqual(closed, [True])
+
+    @mock.patch('os.chdir')
+    def test_run_streamed_leaves_cwd(self, chdir):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        top, options = self.make_parallel_suite(tmpdir, [(0, 0)])
+        options.jobs = 1
+        top._config = config.Parser(reset=False)
+        charm, _ = self.make_parallel_suite(tmpdir, [(0, 0)])
+        charm.name = 'charm'
+        charm._config = config.Parser(reset=False)
+
+        def pending():
+            yield charm, None
+            # Still discovering while the charm's tests run
+            self.assertFalse(chdir.called)
+        top.pending = pending()
+        run = runner.Runner(top, options)
+        run._builder = mock.Mock()
+        results = list(run._run_streamed(top))
+        self.assertEqual(len(results), 2)
+        # The suite's own tests run once discovery is done
+        chdir.assert_any_call(tmpdir)
+
+    @mock.patch('bundletester.builder.Builder.bootstrap')
+    def test_run_pooled(self, bootstrap):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        options = O()
+        options.dryrun = False
+        options.failfast = True
+        options.tests_yaml = None
+        options.juju_major_version = 2
+        options.environment = 'c:primary'
+        options.environments = ['c:primary', 'c:spare1', 'c:spare2']
+
+        def make_suite(name):
+            model = models.TestDir({'name': name,
+                                    'directory': tmpdir,
+                                    'testdir': tmpdir})
+            suite = spec.Suite(model, options=options)
+            suite._config = config.Parser(reset=False)
+            return suite
+
+        path = os.path.join(tmpdir, 'test')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nsleep 0.5\necho ${JUJU_MODEL:-unset}\n')
+        os.chmod(path, 0o755)
+        top = make_suite('bundle')
+        for name in ('charm1', 'charm2'):
+            charm_suite = make_suite(name)
+            charm_suite.spec(path, dirname=tmpdir)
+            top.append(charm_suite)
+        top.spec(path, dirname=tmpdir)
+
+        run = runner.Runner(top, options)
+        start = time.time()
+        with mock.patch.dict(os.environ):
+            os.environ.pop('JUJU_MODEL', None)
+            results = list(run._run_pooled(top, options.environments))
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual([r['suite'] for r in results],
+                         ['charm1', 'charm2', 'bundle'])
+        self.assertEqual(
+            sorted(r['output'].strip() for r in results[:2]),
+            ['c:spare1', 'c:spare2'])
+        self.assertEqual(results[2]['output'].strip(), 'unset')
@@ -0,0 +1,79 @@
+import argparse
+import unittest
+
+from bundletester import config
+from bundletester import models
+from bundletester import shard
+from bundletester import spec
+from bundletester.testplan import TestPlan
+
+
+class Options(object):
+    tests_yaml = None
+
+
+def make_suite(name, tests):
+    suite = spec.Suite(models.TestDir({'name': name,
+                                       'directory': '/tmp',
+                                       'testdir': '/tmp'}),
+                       Options())
+    suite._config = config.Parser()
+    for test in tests:
+        suite.append(config.Parser(name=test, suite=suite))
+    return suite
+
+
+class TestShard(unittest.TestCase):
+
+    def test_parse_shard(self):
+        self.assertEqual(shard.parse_shard('2/3'), (2, 3))
+        self.assertRaises(argparse.ArgumentTypeError,
+                          shard.parse_shard, '0/3')
+        self.assertRaises(argparse.ArgumentTypeError,
+                          shard.parse_shard, 'two')
+
+    def test_assign_by_hash_is_stable(self):
+        ids = ['s::test%s' % i for i in range(20)]
+        shards = shard.assign(ids, 3)
+        self.assertEqual(shards, shard.assign(list(reversed(ids)), 3))
+        self.assertEqual(set(shards.values()), set([1, 2, 3]))
+
+    def test_assign_by_duration(self):
+        durations = {'s::a': 40, 's::b': 30, 's::c': 20, 's::d': 10}
+        shards = shard.assign(sorted(durations) + ['s::e'], 2, durations)
+        # s::e has no history so counts as the mean, 25
+        self.assertEqual(shards, {'s::a': 1, 's::b': 2, 's::e': 2,
+                                  's::c': 1, 's::d': 2})
+
+    def test_select_covers_plan(self):
+        def build():
+            top = make_suite('bundle', ['test01', 'test02'])
+            top.insert(0, make_suite('charm', ['charm-proof', 'make lint']))
+            return top
+        plan = TestPlan(build()).ids()
+        seen = []
+        for index in (1, 2, 3):
+            suite = build()
+            self.assertEqual(shard.select(suite, index, 3), plan)
+            seen.extend(TestPlan(suite).ids())
+            for element in suite:
+                if isinstance(element, spec.Suite):
+                    self.assertTrue(len(element))
+        self.assertEqual(sorted(seen), sorted(plan))
+
+    def test_merge(self):
+        plan = ['c::proof', 'b::test01', 'b::test02']
+        reports = [
+            {'revision': '1', 'testdir': '/t',
+             'shard': {'index': 1, 'count': 2, 'plan': plan},
+             'tests': [{'suite': 'b', 'test': 'test02', 'returncode': 0}]},
+            {'revision': '1', 'testdir': '/t',
+             'shard': {'index': 2, 'count': 2, 'plan': plan},
+             'tests': [{'suite': 'c', 'test': 'proof', 'returncode': 0},
+                       {'suite': 'b', 'test': 'test01', 'returncode': 1}]},
+        ]
+        merged = shard.merge(reports)
+        self.assertNotIn('shard', merged)
+        self.assertEqual(merged['revision'], '1')
+        self.assertEqual([t['test'] for t in merged['tests']],
+                         ['proof', 'test01', 'test02'])
@@ -1,5 +1,7 @@
 import pkg_resources
 import os
+import threading
+import time
 import unittest
 
 import mock
@@ -62,6 +64,173 @@ class TestSpec(unittest.TestCase):
                          ['/bin/ls', '-al'])
 
 
+class TestSpecRecord(unittest.TestCase):
+
+    def setUp(self):
+        self.parent = config.Parser(setup=['suite-setup'], timeout=60)
+        self.test = spec.Spec(locate('test02'), self.parent)
+
+    def test_layers(self):
+        self.assertEqual(self.test.setup, ['suite-setup', 'setup02'])
+        self.assertEqual(self.test.timeout, 60)
+        self.assertEqual(self.test.makefile,
+                         config.Parser.DEFAULT_MAKE_TARGETS)
+        self.assertEqual(self.test['name'], 'test02')
+        self.assertIn('setup', self.test)
+        self.assertNotIn('missing', self.test)
+        self.assertRaises(KeyError, lambda: self.test['missing'])
+        self.assertEqual(dict(self.test.items())['setup'],
+                         ['suite-setup', 'setup02'])
+
+    def test_overrides_leave_layers_alone(self):
+        self.test.setup.append('changed')
+        self.test.timeout = 5
+        self.test['setup'] = ['only']
+        other = spec.Spec(locate('test02'), self.parent)
+        self.assertEqual(self.test.setup, ['only'])
+        self.assertEqual(self.test.timeout, 5)
+        self.assertEqual(other.setup, ['suite-setup', 'setup02'])
+        self.assertEqual(other.timeout, 60)
+        self.assertEqual(self.parent.setup, ['suite-setup'])
+
+    def test_compact(self):
+        self.assertFalse(hasattr(self.test, '__dict__'))
+        self.assertIs(self.test.parent, self.parent)
+
+
+class TestOrderTests(unittest.TestCase):
+
+    def setUp(self):
+        model = models.Charm({
+            'name': 'charm',
+            'directory': '/charm',
+            'testdir': '/charm/tests',
+        })
+        self.options = FakeOptions(juju_major_version=2)
+        self.suite = spec.Suite(model, self.options)
+        self.suite._config = config.Parser()
+        self.tests = ['/charm/tests/%s' % t for t in ('a', 'b', 'c', 'd')]
+
+    def test_name_order(self):
+        self.assertEqual(self.suite.order_tests(self.tests), self.tests)
+
+    def test_pinned(self):
+        self.suite._config = config.Parser(pinned=['c', 'missing', 'b'])
+        self.assertEqual(
+            [os.path.basename(t) for t in self.suite.order_tests(self.tests)],
+            ['c', 'b', 'a', 'd'])
+
+    def test_duration_order(self):
+        self.suite._config = config.Parser(pinned=['d'])
+        self.options.order = 'duration'
+        self.options.history_db = mock.Mock()
+        self.options.history_db.durations.return_value = {
+            'charm::a': 5, 'charm::c': 50, 'charm::d': 1, 'other::b': 99}
+        self.assertEqual(
+            [os.path.basename(t) for t in self.suite.order_tests(self.tests)],
+            ['d', 'b', 'c', 'a'])
+
+
+class TestCharmSuites(unittest.TestCase):
+
+    def setUp(self):
+        self.options = FakeOptions(juju_major_version=2)
+        self.options.exclude = []
+        self.options.skip_implicit = False
+        self.suite = spec.Suite(fake_model(), self.options)
+        self.suite._config = config.Parser(packages=['bundle-package'])
+
+    def charm(self, name):
+        charm = mock.Mock(path='/nowhere')
+        charm.name = name
+        return charm
+
+    @mock.patch('bundletester.spec.models.Charm.from_deployer_charm')
+    def test_order(self, from_deployer_charm):
+        from_deployer_charm.side_effect = lambda charm, mode: models.Charm({
+            'name': charm.name, 'directory': '/' + charm.name,
+            'testdir': None})
+        charms = [self.charm('charm%s' % i) for i in range(20)]
+        with mock.patch.object(spec.Suite, 'find_implicit_tests',
+                               lambda suite: suite.append(suite.name)):
+            suites = self.suite.charm_suites(charms)
+        self.assertEqual([s.name for s in suites],
+                         [c.name for c in charms])
+
+    @mock.patch('bundletester.spec.models.Charm.from_deployer_charm')
+    def test_errors_collected(self, from_deployer_charm):
+        def copy(charm, mode):
+            if charm.name != 'good':
+                raise OSError('%s is broken' % charm.name)
+            return models.Charm({'name': charm.name, 'directory': '/good',
+                                 'testdir': None})
+        from_deployer_charm.side_effect = copy
+        charms = [self.charm(n) for n in ('bad1', 'good', 'bad2')]
+        with self.assertRaises(OSError) as e:
+            self.suite.charm_suites(charms)
+        self.assertIn('bad1: bad1 is broken', str(e.exception))
+        self.assertIn('bad2: bad2 is broken', str(e.exception))
+
+    @mock.patch('bundletester.spec.models.Charm.from_deployer_charm')
+    def test_stream(self, from_deployer_charm):
+        def copy(charm, mode):
+            if charm.name == 'bad':
+                raise OSError('broken')
+            return models.Charm({'name': charm.name,
+                                 'directory': '/' + charm.name,
+                                 'testdir': None})
+        from_deployer_charm.side_effect = copy
+        charms = [self.charm(n) for n in ('one', 'bad', 'two')]
+        with mock.patch.object(spec.Suite, '_charms', return_value=charms), \
+                mock.patch.object(spec.Suite, 'find_implicit_tests'):
+            results = list(self.suite.stream_charm_suites())
+        names = [s.name if s is not None else None for s, _ in results]
+        self.assertEqual(names, ['one', None, 'two'])
+        self.assertEqual(results[1][1], 'bad: broken')
+
+    def test_stream_closed(self):
+        discovering = threading.Event()
+        stopped = threading.Event()
+
+        def iter_charm_suites(suite, charms):
+            try:
+                while True:
+                    discovering.set()
+                    yield None, 'broken'
+                    time.sleep(0.01)
+            finally:
+                stopped.set()
+        with mock.patch.object(spec.Suite, '_charms', return_value=[]), \
+                mock.patch.object(spec.Suite, 'iter_charm_suites',
+                                  iter_charm_suites):
+            results = self.suite.stream_charm_suites()
+            next(results)
+            results.close()
+            self.assertTrue(stopped.wait(5))
+
+    @mock.patch('bundletester.spec.ThreadPool')
+    def test_iter_closed_drops_charms(self, pool):
+        pool.return_value.imap.return_value = iter([(None, 'a'), (None, 'b')])
+        results = self.suite.iter_charm_suites([self.charm('a'),
+                                                self.charm('b')])
+        next(results)
+        results.close()
+        self.assertTrue(pool.return_value.terminate.called)
+        self.assertFalse(pool.return_value.close.called)
+
+    def test_stream_fetch_error(self):
+        with mock.patch.object(spec.Suite, '_charms',
+                               side_effect=OSError('no bundle')):
+            results = list(self.suite.stream_charm_suites())
+        self.assertEqual(results, [(None, 'mybundle.yaml: no bundle')])
+
+    def test_charm_config_leaves_parent_alone(self):
+        charm = config.Parser(parent=self.suite.config)
+        charm.packages = ['charm-package']
+        self.assertEqual(charm.packages, ['bundle-package', 'charm-package'])
+        self.assertEqual(self.suite.config.packages, ['bundle-package'])
+
+
 class TestDeployCommand(unittest.TestCase):
 
     def test_not_bundle(self):
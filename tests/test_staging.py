@@ -0,0 +1,74 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from bundletester import models
+from bundletester import staging
+
+
+class TestStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.src, 'hooks'))
+        with open(os.path.join(self.src, 'hooks', 'install'), 'w') as fp:
+            fp.write('#!/bin/sh\n')
+        os.symlink('install', os.path.join(self.src, 'hooks', 'start'))
+        os.symlink('hooks', os.path.join(self.src, 'actions'))
+        self.dst = os.path.join(self.tmpdir, 'dst')
+
+    def assertStaged(self):
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'actions')),
+                         'hooks')
+        self.assertEqual(
+            os.readlink(os.path.join(self.dst, 'hooks', 'start')), 'install')
+        with open(os.path.join(self.dst, 'hooks', 'install')) as fp:
+            self.assertEqual(fp.read(), '#!/bin/sh\n')
+
+    def test_hardlink(self):
+        stats = staging.stage(self.src, self.dst, 'hardlink')
+        self.assertStaged()
+        self.assertEqual(stats['mode'], 'hardlink')
+        self.assertEqual(stats['written'], 0)
+        self.assertEqual(stats['size'], staging.tree_size(self.src))
+        self.assertEqual(
+            os.stat(os.path.join(self.dst, 'hooks', 'install')).st_ino,
+            os.stat(os.path.join(self.src, 'hooks', 'install')).st_ino)
+
+    def test_copy(self):
+        stats = staging.stage(self.src, self.dst, 'copy')
+        self.assertStaged()
+        self.assertEqual(stats['written'], stats['size'])
+
+    def test_symlink(self):
+        staging.stage(self.src, self.dst, 'symlink')
+        self.assertEqual(os.path.realpath(self.dst), self.src)
+
+    @mock.patch('bundletester.staging.hardlink')
+    @mock.patch('bundletester.staging.reflink')
+    def test_auto_falls_back(self, reflink, hardlink):
+        def fail(src, dst):
+            os.mkdir(dst)
+            raise OSError(errno.ENOTSUP, 'Operation not supported')
+        reflink.side_effect = fail
+        with mock.patch.dict(staging.STAGERS, reflink=reflink,
+                             hardlink=hardlink):
+            stats = staging.stage(self.src, self.dst)
+        self.assertEqual(stats['mode'], 'copy')
+        # Hardlinked trees share their files with the source
+        self.assertFalse(hardlink.called)
+        self.assertStaged()
+
+    def test_from_deployer_charm(self):
+        charm = mock.Mock(path=self.src)
+        charm.name = 'cs:trusty/mysql-38'
+        model = models.Charm.from_deployer_charm(charm, 'hardlink')
+        self.addCleanup(shutil.rmtree, os.path.dirname(model['directory']))
+        self.assertEqual(os.path.basename(model['directory']), 'mysql')
+        self.assertEqual(model['staging']['mode'], 'hardlink')
@@ -0,0 +1,15 @@
+import unittest
+
+from bundletester import tester
+
+
+class TestEnvironments(unittest.TestCase):
+
+    def test_expand_environments(self):
+        environments, new_models = tester.expand_environments(
+            ['c:a,c:b', 'c:bt-{}'], 2)
+        self.assertEqual(environments, ['c:a', 'c:b', 'c:bt-1', 'c:bt-2'])
+        self.assertEqual(new_models, ['c:bt-1', 'c:bt-2'])
+
+    def test_expand_environments_none(self):
+        self.assertEqual(tester.expand_environments(None, 2), ([], []))
@@ -0,0 +1,83 @@
+import os
+import pkg_resources
+import unittest
+
+from bundletester import config
+from bundletester import models
+from bundletester import spec
+from bundletester import testplan
+
+TEST_FILES = pkg_resources.resource_filename(__name__, 'files')
+
+
+class Options(object):
+    tests_yaml = None
+
+
+def make_suite(name, tests):
+    suite = spec.Suite(models.TestDir({'name': name,
+                                       'directory': TEST_FILES,
+                                       'testdir': TEST_FILES}),
+                       Options())
+    suite._config = config.Parser()
+    for test in tests:
+        suite.append(config.Parser(name=test, suite=suite))
+    return suite
+
+
+class TestTestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.top = make_suite('bundle', ['test01', 'test02'])
+        self.charm1 = make_suite('charm1', ['proof'])
+        self.charm2 = make_suite('charm2', ['proof', 'lint'])
+        self.top.insert(0, self.charm2)
+        self.top.insert(0, self.charm1)
+        self.plan = testplan.TestPlan(self.top)
+
+    def test_flat_order(self):
+        self.assertEqual(len(self.plan), 5)
+        self.assertEqual(self.plan.ids(), [
+            'charm1::proof', 'charm2::proof', 'charm2::lint',
+            'bundle::test01', 'bundle::test02'])
+        self.assertEqual([t.index for t in self.plan], range(5))
+        self.assertEqual([self.plan.suites[t.suite].name for t in self.plan],
+                         ['charm1', 'charm2', 'charm2', 'bundle', 'bundle'])
+
+    def test_suites(self):
+        self.assertEqual(self.plan.children(self.top),
+                         [self.charm1, self.charm2])
+        self.assertEqual([s.name for s in self.plan.own_specs(self.top)],
+                         ['test01', 'test02'])
+        self.assertEqual([s.name for s in self.plan.specs(self.charm2)],
+                         ['proof', 'lint'])
+        self.assertEqual(self.plan.count(self.charm2), 2)
+        self.assertEqual(self.plan.count(self.top), 5)
+
+    def test_phase_scripts_resolved(self):
+        # Phase scripts are relative to the parent of the tests directory
+        self.top.testdir = os.path.join(TEST_FILES, 'tests')
+        self.top[2].setup = ['setup02', 'missing']
+        self.top[2].teardown = ['setup02', 'test01']
+        plan = testplan.TestPlan(self.top)
+        test = plan.get(self.top[2])
+        self.assertEqual(test.id, 'bundle::test01')
+        self.assertEqual(test.setup, [os.path.join(TEST_FILES, 'setup02')])
+        self.assertEqual(test.teardown, [os.path.join(TEST_FILES, 'test01'),
+                                         os.path.join(TEST_FILES, 'setup02')])
+
+    def test_filter(self):
+        self.plan.filter(lambda s: s.name != 'proof')
+        self.assertEqual(self.plan.ids(), [
+            'charm2::lint', 'bundle::test01', 'bundle::test02'])
+        self.assertEqual(self.top[0], self.charm2)
+        self.assertEqual(len(self.charm2), 1)
+
+    def test_results(self):
+        for suite, code in (('charm1', 0), ('charm2', 1), ('charm2', 0),
+                            ('bundle', 0)):
+            self.plan.add_result({'suite': suite, 'returncode': code,
+                                  'duration': 1.5})
+        self.assertEqual(self.plan.results(), {0: 3, 1: 1})
+        self.assertEqual(self.plan.results('charm2'), {0: 1, 1: 1})
+        self.assertEqual(self.plan.seconds, 6)
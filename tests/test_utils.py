@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from bundletester import utils
+
+
+class TestOutputCapture(unittest.TestCase):
+
+    def test_in_memory(self):
+        capture = utils.OutputCapture()
+        capture.write('a' * 10)
+        capture.write('b' * 10)
+        capture.close()
+        self.assertIsNone(capture.path)
+        self.assertEqual(capture.getvalue(), 'a' * 10 + 'b' * 10)
+
+    def test_spill_keeps_tail(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'logs', 'test.log')
+        capture = utils.OutputCapture(path, limit=15)
+        for c in 'abcd':
+            capture.write(c * 10)
+        capture.close()
+        with open(path) as f:
+            self.assertEqual(f.read(), 'a' * 10 + 'b' * 10 + 'c' * 10 +
+                             'd' * 10)
+        value = capture.getvalue()
+        self.assertTrue(value.endswith('\n' + 'c' * 5 + 'd' * 10))
+        self.assertIn(path, value)
+
+
+class TestRunLogDir(unittest.TestCase):
+
+    def test_keeps_recent_runs(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        base = os.path.join(tmpdir, 'logs')
+        for name in ('20240101-000000-1', '20240102-000000-1',
+                     '20240103-000000-1'):
+            os.makedirs(os.path.join(base, name))
+        with mock.patch.dict(os.environ, {'BUNDLETESTER_CACHE': tmpdir}):
+            path = utils.run_log_dir(keep=2)
+        self.assertTrue(os.path.isdir(path))
+        self.assertEqual(sorted(os.listdir(base)),
+                         ['20240103-000000-1', os.path.basename(path)])
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from bundletester import venvcache
+
+
+class TestVenvCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.built = []
+
+    def build(self, size):
+        def build(path):
+            self.built.append(os.path.basename(path))
+            os.makedirs(path)
+            with open(os.path.join(path, 'data'), 'w') as fp:
+                fp.write('x' * size)
+        return build
+
+    def test_key(self):
+        req = os.path.join(self.tmpdir, 'requirements.txt')
+        with open(req, 'w') as fp:
+            fp.write('requests\n')
+        key = venvcache.venv_key('python', [req], ['a', 'b'])
+        self.assertEqual(key, venvcache.venv_key('python', [req], ['b', 'a']))
+        self.assertNotEqual(key, venvcache.venv_key('python3', [req], ['a']))
+        with open(req, 'w') as fp:
+            fp.write('requests==2.0\n')
+        self.assertNotEqual(
+            key, venvcache.venv_key('python', [req], ['a', 'b']))
+
+    def test_reuse(self):
+        cache = venvcache.VenvCache(self.tmpdir)
+        path = cache.get('a', self.build(1))
+        self.assertEqual(path, os.path.join(self.tmpdir, 'a'))
+        self.assertEqual(venvcache.VenvCache(self.tmpdir).get(
+            'a', self.build(1)), path)
+        self.assertEqual(self.built, ['a'])
+
+    def test_evict_only_after_build(self):
+        cache = venvcache.VenvCache(self.tmpdir)
+        with mock.patch.object(venvcache.VenvCache, 'evict') as evict:
+            cache.get('a', self.build(1))
+            self.assertEqual(evict.call_count, 1)
+            venvcache.VenvCache(self.tmpdir).get('a', self.build(1))
+            cache.get('a', self.build(1))
+            self.assertEqual(evict.call_count, 1)
+
+    def test_rebuild_incomplete(self):
+        os.makedirs(os.path.join(self.tmpdir, 'a'))
+        venvcache.VenvCache(self.tmpdir).get('a', self.build(1))
+        self.assertEqual(self.built, ['a'])
+
+    def test_evict_lru_not_in_use(self):
+        mib = 1024 * 1024
+        for key in ('old', 'older'):
+            venvcache.VenvCache(self.tmpdir, max_size=0).get(
+                key, self.build(mib))
+        past = time.time() - 100
+        os.utime(os.path.join(self.tmpdir, 'older', venvcache.READY),
+                 (past, past))
+        in_use = venvcache.VenvCache(self.tmpdir, max_size=0)
+        in_use.get('new', self.build(mib))
+        # Least recently used, but held by in_use
+        os.utime(os.path.join(self.tmpdir, 'new', venvcache.READY),
+                 (past - 100, past - 100))
+        venvcache.VenvCache(self.tmpdir, max_size=3).get(
+            'newest', self.build(1))
+        self.assertEqual(
+            sorted(k for k in os.listdir(self.tmpdir)
+                   if not k.endswith('.lock')),
+            ['new', 'newest', 'old'])
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from bundletester import config
+from bundletester import yamlfiles
+
+
+class TestYamlFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        yamlfiles.reset()
+        self.addCleanup(yamlfiles.reset)
+        self.path = self.write('tests.yaml',
+                               'packages: [tree]\nmatrix: {a: [1]}\n')
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fp:
+            fp.write(content)
+        return path
+
+    def test_parsed_once(self):
+        first = yamlfiles.load(self.path)
+        self.assertIs(yamlfiles.load(self.path), first)
+        self.assertEqual(first, {'packages': ['tree'], 'matrix': {'a': [1]}})
+        stats = yamlfiles.stats()
+        self.assertEqual(stats['parses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_reparsed_when_changed(self):
+        yamlfiles.load(self.path)
+        self.write('tests.yaml', 'packages: [tree, jq]\n')
+        self.assertEqual(yamlfiles.load(self.path), {'packages': ['tree',
+                                                                  'jq']})
+        self.assertEqual(yamlfiles.stats()['parses'], 2)
+
+    def test_rename_dir_keeps_document(self):
+        os.mkdir(os.path.join(self.tmpdir, 'charm'))
+        yamlfiles.load(self.write('charm/tests.yaml', 'packages: [jq]\n'))
+        renamed = os.path.join(self.tmpdir, 'renamed')
+        os.rename(os.path.join(self.tmpdir, 'charm'), renamed)
+        yamlfiles.load(os.path.join(renamed, 'tests.yaml'))
+        self.assertEqual(yamlfiles.stats()['parses'], 1)
+
+    def test_reused_inode(self):
+        # A new file in the same inode, with the same mtime and size
+        yamlfiles.load(self.path)
+        st = os.stat(self.path)
+        other = self.write('other.yaml', 'packages: [jq]\nmatrix: {b: [2]}\n')
+        reused = mock.Mock(st_dev=st.st_dev, st_ino=st.st_ino,
+                           st_mtime=st.st_mtime, st_size=st.st_size,
+                           st_ctime=st.st_ctime + 1)
+        with mock.patch('os.stat', return_value=reused):
+            self.assertEqual(yamlfiles.load(other)['packages'], ['jq'])
+        self.assertEqual(yamlfiles.stats()['parses'], 2)
+
+    def test_read_only(self):
+        data = yamlfiles.load(self.path)
+        self.assertRaises(TypeError, data.update, packages=[])
+        self.assertRaises(TypeError, data['packages'].append, 'jq')
+        self.assertRaises(TypeError, data['matrix'].setdefault, 'b', [])
+        thawed = yamlfiles.thaw(data)
+        thawed['packages'].append('jq')
+        self.assertEqual(data['packages'], ['tree'])
+        self.assertIs(type(thawed['matrix']), dict)
+
+    def test_parsers_share_nothing(self):
+        one = config.Parser(self.path)
+        one.packages = ['jq']
+        self.assertEqual(config.Parser(self.path).packages, ['tree'])
+        self.assertEqual(yamlfiles.stats()['parses'], 1)